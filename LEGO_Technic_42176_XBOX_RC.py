@@ -16,21 +16,39 @@ if sys.platform == "win32":
 
 import pygame
 import asyncio
+import argparse
 from bleak import BleakScanner, BleakClient
 import time
-
-start_time = 0
+from contextlib import nullcontext
+from latest_value_writer import LatestValueWriter
+from control_loop import ControlLoop
+from hub_telemetry import HubTelemetry, PROP_BATTERY_VOLTAGE
+from hub_registry import HubRegistry
+from joystick_input import JoystickInput
+from metrics import WriteMetrics
+import lwp_codec as lwp
+from response_curves import AxisMapping, AXIS_UNIPOLAR, default_profiles, g923_profile, xbox_profile, load_config
+
+BRAKE_PULSE_S = 0.4 # how long a bumper press holds the brake frame
+PROFILE_BUTTON = 6  # XBOX "view" button, switches to the next response profile
 
 class TechnicMoveHub:
-    def __init__(self, device_name):
+    def __init__(self, device_name, registry=None):
         self.device_name = device_name
+        self.registry = registry # optional HubRegistry for warm-start connections
+        self.connect_metrics = {}
         self.service_uuid = "00001623-1212-EFDE-1623-785FEABCD123"
         self.char_uuid = "00001624-1212-EFDE-1623-785FEABCD123"
         self.client = None
+        self.writer = None
+        self.telemetry = None
+        self.drive_encoder = lwp.DriveEncoder()
+        self.write_metrics = WriteMetrics() # latency histogram and rate of every GATT write
+        self.tracer = None # optional tracing.Tracer, send_data() opens a span per write of a traced request
         
-        self.LIGHTS_OFF_OFF =    0b100
-        self.LIGHTS_OFF_ON =     0b101
-        self.LIGHTS_ON_ON =      0b000
+        self.LIGHTS_OFF_OFF =    lwp.LIGHTS_OFF_OFF
+        self.LIGHTS_OFF_ON =     lwp.LIGHTS_OFF_ON
+        self.LIGHTS_ON_ON =      lwp.LIGHTS_ON_ON
 
     def run_discover(self):
         try:
@@ -40,139 +58,222 @@ class TechnicMoveHub:
             print(f"Discovery failed with error: {e}")
             return None
 
-    async def scan_and_connect(self):
-        scanner = BleakScanner()
+    def matches(self, device, advertisement_data=None):
+        name = advertisement_data.local_name if advertisement_data is not None else None
+        name = name or device.name
+        return name is not None and self.device_name in name
+
+    async def connect_device(self, device, timeout=10.0):
+        """
+        connect and pair to a BLEDevice or an address, returns True when connected
+        """
+        self.client = BleakClient(device, timeout=timeout)
+
+        t0 = time.monotonic()
+        await self.client.connect()
+        self.connect_metrics["connect_s"] = time.monotonic() - t0
+        if self.client.is_connected:
+            print(f"Connected to {self.device_name}")
+            
+            t0 = time.monotonic()
+            paired = await self.client.pair(protection_level = 2) # this is crucial!!!
+            self.connect_metrics["pair_s"] = time.monotonic() - t0
+            if not paired:
+                print(f"could not pair")
+            return True
+        else:
+            print(f"Failed to connect to {self.device_name}")
+            return False
+
+    async def scan_and_connect(self, scan_timeout=5.0, connect_timeout=10.0):
+        """
+        connect to the hub, trying the address cached in self.registry first
+        the fallback scan stops at the first matching advertisement
+        timings end up in self.connect_metrics
+        """
+        self.connect_metrics = {"method": None, "cache_attempt_s": None, "scan_s": None,
+                                "connect_s": None, "pair_s": None, "total_s": None}
+        start = time.monotonic()
+
+        cached = self.registry.get(self.device_name) if self.registry is not None else None
+        if cached is not None:
+            print(f"connecting to cached {cached['name']} at {cached['address']}...")
+            try:
+                if await self.connect_device(cached["address"], timeout=connect_timeout):
+                    self.registry.remember(cached["address"], cached["name"])
+                    return self._connected("cache", start)
+            except Exception as e:
+                print(f"Cached address failed: {e}")
+                # pair() can fail after connect() succeeded, don't leave that client connected behind the scan
+                if self.client is not None and self.client.is_connected:
+                    try:
+                        await self.client.disconnect()
+                    except Exception as e:
+                        print(f"Failed to disconnect: {e}")
+            self.connect_metrics["cache_attempt_s"] = time.monotonic() - start
+
         print(f"searching for Technic Move Hub...")
-        devices = await scanner.discover(timeout =5)
-
-        for device in devices:
-            if device.name is not None and self.device_name in device.name:
-                print(f"Found device: {device.name} with address: {device.address}")
-                self.client = BleakClient(device)
-
-                
-                await self.client.connect()
-                if self.client.is_connected:
-                    print(f"Connected to {self.device_name}")
-                    
-                    paired = await self.client.pair(protection_level = 2) # this is crucial!!!
-                    if not paired:
-                        print(f"could not pair")
-                    return True
-                else:
-                    print(f"Failed to connect to {self.device_name}")
+        t0 = time.monotonic()
+        device = await BleakScanner.find_device_by_filter(self.matches, timeout=scan_timeout)
+        self.connect_metrics["scan_s"] = time.monotonic() - t0
+
+        if device is not None:
+            print(f"Found device: {device.name} with address: {device.address}")
+            if await self.connect_device(device, timeout=connect_timeout):
+                if self.registry is not None:
+                    self.registry.remember(device.address, device.name or self.device_name)
+                return self._connected("scan", start)
+            return False
         print(f"Device {self.device_name} not found.")
         return False
 
-    async def send_data(self, data):
-        global start_time
+    def _connected(self, method, start):
+        self.connect_metrics["method"] = method
+        self.connect_metrics["total_s"] = time.monotonic() - start
+        print(f"Connected via {method} in {self.connect_metrics['total_s']:.2f} s")
+        return True
+
+    async def write_frame(self, data, response=None):
+        """
+        write one frame to the hub characteristic, raising on failure
+        response=None keeps bleak's default, True/False forces write with/without response
+        """
+        if self.client is None:
+            raise ConnectionError("No BLE client connected.")
+        start = time.monotonic()
+        try:
+            await self.client.write_gatt_char(self.char_uuid, data, response=response)
+        except Exception:
+            self.write_metrics.record(time.monotonic() - start, ok=False)
+            raise
+        self.write_metrics.record(time.monotonic() - start)
+
+    async def send_data(self, data, response=None):
         if self.client is None:
             print("No BLE client connected.")
             return
 
         try:
             # Write the data to the characteristic
-            await self.client.write_gatt_char(self.char_uuid, data)
+            span = self.tracer.child_span("send_data", cat="ble", hub=self.device_name, size=len(data)) \
+                if self.tracer is not None else nullcontext()
+            with span:
+                await self.write_frame(data, response)
             #print(f"Data written to characteristic {self.char_uuid}: {data}")
-       
-            elapsed_time_ms = (time.time() - start_time) * 1000
-            #print(f"Timestamp: {elapsed_time_ms:.2f} ms", end=" ")
-            #print(' '.join(f'{byte:02x}' for byte in data))
 
         except Exception as e:
             print(f"Failed to write data: {e}")
 
+    async def send_command(self, data):
+        """
+        frames that must not be coalesced (LEDs, motors, calibration)
+        queued in order on the background writer when it runs, written directly otherwise
+        """
+        if self.writer is not None and self.writer.running:
+            self.writer.enqueue(data)
+            return
+        await self.send_data(data)
+
+    def start_writer(self, response=False):
+        """
+        opt-in: drive() hands its frame to one background writer and returns at once
+        the writer always sends the newest drive frame, older pending ones are superseded
+        response=False uses write-without-response, True waits for the hub to acknowledge
+        """
+        if self.writer is None or not self.writer.running:
+            self.writer = LatestValueWriter(lambda frame: self.write_frame(frame, response),
+                                            name=f"{self.device_name} writer")
+        self.writer.start()
+
+    async def stop_writer(self, flush=True):
+        if self.writer is not None:
+            await self.writer.stop(flush)
+
+    def writer_stats(self):
+        """counts of submitted, sent, superseded and dropped drive frames, queue depth and write latency"""
+        if self.writer is None:
+            return None
+        return self.writer.stats()
+
+    async def start_telemetry(self, capacity=256):
+        """
+        subscribe to hub notifications and decode them into ring buffers, see hub_telemetry.py
+        """
+        if self.telemetry is None:
+            self.telemetry = HubTelemetry(self, capacity)
+        if not self.telemetry.started:
+            await self.telemetry.start()
+        return self.telemetry
+
     async def disconnect(self):
+        await self.stop_writer()
         if self.client and self.client.is_connected:
             await self.client.disconnect()
             print("Disconnected from the device")
     
-    LED_MODE_COLOR = 0x00
-    LED_MODE_RGB = 0x01
+    ID_LED = lwp.PORT_LED
+    LED_MODE_COLOR = lwp.LED_MODE_COLOR
+    LED_MODE_RGB = lwp.LED_MODE_RGB
+    SC_BUFFER_NO_FEEDBACK = lwp.SC_BUFFER_NO_FEEDBACK
+    MOTOR_MODE_POWER = lwp.MOTOR_MODE_POWER
+    END_STATE_BRAKE = lwp.END_STATE_BRAKE
 
     async def change_led_color(self, colorID):
         if self.client and self.client.is_connected:
-            await self.send_data(bytearray([0x08, 0x00, 0x81, self.ID_LED, self.IO_TYPE_RGB_LED, 0x51, self.LED_MODE_COLOR, colorID]))
+            await self.send_command(lwp.encode_led_color(colorID, self.ID_LED))
 
     async def motor_start_power(self, motor, power):
         if self.client and self.client.is_connected:
-            await self.send_data(bytearray([0x08, 0x00, 0x81, motor&0xFF, self.SC_BUFFER_NO_FEEDBACK, 0x51, self.MOTOR_MODE_POWER, 0xFF&power]))
+            await self.send_command(lwp.encode_motor_power(motor, power, self.SC_BUFFER_NO_FEEDBACK))
 
     async def motor_stop(self, motor, brake=True):
         # motor can be 0x32, 0x33, 0x34
         if self.client and self.client.is_connected:
-            await self.send_data(bytearray([0x08, 0x00, 0x81, motor&0xFF, self.SC_BUFFER_NO_FEEDBACK, 0x51, self.MOTOR_MODE_POWER, self.END_STATE_BRAKE if brake else 0x00]))
+            await self.send_command(lwp.encode_motor_power(motor, lwp.POWER_BRAKE if brake else lwp.POWER_FLOAT,
+                                                           self.SC_BUFFER_NO_FEEDBACK))
 
     async def calibrate_steering(self):
-        await self.send_data(bytes.fromhex("0d008136115100030000001000"))
-        #await asyncio.sleep(0.1)
-        await self.send_data(bytes.fromhex("0d008136115100030000000800"))
-        #await asyncio.sleep(0.1)
+        for frame in lwp.CALIBRATE_STEERING:
+            await self.send_command(frame)
+            #await asyncio.sleep(0.1)
+
+    def submit_drive(self, speed=0, angle=0, lights = 0x00):
+        """
+        replace the pending drive state of the background writer, returns its sequence number
+        the frame is patched in place: while one is still pending it is updated,
+        once the writer has taken it the other preallocated frame is used
+        """
+        encoder = self.drive_encoder
+        if not self.writer.pending:
+            encoder.swap()
+        return self.writer.submit(encoder.encode(speed, angle, lights))
 
     async def drive(self, speed=0, angle=0, lights = 0x00):
-        await self.send_data(bytearray([0x0d,0x00,0x81,0x36,0x11,0x51,0x00,0x03,0x00, speed&0xFF, angle&0xFF, lights&0xFF,0x00]))
+        if self.writer is not None and self.writer.running:
+            self.submit_drive(speed, angle, lights)
+            return
+        await self.send_data(self.drive_encoder.encode(speed, angle, lights))
         #await asyncio.sleep(0.1)
 
-def normalize(value):
-    """
-    input -1 to 1
-    return 0 to 1
-    """
-    if value == 0:
-        return 0
-    else:
-        return (-value + 1)/2
-
-def ease_in_expo(x: float) -> float:
-    """ https://easings.net/#easeInExpo """
-    if x == 0:
-        return 0
-    return 2 ** (10 * x - 10)
-
-def ease_in_quart(x: float) -> float:
-    """ https://easings.net/#easeInQuart """
-    return x ** 4
-
-def ease_in_quad(x: float) -> float:
-    """ https://easings.net/#easeInQuad """
-    return x ** 2
-  
+G923 = g923_profile()
+XBOX = xbox_profile()
+LEFT_STICK_Y = AxisMapping(1, deadzone=0.03, invert=True)
+RIGHT_STICK_X = AxisMapping(2, deadzone=0.03)
+LEFT_TRIGGER = AxisMapping(4, kind=AXIS_UNIPOLAR)
+RIGHT_TRIGGER = AxisMapping(5, kind=AXIS_UNIPOLAR)
+
 def get_steering_wheel(joystick):
-    # G923 Racing Wheel for PlayStation and PC
-    steering = joystick.get_axis(0) # volante -1 to 0
-    accelerator_pedal = normalize(joystick.get_axis(1)) # acelerador 0 to 1
-    break_pedal = normalize(joystick.get_axis(2)) # freio 0 to 1
-
-    # skip issue to 0.5 with no value
-    # if accelerator_pedal == 0.5 and wheel_updated == False:
-    #     accelerator_pedal = 0
-    # else:
-    #     wheel_updated = True
-    # button 4 = borboleta direita
-    # button 5 = borboleta direita
-
-    # break is priority
-    if break_pedal > 0.1:
-        throttle = -ease_in_quad(break_pedal)
-    else:
-        throttle = ease_in_quad(accelerator_pedal)
-        
-    return round(steering*100), round(throttle*100)
+    # G923 Racing Wheel for PlayStation and PC, brake pedal has priority
+    return G923.map(joystick)
 
 def get_left_joystick(joystick):
-    x = round(joystick.get_axis(0)*100)
-    y = -round(joystick.get_axis(1)*100)
-    return (x,y)
+    return (XBOX.steering.read(joystick), LEFT_STICK_Y.read(joystick))
 
 def get_right_joystick(joystick):
-    x = round(joystick.get_axis(2)*100)
-    y = -round(joystick.get_axis(3)*100)
-    return (x,y)
+    return (RIGHT_STICK_X.read(joystick), XBOX.throttle.read(joystick))
 
 def get_triggers(joystick):
-    left = round((joystick.get_axis(4)+100)/2)
-    right = round((joystick.get_axis(5)+100)/2)
-    return (left, right)
+    return (LEFT_TRIGGER.read(joystick), RIGHT_TRIGGER.read(joystick))
 
 
 def get_A_button(joystick):
@@ -193,12 +294,22 @@ def get_left_bumper(joystick):
 def get_right_bumper(joystick):
     return joystick.get_button(5)
 
-async def main():
+def get_profile_button(joystick):
+    return joystick.get_button(PROFILE_BUTTON) if joystick.get_numbuttons() > PROFILE_BUTTON else 0
+
+async def main(args):
     device_name = "Technic Move"  # Replace with your BLE device's name
-    hub = TechnicMoveHub(device_name)
+    hub = TechnicMoveHub(device_name, registry=None if args.no_cache else HubRegistry())
     if not await hub.scan_and_connect():
         print("Technic hub not found!")
         return
+
+    if args.coalesce:
+        hub.start_writer(response=args.response)
+
+    if args.telemetry:
+        telemetry = await hub.start_telemetry()
+        await telemetry.enable_hub_property(PROP_BATTERY_VOLTAGE)
         
     # Initialize Pygame
     pygame.init()
@@ -223,68 +334,122 @@ async def main():
     steering_old = 0
     lights_old = 0
     was_brake = False
-    start_time = time.time()
-
-    try:
-        while True:
-            # Pump Pygame event loop
-            pygame.event.pump() # poll joystick
-
-            # Print controller inputs
-            # throttle = get_right_joystick(joystick)[1]
-            # steering = get_left_joystick(joystick)[0]
+    braking = False
+    refresh = True
+
+    # throttle / steering below 3 are sent as 0
+    profiles = default_profiles(min_output=3)
+    if args.curves:
+        load_config(args.curves, profiles)
+    profiles.swap(args.profile)
+    print(f"response profile: {profiles.active.name}")
+    profile_old = False
+
+    loop = ControlLoop(rate_hz=args.rate)
+    inputs = JoystickInput(joystick)
+
+    def end_brake_pulse():
+        nonlocal braking, lights_old, refresh
+        braking = False
+        lights_old = None # force the current state to be sent again
+        refresh = True
+
+    async def tick():
+        nonlocal lights, toggle_old, throttle_old, steering_old, lights_old, was_brake, braking, refresh, profile_old
+
+        # drain joystick events, nothing to map or send unless a filtered value changed
+        if not inputs.poll() and not refresh:
+            return
+        refresh = False
+        state = inputs.snapshot
+
+        # Print controller inputs
+        # throttle = get_right_joystick(state)[1]
+        # steering = get_left_joystick(state)[0]
+
+        profile_button = get_profile_button(state)
+        if profile_button and not profile_old:
+            print(f"response profile: {profiles.cycle().name}")
+        profile_old = profile_button
+
+        steering, throttle = profiles.map(state)
+        #steering = get_right_joystick(state)[0] # use only one joystick?
+
+        brake = get_right_bumper(state)
+        # toggle lights
+        toggle = get_Y_button(state)
+        if toggle and not toggle_old:
+            if lights == hub.LIGHTS_OFF_OFF :
+                print("lights on")
+                lights = hub.LIGHTS_ON_ON
+            else:
+                print("lights off")
+                lights = hub.LIGHTS_OFF_OFF
+        toggle_old = toggle
+
+        if brake and not was_brake:
+            joystick.rumble(0.0, 0.3, 300)
+            await hub.drive(0, steering, hub.LIGHTS_OFF_ON)
+            # hold the brake frame for BRAKE_PULSE_S without blocking input handling
+            braking = True
+            loop.call_later(BRAKE_PULSE_S, end_brake_pulse)
+
+        if not brake and was_brake and not braking:
+            await hub.drive(throttle, steering, lights)
+
+        was_brake = brake
+        if braking:
+            return
 
-            steering, throttle = get_steering_wheel(joystick=joystick)
-            #steering = get_right_joystick(joystick)[0] # use only one joystick?
+        if steering != steering_old or throttle != throttle_old or lights != lights_old:
+            print("throttle", throttle, "steering", steering)
+            await hub.drive(throttle, steering, lights)
         
-            if abs(throttle)<3:
-                throttle = 0
-            if abs(steering)< 3:
-                steering = 0
-
-            brake = get_right_bumper(joystick)
-            # toggle lights
-            toggle = get_Y_button(joystick)
-            if toggle and not toggle_old:
-                if lights == hub.LIGHTS_OFF_OFF :
-                    print("lights on")
-                    lights = hub.LIGHTS_ON_ON
-                else:
-                    print("lights off")
-                    lights = hub.LIGHTS_OFF_OFF
-            toggle_old = toggle
-
-       
-            if brake and not was_brake:
-                joystick.rumble(0.0, 0.3, 300)                    
-                await hub.drive(0, steering, hub.LIGHTS_OFF_ON)
-                await asyncio.sleep(0.4)
-                throttle = 0
-                throttle_old = 0
-            
-            if not brake and was_brake:
-                await hub.drive(throttle, steering, lights)
-
-            was_brake = brake
-            
-            if steering != steering_old or throttle != throttle_old or lights != lights_old and not brake:
-                print("throttle", throttle, "steering", steering)
-                await hub.drive(throttle, steering, lights)
-            
-            throttle_old = throttle
-            steering_old = steering
-            lights_old = lights
+        throttle_old = throttle
+        steering_old = steering
+        lights_old = lights
 
-            # Flush the output
-            sys.stdout.flush()
-
-            asyncio.sleep(0.05)
+        # Flush the output
+        sys.stdout.flush()
 
+    try:
+        await loop.run(tick)
     except KeyboardInterrupt:
         pass
     finally:
+        print("control loop stats", loop.stats())
+        if args.coalesce:
+            print("writer stats", hub.writer_stats())
+        if args.telemetry:
+            print("battery", hub.telemetry.battery_level(), "%")
+        await hub.disconnect()
         pygame.quit()
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Drive the LEGO Technic Move Hub with an XBOX controller or G923 wheel")
+    parser.add_argument("--coalesce", action="store_true",
+                        help="send drive commands from a background writer that only keeps the newest one")
+    parser.add_argument("--response", action="store_true",
+                        help="with --coalesce, use write-with-response instead of write-without-response")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always scan instead of connecting to the last known hub address first")
+    parser.add_argument("--telemetry", action="store_true",
+                        help="subscribe to hub notifications (battery, port values, command feedback)")
+    parser.add_argument("--simulate", action="store_true",
+                        help="use the in-process BLE simulator (ble_sim.py) instead of a real hub")
+    parser.add_argument("--rate", type=float, default=50,
+                        help="control loop rate in Hz (default 50)")
+    parser.add_argument("--profile", default="g923",
+                        help="response profile to start with: g923, xbox or one from --curves "
+                             "(the view button switches profiles while driving)")
+    parser.add_argument("--curves", metavar="JSON",
+                        help="load user response curves and profiles from a JSON file")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    if args.simulate:
+        import ble_sim
+        ble_sim.install()
+    asyncio.run(main(args))
 
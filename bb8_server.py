@@ -1,15 +1,100 @@
 import time
 import os
-import asyncio
-import signal
-import sys
-from flask import Flask, request, jsonify
+import argparse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
 from bleak import BleakError
 from droiddepot.connection import DroidConnection, discover_droid
 from droiddepot.motor import DroidMotorDirection, DroidMotorIdentifier
+from latest_value_writer import LatestValueWriter
+from metrics import Metrics, WriteMetrics
+from rate_limit import RateLimiter, RouteLimit, WriteBudget, is_stop
+from tracing import Tracer
 
-app = Flask(__name__)
 droid = None
+writer = None
+register_mode = False # --register: /drive stores the setpoint and returns before it is written
+metrics = Metrics() # --verbose prints every request's time
+drive_writes = WriteMetrics() # both motor commands of one setpoint
+limiter = None # --rate-limit
+tracer = None  # --trace: spans of requests that carry a traceparent header and of their BLE writes
+
+# BLE writes per request and share of the droid's write budget per route:
+# a setpoint is two motor commands, a sound is set_volume + set_audio_bank + play
+ROUTE_LIMITS = {
+    "drive": RouteLimit(cost=2, share=1.0),
+    "sounds": RouteLimit(cost=3, share=0.25),
+}
+
+async def write_motor_speeds(setpoint):
+    direction_left, left_speed, direction_right, right_speed = setpoint
+    start = time.monotonic()
+    try:
+        await droid.motor_controller.set_motor_speed(direction_left, DroidMotorIdentifier.LeftMotor, left_speed, 300)
+        await droid.motor_controller.set_motor_speed(direction_right, DroidMotorIdentifier.RightMotor, right_speed, 300)
+    except Exception:
+        drive_writes.record(time.monotonic() - start, ok=False)
+        raise
+    drive_writes.record(time.monotonic() - start)
+
+@asynccontextmanager
+async def lifespan(app):
+    # the droid is connected on the server's event loop, so every request
+    # reuses the same BleakClient without any loop handoff
+    global droid, writer
+    try:
+        droid = await discover_droid(retry=True)
+        droid.tracer = tracer
+        async with droid as d:
+            d: DroidConnection = d
+
+            if not d.droid.is_connected:
+                raise RuntimeError("Droid not connected!")
+
+            if register_mode:
+                # both motor writes of the newest setpoint go out at the link's pace
+                writer = LatestValueWriter(write_motor_speeds, name="droid writer")
+                writer.start()
+            try:
+                yield
+            finally:
+                if writer is not None:
+                    await writer.stop()
+
+    except OSError as err:
+        raise RuntimeError(f"Discovery failed due to operating system: {err}")
+    except BleakError as err:
+        raise RuntimeError(f"Discovery failed due to Bleak: {err}")
+    finally:
+        print("Shutting down.")
+        droid = None
+        writer = None
+        if tracer is not None:
+            tracer.close()
+
+app = FastAPI(lifespan=lifespan)
+metrics.install(app)
+
+def droid_metrics():
+    return {
+        "connected": droid is not None and droid.droid is not None and droid.droid.is_connected,
+        "drive_writes": drive_writes.as_dict(),
+        "writer": writer.stats() if writer is not None else None,
+        "heartbeat": droid.heartbeat_stats() if droid is not None else None,
+        "connection": droid.connection_stats() if droid is not None else None,
+    }
+
+metrics.add_provider("droid", droid_metrics)
+metrics.add_provider("rate_limit", lambda: limiter.stats() if limiter is not None else None)
+
+class DriveRequest(BaseModel):
+    speed: int = 0
+    angle: int = 0
+
+class SoundRequest(BaseModel):
+    soundID: int = 0
 
 def calculate_motor_speeds(speed, angle):
     base_speed = int(speed)
@@ -33,20 +118,20 @@ def normalize_values_to_motor(left_speed, right_speed):
     right_speed = int(right_speed * 1.6)
     return abs(left_speed), abs(right_speed)
 
-@app.route('/drive', methods=['POST'])
-async def drive():
-    start_time = time.time()
+@app.post('/drive')
+async def drive(data: DriveRequest, request: Request):
     try:
-        data = request.json
-        speed = data.get('speed', 0)
-        angle = data.get('angle', 0)
-
         # Ensure values are within the range -100 to 100
-        speed = max(-100, min(100, speed))
-        angle = max(-100, min(100, angle))
+        speed = max(-100, min(100, data.speed))
+        angle = max(-100, min(100, data.angle))
 
         if droid is None:
             raise Exception("Droid is not initialized")
+        if limiter is not None:
+            # stopping both motors is never rate limited
+            rejected = limiter.reject(request, "drive", priority=is_stop(speed, angle))
+            if rejected is not None:
+                return rejected
 
         left_speed, right_speed = calculate_motor_speeds(speed, angle)
         direction_map = {
@@ -58,61 +143,75 @@ async def drive():
 
         left_speed, right_speed = normalize_values_to_motor(left_speed, right_speed)
 
-        await droid.motor_controller.set_motor_speed(direction_left, DroidMotorIdentifier.LeftMotor, left_speed, 300)
-        await droid.motor_controller.set_motor_speed(direction_right, DroidMotorIdentifier.RightMotor, right_speed, 300)
-
-        response_time = time.time() - start_time
-        print(f"/drive endpoint processed in {response_time:.4f} seconds")
-        return jsonify({"status": "success"})
+        if writer is not None:
+            seq = writer.submit((direction_left, left_speed, direction_right, right_speed))
+            return {"status": "success", "seq": seq}
+        await write_motor_speeds((direction_left, left_speed, direction_right, right_speed))
+        return {"status": "success"}
     except Exception as e:
         print(f"Error in /drive endpoint: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+@app.get('/metrics')
+async def get_metrics():
+    # per route request/error counts and latency histograms, drive writes, connection state
+    return metrics.as_dict()
+
+@app.get('/stats')
+async def stats():
+    # with --register: queue depth, superseded (coalesced) setpoints and write latency of the droid writer
+    return {"status": "success", "register": register_mode, "writer": writer.stats() if writer is not None else None}
 
-@app.route('/sounds', methods=['POST'])
-async def play_sound():
-    start_time = time.time()
+@app.post('/sounds')
+async def play_sound(data: SoundRequest, request: Request):
     try:
-        data = request.json
-        soundID = data.get('soundID', 0)
         if droid is None:
             raise Exception("Droid is not initialized")
-        await droid.audio_controller.play_audio(soundID, 1, True, 100)
-        response_time = time.time() - start_time
-        print(f"/sounds endpoint processed in {response_time:.4f} seconds")
-        return jsonify({"status": "success"})
+        if limiter is not None:
+            rejected = limiter.reject(request, "sounds")
+            if rejected is not None:
+                return rejected
+        await droid.audio_controller.play_audio(data.soundID, 1, True, 100)
+        return {"status": "success"}
     except Exception as e:
         print(f"Error in /sounds endpoint: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-async def main():
-    global droid
-    droid = await discover_droid(retry=True)
-
-    try:
-        async with droid as d:
-            d: DroidConnection = d
-
-            if not d.droid.is_connected:
-                print("Droid not connected!")
-                return
-
-            app.run(host='0.0.0.0', port=5000)  # Ensure the server is listening on all interfaces
-            
-    except OSError as err:
-        print(f"Discovery failed due to operating system: {err}")
-    except BleakError as err:
-        print(f"Discovery failed due to Bleak: {err}")
-    except KeyboardInterrupt as err:
-        pass
-    finally:
-        print("Shutting down.")
-
-def signal_handler(sig, frame):
-    print("Interrupt received, stopping...")
-    if droid is not None:
-        asyncio.run(droid.disconnect())
-    sys.exit(0)
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="HTTP control server for a DroidDepot droid")
+    parser.add_argument("--simulate", action="store_true",
+                        help="use the in-process BLE simulator (ble_sim.py) instead of a real droid")
+    parser.add_argument("--register", action="store_true",
+                        help="/drive only stores the newest setpoint and answers at once with its sequence number; "
+                             "a background writer sends it to the droid")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="answer 429 when a client or route exceeds its share of the droid's BLE write budget; "
+                             "stop setpoints (speed and angle 0) always pass")
+    parser.add_argument("--rate-budget", type=float, default=None, metavar="WRITES_PER_S",
+                        help="fixed BLE write budget instead of the one measured from motor write latency")
+    parser.add_argument("--rate-burst", type=float, default=0.25, metavar="SECONDS",
+                        help="seconds of budget a token bucket holds")
+    parser.add_argument("--client-share", type=float, default=0.5,
+                        help="fraction of a route's budget a single client may use")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write spans of traced requests (traceparent header) and their BLE writes "
+                             "to a Chrome trace file, see tracing.py")
+    parser.add_argument("--verbose", action="store_true", help="print the processing time of every request")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGINT, signal_handler)
-    asyncio.run(main())
\ No newline at end of file
+    import uvicorn
+    args = parse_args()
+    register_mode = args.register
+    metrics.verbose = args.verbose
+    if args.trace:
+        tracer = Tracer(args.trace, "bb8_server")
+        tracer.install(app)
+    if args.rate_limit:
+        budget = WriteBudget(drive_writes, writes_per_sample=2, fixed=args.rate_budget)
+        limiter = RateLimiter(budget, ROUTE_LIMITS, args.rate_burst, args.client_share)
+    if args.simulate:
+        import ble_sim
+        ble_sim.install()
+    # Ctrl+C is handled by uvicorn, which runs the lifespan shutdown (disconnect)
+    uvicorn.run(app, host='0.0.0.0', port=5000, access_log=args.verbose)  # Ensure the server is listening on all interfaces
\ No newline at end of file
@@ -0,0 +1,242 @@
+# bench_droid_commands.py
+# Parity check and microbenchmarks for the byte-native droiddepot command
+# API (send_droid_command_bytes and friends). The controllers used to format
+# every command as a hex string and parse it back with bytes.fromhex; this
+# replays the old string encoders next to the ported controllers and checks
+# that every command writes the same bytes, then times both paths (timeit,
+# alternating legacy and ported runs) and measures what they allocate
+# (tracemalloc). tests/test_droid_commands.py runs the parity check under
+# pytest.
+#
+#   python bench_droid_commands.py --number 100000
+
+import argparse
+import asyncio
+import json
+import sys
+import timeit
+import tracemalloc
+from droiddepot.connection import DroidConnection
+from droiddepot.motor import DroidMotorDirection, DroidMotorIdentifier
+from droiddepot.protocol import DroidCommandId, DroidMultipurposeCommand
+from droiddepot.audio import DroidAudioCommand
+from droiddepot.utils import int_to_hex, int_to_bytes, int_to_decimal_byte
+
+
+class RecordingClient:
+    """stands in for the BleakClient of a DroidConnection and keeps every write"""
+
+    def __init__(self):
+        self.writes = []
+        self.is_connected = True
+
+    async def write_gatt_char(self, char, data, response=None):
+        self.writes.append(bytes(data))
+
+
+# the string encoders the controllers used before the byte API
+
+def legacy_motor_speed(direction, motor_id, speed=160, ramp_speed=300, delay=0):
+    delay_hex = int_to_hex(delay)
+    if len(delay_hex) < 4:
+        delay_hex = "0" * (4 - len(delay_hex)) + delay_hex
+    motor_select = "%s%d" % (direction, motor_id)
+    return DroidCommandId.SetMotorSpeed, "%s%s%s%s" % (motor_select, int_to_hex(speed), int_to_hex(ramp_speed), delay_hex)
+
+
+def legacy_multi(command_id, data=""):
+    return DroidCommandId.MultipurposeCommand, "44%s%s" % ("{:02d}".format(command_id), data)
+
+
+def legacy_head_speed(direction, speed=160, ramp_speed=300):
+    dir_hex = "00" if direction == DroidMotorDirection.Forward else "FF"
+    command_data = "%s%s%s0000" % (dir_hex, int_to_hex(speed), int_to_hex(ramp_speed))
+    return [legacy_multi(DroidMultipurposeCommand.RotateBUnitHead, command_data),
+            legacy_multi(DroidMultipurposeCommand.RotateRUnitHead, command_data)]
+
+
+def legacy_center_head(speed=255, offset=0):
+    return legacy_multi(DroidMultipurposeCommand.CenterRUnitHead, "%s%s" % (int_to_hex(speed), int_to_hex(offset)))
+
+
+def legacy_audio(command_id, data="00"):
+    return legacy_multi(DroidMultipurposeCommand.AudioControllerCommand, "%s%s" % (int_to_hex(command_id), data))
+
+
+def legacy_script(script_id, script_action):
+    return DroidCommandId.ScriptActionComand, "%s%s" % ("{:02d}".format(script_id), "{:02d}".format(script_action))
+
+
+def parity_cases(connection):
+    """(name, coroutine factory, expected (command id, hex data) list) for every ported command"""
+    motor = connection.motor_controller
+    audio = connection.audio_controller
+    script = connection.script_engine
+    cases = []
+
+    for direction in (DroidMotorDirection.Forward, DroidMotorDirection.Backwards):
+        for motor_id in DroidMotorIdentifier:
+            for speed in (0, 1, 15, 16, 160, 255, 256, 300, 4095, 65535):
+                for ramp_speed in (0, 255, 300):
+                    for delay in (0, 1, 255, 256, 4096, 65535, 65536):
+                        cases.append((f"set_motor_speed({direction}, {motor_id}, {speed}, {ramp_speed}, {delay})",
+                                      lambda a=(direction, motor_id, speed, ramp_speed, delay): motor.set_motor_speed(*a),
+                                      [legacy_motor_speed(direction, motor_id, speed, ramp_speed, delay)]))
+
+    for direction in (DroidMotorDirection.Forward, DroidMotorDirection.Backwards):
+        for speed, ramp_speed in ((0, 0), (160, 300), (255, 65535)):
+            cases.append((f"set_head_speed({direction}, {speed}, {ramp_speed})",
+                          lambda a=(direction, speed, ramp_speed): motor.set_head_speed(*a),
+                          legacy_head_speed(direction, speed, ramp_speed)))
+    for speed, offset in ((255, 0), (0, 0), (16, 300)):
+        cases.append((f"center_head({speed}, {offset})", lambda a=(speed, offset): motor.center_head(*a),
+                      [legacy_center_head(speed, offset)]))
+
+    for script_id in range(1, 100):
+        if script_id == 13:
+            continue
+        for action in (0, 1, 2):
+            cases.append((f"send_script_command({script_id}, {action})",
+                          lambda a=(script_id, action): script.send_script_command(*a), [legacy_script(script_id, action)]))
+
+    for volume in (0, 1, 50, 100, 255, 256):
+        cases.append((f"set_volume({volume})", lambda v=volume: audio.set_volume(v),
+                      [legacy_audio(DroidAudioCommand.SetVolume, int_to_hex(volume))]))
+    for bank in (0, 1, 7, 16):
+        cases.append((f"set_audio_bank({bank})", lambda b=bank: audio.set_audio_bank(b),
+                      [legacy_audio(DroidAudioCommand.SetSelectedSoundBank, int_to_hex(bank))]))
+    for sound in (1, 2, 16, 256):
+        # the sound id string is never empty, so every call plays from the selected group
+        cases.append((f"play_audio({sound})", lambda s=sound: audio.play_audio(sound_id=s),
+                      [legacy_audio(DroidAudioCommand.PlayAudioFromSelectedGroup, int_to_hex(sound - 1))]))
+    for led in (1, 10, 31, 255):
+        cases.append((f"enable_head_led({led})", lambda l=led: audio.enable_head_led(l),
+                      [legacy_audio(DroidAudioCommand.EnableHeadLeds, int_to_hex(led))]))
+        cases.append((f"turn_on_led({led})", lambda l=led: audio.turn_on_led(l),
+                      [legacy_audio(DroidAudioCommand.SetLedOn, int_to_hex(led))]))
+        cases.append((f"turn_off_led({led})", lambda l=led: audio.turn_off_led(l),
+                      [legacy_audio(DroidAudioCommand.SetLedOff, int_to_hex(led))]))
+    for led in (10, 31, 99):
+        cases.append((f"disable_head_led({led})", lambda l=led: audio.disable_head_led(l),
+                      [legacy_audio(DroidAudioCommand.DisableHeadLeds, "%s" % led)]))
+
+    for state in (False, True):
+        cases.append((f"set_pairing_led({state})", lambda s=state: connection.set_pairing_led(s),
+                      [(DroidCommandId.SetPairingLedState, "00" + ("ff" if state else "00"))]))
+        cases.append((f"set_rgb_led({state})", lambda s=state: connection.set_rgb_led(s),
+                      [(DroidCommandId.SetRGBLedState, "00" + ("ff" if state else "00"))]))
+    cases.append(("heartbeat", lambda: connection.send_droid_command_bytes(DroidCommandId.ConnectionHeartbeat),
+                  [(DroidCommandId.ConnectionHeartbeat, "")]))
+    cases.append(("long command", lambda: connection.send_droid_command_bytes(0x10, bytes(range(40))),
+                  [(0x10, bytes(range(40)).hex())]))
+    return cases
+
+
+async def check_parity(connection):
+    """every ported command writes the bytes its old string encoder wrote"""
+    client = connection.droid
+    cases = parity_cases(connection)
+    failures = []
+    for name, send, expected in cases:
+        client.writes.clear()
+        await send()
+        wanted = [bytes(connection.build_droid_command(command_id, data)) for command_id, data in expected]
+        if client.writes != wanted:
+            failures.append(f"{name}: {[w.hex() for w in client.writes]} != {[w.hex() for w in wanted]}")
+    return len(cases), failures
+
+
+def allocated_per_call(func, number=10000):
+    """bytes still allocated after `number` calls whose results are kept, per call"""
+    func()
+    results = [None] * number
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(number):
+        results[i] = func()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / number
+
+
+def bench_pair(legacy, ported, number, repeat=7):
+    """
+    time a (name, func) legacy path and its ported byte path, alternating the runs
+    so drift (frequency scaling, other load) hits both alike; the best run of each counts
+    """
+    times = ([], [])
+    for _ in range(repeat):
+        for side, (_, func) in enumerate((legacy, ported)):
+            times[side].append(timeit.timeit(func, number=number))
+    return [{
+        "name": name,
+        "ns_per_call": min(side_times) / number * 1e9,
+        "ns_spread": (max(side_times) - min(side_times)) / number * 1e9,
+        "bytes_per_call": allocated_per_call(func),
+    } for (name, func), side_times in zip((legacy, ported), times)]
+
+
+def run_send(connection, send):
+    """drive one send coroutine to completion without an event loop, the recording client never suspends"""
+    def call():
+        coroutine = send()
+        try:
+            coroutine.send(None)
+        except StopIteration:
+            pass
+        connection.droid.writes.clear()
+    return call
+
+
+def main(args):
+    connection = DroidConnection("00:00:00:00:00:00", {})
+    connection.droid = RecordingClient()
+
+    count, failures = asyncio.run(check_parity(connection))
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    print(f"parity: {count - len(failures)} of {count} commands ok", file=sys.stderr)
+
+    motor = connection.motor_controller
+    build = connection.build_droid_command
+    pairs = [
+        (("motor legacy string + fromhex", lambda: build(*legacy_motor_speed(8, 1, 160, 300, 0))),
+         ("motor build_droid_command_bytes",
+          lambda: connection.build_droid_command_bytes(DroidCommandId.SetMotorSpeed, b"\x81", int_to_bytes(160),
+                                                       int_to_bytes(300), int_to_bytes(0, 2)))),
+        (("head legacy string + fromhex", lambda: build(*legacy_center_head(255, 0))),
+         ("head build_droid_command_bytes",
+          lambda: connection.build_droid_command_bytes(DroidCommandId.MultipurposeCommand, b"\x44",
+                                                       int_to_decimal_byte(DroidMultipurposeCommand.CenterRUnitHead),
+                                                       int_to_bytes(255), int_to_bytes(0)))),
+        (("script legacy string + fromhex", lambda: build(*legacy_script(12, 1))),
+         ("script build_droid_command_bytes",
+          lambda: connection.build_droid_command_bytes(DroidCommandId.ScriptActionComand, int_to_decimal_byte(12),
+                                                       int_to_decimal_byte(1)))),
+        (("send set_motor_speed (legacy)",
+          run_send(connection, lambda: connection.send_droid_command(*legacy_motor_speed(8, 1, 160, 300, 0)))),
+         ("send set_motor_speed (bytes)", run_send(connection, lambda: motor.set_motor_speed(8, 1, 160, 300, 0)))),
+        (("send center_head (legacy)",
+          run_send(connection, lambda: connection.send_droid_command(*legacy_center_head(255, 0)))),
+         ("send center_head (bytes)", run_send(connection, lambda: motor.center_head(255, 0)))),
+    ]
+    results = []
+    for legacy, ported in pairs:
+        results.extend(bench_pair(legacy, ported, args.number, args.repeat))
+    for result in results:
+        print(f"{result['name']:<34} {result['ns_per_call']:8.1f} ns (spread {result['ns_spread']:7.1f})  "
+              f"{result['bytes_per_call']:6.1f} B/call", file=sys.stderr)
+
+    print(json.dumps({"benchmark": "droid_commands", "parity_failures": failures, "results": results}, indent=2))
+    return 1 if failures else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check and microbenchmark the byte-native droid command encoders")
+    parser.add_argument("--number", type=int, default=100000, help="calls per timing run")
+    parser.add_argument("--repeat", type=int, default=7, help="timing runs per path, the best one counts")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
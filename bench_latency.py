@@ -0,0 +1,323 @@
+# bench_latency.py
+# End-to-end latency benchmark: joystick sample -> axis mapping -> (HTTP) ->
+# hub/droid command -> BLE transport write.
+#
+# A synthetic joystick sweeps its axes and is sampled by a ControlLoop at each
+# requested input rate. Every sample goes through the same mapping functions
+# as the real controllers and is then sent to one of these targets:
+#
+#   hub    TechnicMoveHub.drive() in-process on the simulated BLE transport
+#   droid  DroidMotorController.set_motor_speed() in-process, as bb8_server's /drive does
+#   http   POST /drive to a running robot_control.py or bb8_server.py (--url),
+#          or one started with --spawn on the simulated transport
+#
+# Latency is measured from the moment a sample is taken until the transport
+# write carrying it has completed (in-process targets) or until the HTTP
+# response arrives (http target, /drive answers after the write). Results are
+# printed as JSON so they can be stored and compared between releases:
+#
+#   python bench_latency.py --target hub --rates 50,100,200 --output bench.json
+
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+from control_loop import ControlLoop
+from latency_stats import summarize
+from LEGO_Technic_42176_XBOX_RC import TechnicMoveHub, get_steering_wheel, get_left_joystick, get_right_joystick
+from droiddepot.motor import DroidMotorDirection, DroidMotorIdentifier
+import ble_sim
+
+
+class SyntheticJoystick:
+    """
+    stands in for a pygame joystick: every axis follows a slow sine sweep,
+    buttons are released
+    """
+
+    def __init__(self, frequency=0.5, axes=6):
+        self.frequency = frequency
+        self.axes = axes
+        self.start = time.monotonic()
+
+    def get_axis(self, i):
+        t = time.monotonic() - self.start
+        return math.sin(2 * math.pi * self.frequency * t + i * math.pi / 3)
+
+    def get_button(self, i):
+        return 0
+
+    def get_name(self):
+        return "synthetic joystick"
+
+    def rumble(self, *args):
+        return False
+
+
+def map_input(joystick, mapping):
+    if mapping == "wheel":
+        return get_steering_wheel(joystick)
+    return get_left_joystick(joystick)[0], get_right_joystick(joystick)[1]
+
+
+class HubTarget:
+    name = "hub"
+
+    def __init__(self, coalesce=False, response=False):
+        self.coalesce = coalesce
+        self.response = response
+        self.hub = None
+        self.latencies = []
+        self._samples = {} # writer sequence number -> sample time
+
+    async def setup(self):
+        self.hub = TechnicMoveHub("Technic Move")
+        if not await self.hub.scan_and_connect():
+            raise RuntimeError("simulated hub not found")
+        if self.coalesce:
+            self.hub.start_writer(response=self.response)
+            self.hub.client.write_observers.append(self._on_write)
+
+    def _on_write(self, char, data, completed_at):
+        seq = self.hub.writer.in_flight_seq
+        sampled_at = self._samples.pop(seq, None)
+        if sampled_at is not None:
+            self.latencies.append(completed_at - sampled_at)
+        # samples superseded before they were written are never measured
+        for older in [older for older in self._samples if older < seq]:
+            del self._samples[older]
+
+    async def send(self, steering, throttle, sampled_at):
+        if self.coalesce:
+            self._samples[self.hub.submit_drive(throttle, steering, 0)] = sampled_at
+            return
+        await self.hub.drive(throttle, steering, 0)
+        self.latencies.append(time.monotonic() - sampled_at)
+
+    def stats(self):
+        return self.hub.writer_stats() if self.coalesce else {}
+
+    def writes(self):
+        return self.hub.client.writes
+
+    async def teardown(self):
+        await self.hub.disconnect()
+
+
+class DroidTarget:
+    name = "droid"
+
+    def __init__(self):
+        self.droid = None
+        self.server = None
+        self.latencies = []
+
+    async def setup(self):
+        from droiddepot.connection import discover_droid
+        import bb8_server
+
+        self.server = bb8_server
+        self.droid = await discover_droid(retry=True)
+        await self.droid.connect(silent=True)
+
+    async def send(self, steering, throttle, sampled_at):
+        # same mapping as bb8_server's /drive
+        left_speed, right_speed = self.server.calculate_motor_speeds(throttle, steering)
+        direction_left = DroidMotorDirection.Backwards if left_speed < 0 else DroidMotorDirection.Forward
+        direction_right = DroidMotorDirection.Backwards if right_speed < 0 else DroidMotorDirection.Forward
+        left_speed, right_speed = self.server.normalize_values_to_motor(left_speed, right_speed)
+
+        motors = self.droid.motor_controller
+        await motors.set_motor_speed(direction_left, DroidMotorIdentifier.LeftMotor, left_speed, 300)
+        await motors.set_motor_speed(direction_right, DroidMotorIdentifier.RightMotor, right_speed, 300)
+        self.latencies.append(time.monotonic() - sampled_at)
+
+    def stats(self):
+        return {}
+
+    def writes(self):
+        return self.droid.droid.writes
+
+    async def teardown(self):
+        await self.droid.disconnect(silent=True)
+
+
+class HttpTarget:
+    name = "http"
+
+    def __init__(self, url, server):
+        self.url = url.rstrip("/") + "/drive"
+        self.server = server
+        self.session = None
+        self.latencies = []
+        self.errors = 0
+        self.requests = 0
+
+    async def setup(self):
+        import aiohttp
+
+        self.session = aiohttp.ClientSession()
+
+    async def send(self, steering, throttle, sampled_at):
+        payload = {"speed": throttle, "angle": steering}
+        if self.server == "robot_control":
+            payload["lights"] = 0
+        self.requests += 1
+        try:
+            async with self.session.post(self.url, json=payload) as response:
+                await response.read()
+                if response.status != 200:
+                    self.errors += 1
+                    return
+        except Exception:
+            self.errors += 1
+            return
+        self.latencies.append(time.monotonic() - sampled_at)
+
+    def stats(self):
+        return {"requests": self.requests, "errors": self.errors}
+
+    def writes(self):
+        return self.requests - self.errors
+
+    async def teardown(self):
+        await self.session.close()
+
+
+async def run_rate(target, joystick, mapping, rate_hz, duration):
+    target.latencies = []
+    writes_before = target.writes()
+    loop = ControlLoop(rate_hz)
+    samples = 0
+
+    async def tick():
+        nonlocal samples
+        sampled_at = time.monotonic()
+        steering, throttle = map_input(joystick, mapping)
+        samples += 1
+        await target.send(steering, throttle, sampled_at)
+
+    start = time.monotonic()
+    await loop.run(tick, duration=duration)
+    await asyncio.sleep(0.1) # let the last writes land
+    elapsed = time.monotonic() - start
+
+    return {
+        "rate_hz": rate_hz,
+        "duration_s": elapsed,
+        "samples": samples,
+        "input_rate_hz": samples / elapsed,
+        "commands_per_s": (target.writes() - writes_before) / elapsed,
+        "latency_ms": summarize(target.latencies, 1000),
+        "loop": loop.stats(),
+        "target": target.stats(),
+    }
+
+
+def wait_for_port(url, timeout=30.0):
+    import socket
+    from urllib.parse import urlparse
+
+    parsed = urlparse(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((parsed.hostname, parsed.port or 80), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+async def main(args):
+    world = ble_sim.install(ble_sim.SimulatedWorld(
+        ble_sim.default_world().peripherals,
+        ble_sim.LinkProfile(connection_interval=args.interval / 1000, loss=args.loss, seed=args.seed)))
+
+    if args.target == "hub":
+        target = HubTarget(coalesce=args.coalesce, response=args.response)
+    elif args.target == "droid":
+        target = DroidTarget()
+    else:
+        target = HttpTarget(args.url, args.server)
+
+    joystick = SyntheticJoystick()
+    await target.setup()
+    results = []
+    try:
+        for rate_hz in args.rates:
+            result = await run_rate(target, joystick, args.mapping, rate_hz, args.duration)
+            latency = result["latency_ms"]
+            print(f"{rate_hz:>6.0f} Hz  p50 {latency.get('p50', 0):7.2f} ms  p95 {latency.get('p95', 0):7.2f} ms  "
+                  f"p99 {latency.get('p99', 0):7.2f} ms  {result['commands_per_s']:7.1f} cmd/s", file=sys.stderr)
+            results.append(result)
+    finally:
+        await target.teardown()
+
+    report = {
+        "benchmark": "input_to_write_latency",
+        "target": args.target,
+        "server": args.server if args.target == "http" else None,
+        "mapping": args.mapping,
+        "coalesce": args.coalesce,
+        "register": args.register,
+        "link": {"connection_interval_ms": args.interval, "loss": args.loss},
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    return text
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure input-to-BLE-write latency of the control path")
+    parser.add_argument("--target", choices=("hub", "droid", "http"), default="hub")
+    parser.add_argument("--server", choices=("robot_control", "bb8_server"), default="robot_control",
+                        help="which server the http target talks to")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="server base URL for the http target")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start the server on the simulated transport for the http target")
+    parser.add_argument("--register", action="store_true",
+                        help="with --spawn, start the server with --register (/drive answers before the write)")
+    parser.add_argument("--mapping", choices=("wheel", "stick"), default="wheel",
+                        help="G923 wheel mapping or XBOX stick mapping")
+    parser.add_argument("--rates", type=lambda s: [float(r) for r in s.split(",")], default=[50, 100, 200],
+                        help="comma separated input rates in Hz")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per rate")
+    parser.add_argument("--coalesce", action="store_true", help="hub target: use the latest-value writer")
+    parser.add_argument("--response", action="store_true", help="hub target: write with response")
+    parser.add_argument("--interval", type=float, default=15.0, help="simulated connection interval in ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="simulated packet loss probability")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = None
+    if args.target == "http" and args.spawn:
+        server = subprocess.Popen([sys.executable, f"{args.server}.py", "--simulate"]
+                                  + (["--register"] if args.register else []))
+        if not wait_for_port(args.url):
+            server.terminate()
+            sys.exit(f"{args.server}.py did not start")
+    try:
+        # keep stdout for the JSON report, the controllers' own messages go to stderr
+        stdout = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            report = asyncio.run(main(args))
+        print(report, file=stdout)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
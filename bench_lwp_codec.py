@@ -0,0 +1,131 @@
+# bench_lwp_codec.py
+# Microbenchmarks for lwp_codec: time per encode (timeit) and memory
+# allocated per encode (tracemalloc), compared with the bytearray literals
+# TechnicMoveHub used to build on every call. Also checks that every encoder
+# round-trips through decode_downstream().
+#
+#   python bench_lwp_codec.py --number 200000
+
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+import lwp_codec as lwp
+
+
+def legacy_drive(speed, angle, lights):
+    return bytearray([0x0d,0x00,0x81,0x36,0x11,0x51,0x00,0x03,0x00, speed&0xFF, angle&0xFF, lights&0xFF,0x00])
+
+
+def legacy_calibrate():
+    return bytes.fromhex("0d008136115100030000001000"), bytes.fromhex("0d008136115100030000000800")
+
+
+def check_round_trip():
+    """every encoder's frame decodes back to its arguments"""
+    encoder = lwp.DriveEncoder()
+    cases = [
+        (encoder.encode(-40, 25, lwp.LIGHTS_OFF_ON), lwp.DriveCommand(lwp.SC_IMMEDIATE_FEEDBACK, -40, 25, lwp.LIGHTS_OFF_ON)),
+        (lwp.encode_drive(100, -100, lwp.LIGHTS_ON_ON), lwp.DriveCommand(lwp.SC_IMMEDIATE_FEEDBACK, 100, -100, 0)),
+        (lwp.encode_hub_property(0x06, lwp.HUB_PROP_OP_ENABLE_UPDATES), lwp.HubPropertyRequest(0x06, 0x02, b"")),
+        (lwp.encode_hub_action(lwp.HUB_ACTION_SWITCH_OFF), lwp.HubAction(0x01)),
+        (lwp.encode_hub_alert(lwp.ALERT_LOW_VOLTAGE, lwp.ALERT_OP_REQUEST_UPDATE), lwp.HubAlertRequest(0x01, 0x03)),
+        (lwp.encode_port_information_request(lwp.PORT_A), lwp.PortInformationRequest(lwp.PORT_A, 0x01)),
+        (lwp.encode_port_mode_information_request(lwp.PORT_A, 2, 0x80),
+         lwp.PortModeInformationRequest(lwp.PORT_A, 2, 0x80)),
+        (lwp.encode_port_input_format(lwp.PORT_B, 2, 5, True), lwp.PortInputFormatSetup(lwp.PORT_B, 2, 5, True)),
+        (lwp.encode_virtual_port_connect(lwp.PORT_A, lwp.PORT_B), lwp.VirtualPortSetup(True, (lwp.PORT_A, lwp.PORT_B))),
+        (lwp.encode_virtual_port_disconnect(0x10), lwp.VirtualPortSetup(False, (0x10,))),
+        (lwp.encode_motor_power(lwp.PORT_C, -50),
+         lwp.WriteDirectMode(lwp.PORT_C, lwp.SC_BUFFER_NO_FEEDBACK, lwp.MOTOR_MODE_POWER, bytes([0xCE]))),
+        (lwp.encode_led_color(9), lwp.WriteDirectMode(lwp.PORT_LED, lwp.SC_IMMEDIATE_FEEDBACK, lwp.LED_MODE_COLOR, b"\x09")),
+        (lwp.encode_led_rgb(1, 2, 3), lwp.WriteDirectMode(lwp.PORT_LED, lwp.SC_IMMEDIATE_FEEDBACK, lwp.LED_MODE_RGB,
+                                                          b"\x01\x02\x03")),
+        (lwp.encode_start_power(lwp.PORT_A, -30),
+         lwp.PortOutputCommand(lwp.PORT_A, lwp.SC_IMMEDIATE_FEEDBACK, lwp.OUT_START_POWER, (-30,))),
+        (lwp.encode_start_speed(lwp.PORT_A, 50, 80),
+         lwp.PortOutputCommand(lwp.PORT_A, lwp.SC_IMMEDIATE_FEEDBACK, lwp.OUT_START_SPEED, (50, 80, 0))),
+        (lwp.encode_start_speed_for_time(lwp.PORT_A, 1500, 60),
+         lwp.PortOutputCommand(lwp.PORT_A, lwp.SC_IMMEDIATE_FEEDBACK, lwp.OUT_START_SPEED_FOR_TIME,
+                               (1500, 60, 100, lwp.END_STATE_BRAKE, 0))),
+        (lwp.encode_start_speed_for_degrees(lwp.PORT_B, 720, -60),
+         lwp.PortOutputCommand(lwp.PORT_B, lwp.SC_IMMEDIATE_FEEDBACK, lwp.OUT_START_SPEED_FOR_DEGREES,
+                               (720, -60, 100, lwp.END_STATE_BRAKE, 0))),
+        (lwp.encode_goto_absolute_position(lwp.PORT_B, -90, 40, end_state=lwp.END_STATE_HOLD),
+         lwp.PortOutputCommand(lwp.PORT_B, lwp.SC_IMMEDIATE_FEEDBACK, lwp.OUT_GOTO_ABSOLUTE_POSITION,
+                               (-90, 40, 100, lwp.END_STATE_HOLD, 0))),
+        (lwp.encode_set_acc_time(lwp.PORT_A, 300),
+         lwp.PortOutputCommand(lwp.PORT_A, lwp.SC_IMMEDIATE_FEEDBACK, lwp.OUT_SET_ACC_TIME, (300, 0))),
+        (lwp.encode_set_dec_time(lwp.PORT_A, 200, 1),
+         lwp.PortOutputCommand(lwp.PORT_A, lwp.SC_IMMEDIATE_FEEDBACK, lwp.OUT_SET_DEC_TIME, (200, 1))),
+    ]
+    failures = []
+    for frame, expected in cases:
+        decoded = lwp.decode_downstream(frame)
+        if decoded != expected:
+            failures.append(f"{bytes(frame).hex()}: {decoded} != {expected}")
+
+    for speed in range(-100, 101, 7):
+        if bytes(encoder.encode(speed, -speed, lwp.LIGHTS_OFF_OFF)) != bytes(legacy_drive(speed, -speed, lwp.LIGHTS_OFF_OFF)):
+            failures.append(f"drive frame differs from the legacy literal at speed {speed}")
+    if tuple(lwp.CALIBRATE_STEERING) != legacy_calibrate():
+        failures.append("calibration frames differ from the legacy hex strings")
+    return len(cases), failures
+
+
+def allocated_per_call(func, number=10000):
+    """bytes still allocated after `number` calls whose results are kept, per call"""
+    func()
+    results = [None] * number
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(number):
+        results[i] = func()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / number
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    return {
+        "name": name,
+        "ns_per_call": seconds / number * 1e9,
+        "bytes_per_call": allocated_per_call(func),
+    }
+
+
+def main(args):
+    count, failures = check_round_trip()
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    print(f"round trip: {count - len(failures)} of {count} frames ok", file=sys.stderr)
+
+    encoder = lwp.DriveEncoder()
+    results = [
+        bench("drive legacy bytearray literal", lambda: legacy_drive(40, -25, 0), args.number),
+        bench("drive encode_drive()", lambda: lwp.encode_drive(40, -25, 0), args.number),
+        bench("drive DriveEncoder.encode()", lambda: encoder.encode(40, -25, 0), args.number),
+        bench("calibrate legacy bytes.fromhex", legacy_calibrate, args.number),
+        bench("calibrate CALIBRATE_STEERING", lambda: lwp.CALIBRATE_STEERING, args.number),
+        bench("led encode_led_color()", lambda: lwp.encode_led_color(9), args.number),
+        bench("motor encode_motor_power()", lambda: lwp.encode_motor_power(lwp.PORT_A, 50), args.number),
+        bench("decode drive frame", lambda: lwp.decode_downstream(encoder.frame), args.number),
+    ]
+    for result in results:
+        print(f"{result['name']:<34} {result['ns_per_call']:8.1f} ns  {result['bytes_per_call']:6.1f} B/call",
+              file=sys.stderr)
+
+    print(json.dumps({"benchmark": "lwp_codec", "round_trip_failures": failures, "results": results}, indent=2))
+    return 1 if failures else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Microbenchmark the LEGO Wireless Protocol frame codec")
+    parser.add_argument("--number", type=int, default=100000, help="calls per timing run")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
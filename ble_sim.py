@@ -0,0 +1,495 @@
+# ble_sim.py
+# In-process stand-in for bleak's BleakClient and BleakScanner.
+#
+# A SimulatedWorld holds simulated peripherals (a Technic Move Hub and a
+# DroidDepot droid by default). SimulatedBleakClient writes go through a link
+# model with a configurable connection interval, per-write latency
+# distribution and packet loss, and peripherals answer with notifications the
+# way the real firmware does (port output feedback and hub properties for the
+# hub, firmware information and head motor events for droids).
+#
+# install() swaps the simulated classes in for bleak's everywhere they were
+# imported, so the controllers and servers run unchanged without hardware:
+#
+#   import ble_sim
+#   ble_sim.install()
+
+import asyncio
+import random
+import struct
+import sys
+import time
+from collections import deque
+from bleak.exc import BleakError
+
+TECHNIC_HUB_CHAR_UUID = "00001624-1212-efde-1623-785feabcd123"
+DROID_COMMAND_CHAR_UUID = "09b600b1-3e42-41fc-b474-e9c0c8f0c801"
+DROID_NOTIFY_CHAR_UUID = "09b600b0-3e42-41fc-b474-e9c0c8f0c801"
+DROID_MANUFACTURER_ID = 387
+DROID_FIRMWARE_VERSION = bytes.fromhex("4b1001444411110100000000")
+
+
+class LinkProfile:
+    """
+    timing model of one BLE connection
+
+    connection_interval: seconds between connection events, a write goes out on the next one
+    latency_mean, latency_jitter: extra per-write delay (normal distribution, clipped at 0)
+    loss: probability that a packet is lost; lost write-without-response packets never
+          arrive, write-with-response packets are retransmitted on the next connection event
+    connect_delay: time taken by connect()
+    advertising_interval: time between advertisements seen by a scanner
+    """
+
+    def __init__(self, connection_interval=0.015, latency_mean=0.002, latency_jitter=0.001, loss=0.0,
+                 connect_delay=0.3, advertising_interval=0.1, seed=None):
+        self.connection_interval = connection_interval
+        self.latency_mean = latency_mean
+        self.latency_jitter = latency_jitter
+        self.loss = loss
+        self.connect_delay = connect_delay
+        self.advertising_interval = advertising_interval
+        self.random = random.Random(seed)
+
+    def latency(self):
+        if self.latency_jitter <= 0:
+            return self.latency_mean
+        return max(0.0, self.random.gauss(self.latency_mean, self.latency_jitter))
+
+    def lost(self):
+        return self.loss > 0 and self.random.random() < self.loss
+
+
+class SimulatedBLEDevice:
+    """stands in for bleak.backends.device.BLEDevice"""
+
+    def __init__(self, address, name, rssi=-60):
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+        self.details = None
+
+    def __repr__(self):
+        return f"{self.address}: {self.name}"
+
+
+class SimulatedAdvertisementData:
+    """stands in for bleak.backends.scanner.AdvertisementData"""
+
+    def __init__(self, local_name=None, manufacturer_data=None, service_uuids=None, rssi=-60):
+        self.local_name = local_name
+        self.manufacturer_data = manufacturer_data or {}
+        self.service_data = {}
+        self.service_uuids = service_uuids or []
+        self.tx_power = None
+        self.rssi = rssi
+        self.platform_data = ()
+
+
+class SimulatedPeripheral:
+    """base class: a device that advertises, accepts writes and sends notifications"""
+
+    def __init__(self, address, name, manufacturer_data=None, service_uuids=None, rssi=-60):
+        self.address = address
+        self.name = name
+        self.device = SimulatedBLEDevice(address, name, rssi)
+        self.advertisement = SimulatedAdvertisementData(name, manufacturer_data, service_uuids, rssi)
+        self.clients = []
+        self.received = deque(maxlen=1000) # (monotonic time, char, bytes) of writes that arrived
+
+    def attach(self, client):
+        self.clients.append(client)
+        self.on_connect(client)
+
+    def detach(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+            self.on_disconnect(client)
+
+    def notify(self, char, data):
+        for client in self.clients:
+            client.deliver(char, data)
+
+    def receive(self, client, char, data):
+        self.received.append((time.monotonic(), char, bytes(data)))
+        self.on_write(client, char, data)
+
+    def on_connect(self, client):
+        pass
+
+    def on_disconnect(self, client):
+        pass
+
+    def on_write(self, client, char, data):
+        pass
+
+
+class SimulatedTechnicMoveHub(SimulatedPeripheral):
+    """
+    answers port output commands with port output feedback, hub property
+    requests with their values, and port input format setups with an ack
+    followed by periodic port values
+    """
+
+    def __init__(self, address="90:84:2B:00:00:01", name="Technic Move", battery=87, value_interval=0.1):
+        super().__init__(address, name, service_uuids=["00001623-1212-efde-1623-785feabcd123"])
+        self.battery = battery
+        self.value_interval = value_interval
+        self.properties = {
+            0x01: name.encode(),
+            0x03: struct.pack("<i", 0x10000010),
+            0x04: struct.pack("<i", 0x10000000),
+            0x05: struct.pack("<b", -60),
+            0x06: bytes([battery]),
+            0x0A: struct.pack("<H", 0x0300),
+        }
+        self.property_updates = set()
+        self.port_subscriptions = {} # port -> mode
+        self.drive_state = (0, 0, 0)
+        self._value_task = None
+
+    def on_connect(self, client):
+        if self._value_task is None:
+            self._value_task = asyncio.get_running_loop().create_task(self._send_values())
+
+    def on_disconnect(self, client):
+        if not self.clients and self._value_task is not None:
+            self._value_task.cancel()
+            self._value_task = None
+
+    def _hub_property(self, prop):
+        value = self.properties.get(prop, b"")
+        return bytes([5 + len(value), 0x00, 0x01, prop, 0x06]) + value
+
+    def on_write(self, client, char, data):
+        if len(data) < 3:
+            return
+        msg_type = data[2]
+        if msg_type == 0x81:
+            port, startup = data[3], data[4]
+            if port == 0x36 and len(data) >= 12:
+                self.drive_state = (struct.unpack("b", bytes([data[9]]))[0],
+                                    struct.unpack("b", bytes([data[10]]))[0], data[11])
+            if startup & 0x01:
+                # command feedback requested: buffer empty + command completed + idle
+                self.notify(char, bytes([0x05, 0x00, 0x82, port, 0x0A]))
+        elif msg_type == 0x01:
+            prop, op = data[3], data[4]
+            if op == 0x02:
+                self.property_updates.add(prop)
+                self.notify(char, self._hub_property(prop))
+            elif op == 0x03:
+                self.property_updates.discard(prop)
+            elif op == 0x05:
+                self.notify(char, self._hub_property(prop))
+        elif msg_type == 0x41:
+            port, mode = data[3], data[4]
+            notify_enabled = data[9] if len(data) > 9 else 0
+            if notify_enabled:
+                self.port_subscriptions[port] = mode
+            else:
+                self.port_subscriptions.pop(port, None)
+            self.notify(char, bytes([0x0A, 0x00, 0x47]) + bytes(data[3:10]))
+
+    async def _send_values(self):
+        rng = random.Random(0)
+        while True:
+            await asyncio.sleep(self.value_interval)
+            for port in list(self.port_subscriptions):
+                values = struct.pack("<hhh", rng.randint(-5, 5), rng.randint(-5, 5), 1000 + rng.randint(-5, 5))
+                self.notify(TECHNIC_HUB_CHAR_UUID, bytes([4 + len(values), 0x00, 0x45, port]) + values)
+            if 0x06 in self.property_updates:
+                self.notify(TECHNIC_HUB_CHAR_UUID, self._hub_property(0x06))
+
+
+class SimulatedDroid(SimulatedPeripheral):
+    """
+    a DroidDepot droid: answers the firmware information request and reports
+    head motor start/stop events for head motor commands
+    """
+
+    def __init__(self, address="F0:00:00:00:00:01", personality=1, affiliation=1, head_move_time=0.3):
+        manufacturer_data = {DROID_MANUFACTURER_ID: bytes([0x03, 0x04, 0x44, 0x81, 0x80 + affiliation * 2, personality])}
+        super().__init__(address, "DROID", manufacturer_data)
+        self.head_move_time = head_move_time
+        self.commands = deque(maxlen=1000) # (command id, data) of decoded commands
+
+    def _message(self, command_id, data):
+        return bytes([len(data) + 4 + 0x1f, 0x00, command_id, 0x40 + len(data)]) + data
+
+    def on_write(self, client, char, data):
+        if not isinstance(char, str) or char.lower() != DROID_COMMAND_CHAR_UUID or len(data) < 4:
+            return
+        command_id = data[2]
+        payload = bytes(data[4:])
+        self.commands.append((command_id, payload))
+
+        if command_id == 0x01:
+            self.notify(DROID_NOTIFY_CHAR_UUID, self._message(0x81, DROID_FIRMWARE_VERSION))
+        elif command_id == 0x05 and payload and payload[0] & 0x0F == 2:
+            asyncio.get_running_loop().create_task(self._move_head())
+
+    async def _move_head(self):
+        self.notify(DROID_NOTIFY_CHAR_UUID, self._message(0x80, bytes([0x00, 2])))   # MotorStarted
+        await asyncio.sleep(self.head_move_time)
+        self.notify(DROID_NOTIFY_CHAR_UUID, self._message(0x80, bytes([0x00, 130]))) # MotorStopped
+
+
+class SimulatedWorld:
+    def __init__(self, peripherals=None, profile=None):
+        self.peripherals = list(peripherals) if peripherals is not None else []
+        self.profile = profile or LinkProfile()
+
+    def add(self, peripheral):
+        self.peripherals.append(peripheral)
+        return peripheral
+
+    def find(self, address):
+        for peripheral in self.peripherals:
+            if peripheral.address.lower() == address.lower():
+                return peripheral
+        return None
+
+
+def default_world(profile=None, hubs=1, droids=1):
+    world = SimulatedWorld(profile=profile)
+    for i in range(hubs):
+        world.add(SimulatedTechnicMoveHub(address=f"90:84:2B:00:00:{i + 1:02X}"))
+    for i in range(droids):
+        world.add(SimulatedDroid(address=f"F0:00:00:00:00:{i + 1:02X}"))
+    return world
+
+
+WORLD = default_world()
+
+
+class SimulatedBleakScanner:
+    world = WORLD
+
+    def __init__(self, detection_callback=None, service_uuids=None, **kwargs):
+        self._callbacks = [detection_callback] if detection_callback is not None else []
+        self.discovered_devices_and_advertisement_data = {}
+        self._tasks = []
+
+    @property
+    def discovered_devices(self):
+        return [device for device, _ in self.discovered_devices_and_advertisement_data.values()]
+
+    def register_detection_callback(self, callback):
+        self._callbacks.append(callback)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._advertise(peripheral)) for peripheral in self.world.peripherals]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    async def _advertise(self, peripheral):
+        profile = self.world.profile
+        # the first advertisement lands somewhere within one advertising interval
+        await asyncio.sleep(profile.random.uniform(0, profile.advertising_interval))
+        while True:
+            self.discovered_devices_and_advertisement_data[peripheral.address] = (peripheral.device, peripheral.advertisement)
+            for callback in list(self._callbacks):
+                result = callback(peripheral.device, peripheral.advertisement)
+                if asyncio.iscoroutine(result):
+                    await result
+            await asyncio.sleep(profile.advertising_interval)
+
+    @classmethod
+    async def discover(cls, timeout=5.0, return_adv=False, **kwargs):
+        async with cls(**kwargs) as scanner:
+            await asyncio.sleep(timeout)
+        if return_adv:
+            return dict(scanner.discovered_devices_and_advertisement_data)
+        return scanner.discovered_devices
+
+    @classmethod
+    async def find_device_by_filter(cls, filterfunc, timeout=10.0, **kwargs):
+        found = asyncio.get_running_loop().create_future()
+
+        def on_detect(device, advertisement_data):
+            if not found.done() and filterfunc(device, advertisement_data):
+                found.set_result(device)
+
+        async with cls(detection_callback=on_detect, **kwargs):
+            try:
+                return await asyncio.wait_for(found, timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    @classmethod
+    async def find_device_by_address(cls, device_identifier, timeout=10.0, **kwargs):
+        return await cls.find_device_by_filter(
+            lambda device, advertisement_data: device.address.lower() == device_identifier.lower(), timeout, **kwargs)
+
+    @classmethod
+    async def find_device_by_name(cls, name, timeout=10.0, **kwargs):
+        return await cls.find_device_by_filter(
+            lambda device, advertisement_data: advertisement_data.local_name == name, timeout, **kwargs)
+
+
+class SimulatedBleakClient:
+    world = WORLD
+
+    def __init__(self, address_or_ble_device, disconnected_callback=None, *, timeout=10.0, **kwargs):
+        if isinstance(address_or_ble_device, str):
+            self.address = address_or_ble_device
+        else:
+            self.address = address_or_ble_device.address
+        self.disconnected_callback = disconnected_callback
+        self.timeout = timeout
+        self.peripheral = None
+        self.mtu_size = 23
+        self._notify_callbacks = {}
+        self._epoch = time.monotonic()
+
+        self.writes = 0
+        self.lost = 0
+        self.retransmits = 0
+        self.notifications = 0
+        self.bytes_written = 0
+        self.write_observers = [] # callables(char, data, completed_at) called after every write
+
+    @property
+    def is_connected(self):
+        return self.peripheral is not None
+
+    async def connect(self, **kwargs):
+        peripheral = self.world.find(self.address)
+        await asyncio.sleep(self.world.profile.connect_delay)
+        if peripheral is None:
+            raise BleakError(f"Device with address {self.address} was not found.")
+        self.peripheral = peripheral
+        self._epoch = time.monotonic()
+        peripheral.attach(self)
+        return True
+
+    async def disconnect(self):
+        if self.peripheral is None:
+            return True
+        peripheral, self.peripheral = self.peripheral, None
+        peripheral.detach(self)
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+        return True
+
+    async def pair(self, *args, **kwargs):
+        return self.is_connected
+
+    async def unpair(self):
+        return True
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.disconnect()
+
+    def _until_next_connection_event(self):
+        interval = self.world.profile.connection_interval
+        if interval <= 0:
+            return 0.0
+        return interval - ((time.monotonic() - self._epoch) % interval)
+
+    async def write_gatt_char(self, char_specifier, data, response=None):
+        if self.peripheral is None:
+            raise BleakError("Not connected")
+        profile = self.world.profile
+        data = bytes(data)
+
+        await asyncio.sleep(self._until_next_connection_event() + profile.latency())
+        if response:
+            # lost packets are retransmitted on the following connection events,
+            # the acknowledgement comes back one connection event later
+            while profile.lost():
+                self.retransmits += 1
+                await asyncio.sleep(profile.connection_interval)
+            await asyncio.sleep(profile.connection_interval)
+            delivered = True
+        else:
+            delivered = not profile.lost()
+            if not delivered:
+                self.lost += 1
+
+        self.writes += 1
+        self.bytes_written += len(data)
+        if delivered and self.peripheral is not None:
+            self.peripheral.receive(self, char_specifier, data)
+        completed_at = time.monotonic()
+        for observer in self.write_observers:
+            observer(char_specifier, data, completed_at)
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        return bytearray()
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self._notify_callbacks[str(char_specifier).lower()] = callback
+
+    async def stop_notify(self, char_specifier):
+        self._notify_callbacks.pop(str(char_specifier).lower(), None)
+
+    def deliver(self, char, data):
+        """called by the peripheral, hands a notification to the client after one link delay"""
+        callback = self._notify_callbacks.get(str(char).lower())
+        if callback is None:
+            return
+        loop = asyncio.get_running_loop()
+        delay = self._until_next_connection_event() + self.world.profile.latency()
+        loop.call_later(delay, self._dispatch, callback, char, bytearray(data))
+
+    def _dispatch(self, callback, char, data):
+        if self.peripheral is None:
+            return
+        self.notifications += 1
+        result = callback(char, data)
+        if asyncio.iscoroutine(result):
+            asyncio.get_running_loop().create_task(result)
+
+    def stats(self):
+        return {
+            "writes": self.writes,
+            "lost": self.lost,
+            "retransmits": self.retransmits,
+            "notifications": self.notifications,
+            "bytes_written": self.bytes_written,
+        }
+
+
+def install(world=None):
+    """
+    replace bleak's BleakClient and BleakScanner with the simulated ones in
+    bleak itself and in every module that already imported them
+    returns the SimulatedWorld in use
+    """
+    import bleak
+
+    if world is not None:
+        SimulatedBleakClient.world = world
+        SimulatedBleakScanner.world = world
+
+    replacements = []
+    for name, simulated in (("BleakClient", SimulatedBleakClient), ("BleakScanner", SimulatedBleakScanner)):
+        real = getattr(bleak, name)
+        if real is not simulated:
+            replacements.append((name, real, simulated))
+        setattr(bleak, name, simulated)
+
+    for module in list(sys.modules.values()):
+        for name, real, simulated in replacements:
+            if getattr(module, name, None) is real:
+                setattr(module, name, simulated)
+
+    print(f"Using simulated BLE transport with {len(SimulatedBleakClient.world.peripherals)} peripherals")
+    return SimulatedBleakClient.world
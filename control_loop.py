@@ -0,0 +1,108 @@
+# control_loop.py
+# Fixed-rate tick scheduler for the input -> hub pipeline.
+#
+# Ticks are scheduled on absolute monotonic deadlines (start + n * period), so
+# sleep inaccuracy never accumulates into drift. A tick that runs past the
+# next deadline is counted as an overrun and the missed deadlines are skipped
+# instead of being replayed in a burst. Timed maneuvers (e.g. a brake pulse)
+# are registered with call_later() and fire at the start of the first tick at
+# or after their deadline, so they never block input handling.
+
+import asyncio
+import heapq
+import itertools
+import time
+from latency_stats import RunningStats
+
+
+class ControlLoop:
+    def __init__(self, rate_hz=50):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be positive")
+        self.rate_hz = rate_hz
+        self.period = 1.0 / rate_hz
+
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter = RunningStats()    # wake-up lateness vs. deadline, seconds
+        self.tick_time = RunningStats() # time spent inside the tick callback, seconds
+
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._cancelled = set()
+        self._running = False
+
+    def call_later(self, delay, callback, *args):
+        """
+        run callback(*args) on the first tick at or after now + delay
+        callback may be a plain function or a coroutine function
+        returns a handle for cancel()
+        """
+        handle = next(self._timer_ids)
+        heapq.heappush(self._timers, (time.monotonic() + delay, handle, callback, args))
+        return handle
+
+    def cancel(self, handle):
+        self._cancelled.add(handle)
+
+    def stop(self):
+        self._running = False
+
+    async def _run_timers(self, now):
+        while self._timers and self._timers[0][0] <= now:
+            _, handle, callback, args = heapq.heappop(self._timers)
+            if handle in self._cancelled:
+                self._cancelled.discard(handle)
+                continue
+            result = callback(*args)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def run(self, tick, duration=None):
+        """
+        call `await tick()` every period until stop() is called
+        (or for `duration` seconds when given)
+        """
+        self._running = True
+        start = time.monotonic()
+        end = start + duration if duration is not None else None
+        n = 0
+        deadline = start
+
+        while self._running:
+            now = time.monotonic()
+            self.jitter.add(now - deadline)
+
+            await self._run_timers(now)
+            await tick()
+            self.ticks += 1
+
+            done = time.monotonic()
+            self.tick_time.add(done - now)
+            if end is not None and done >= end:
+                break
+
+            n += 1
+            deadline = start + n * self.period
+            if done > deadline:
+                # overran the next deadline: realign instead of bursting to catch up
+                self.overruns += 1
+                missed = int((done - deadline) / self.period) + 1
+                self.skipped += missed
+                n += missed
+                deadline = start + n * self.period
+
+            await asyncio.sleep(deadline - time.monotonic())
+
+        self._running = False
+
+    def stats(self):
+        return {
+            "rate_hz": self.rate_hz,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "jitter_ms": self.jitter.as_dict(1000),
+            "tick_ms": self.tick_time.as_dict(1000),
+        }
@@ -0,0 +1,130 @@
+# drive_channel.py
+# Binary WebSocket drive channel shared by the server (/ws/drive in
+# robot_control.py) and the clients (joystick_control.py --ws).
+#
+# Every setpoint is one 16 byte binary message instead of a JSON HTTP POST:
+#
+#   uint32 seq | float64 client timestamp (time.time()) | int8 speed | int8 angle | uint8 lights | pad
+#
+# little endian. The server never answers individual frames. It drops a
+# frame whose sequence number is not newer than the last one it accepted,
+# and a frame that arrives more than max_age later than the fastest frame of
+# the connection (relative delay, so the two clocks do not need to agree).
+
+import struct
+import time
+from collections import namedtuple
+
+FRAME = struct.Struct("<IdbbBx")
+FRAME_SIZE = FRAME.size
+SEQ_MASK = 0xFFFFFFFF
+
+DriveFrame = namedtuple("DriveFrame", "seq timestamp speed angle lights")
+
+
+def encode_frame(seq, speed, angle, lights=0, timestamp=None):
+    return FRAME.pack(seq & SEQ_MASK, time.time() if timestamp is None else timestamp, speed, angle, lights)
+
+
+def decode_frame(data):
+    """raises ValueError for a message of the wrong size"""
+    if len(data) != FRAME_SIZE:
+        raise ValueError(f"drive frame must be {FRAME_SIZE} bytes, got {len(data)}")
+    return DriveFrame._make(FRAME.unpack(data))
+
+
+class DriveFrameEncoder:
+    """numbers the frames of one connection"""
+
+    def __init__(self):
+        self.seq = 0
+
+    def encode(self, speed, angle, lights=0):
+        self.seq = (self.seq + 1) & SEQ_MASK
+        return FRAME.pack(self.seq, time.time(), speed, angle, lights)
+
+
+class DriveFrameFilter:
+    def __init__(self, max_age=0.25):
+        """
+        max_age: seconds a frame may arrive later than the connection's fastest frame
+        """
+        self.max_age = max_age
+        self.last_seq = None
+        self.min_delay = None # smallest (arrival - client timestamp) seen, absorbs the clock offset
+
+        self.accepted = 0
+        self.out_of_order = 0
+        self.stale = 0
+        self.malformed = 0
+
+    def accept(self, data, now=None):
+        """returns the DriveFrame to apply, or None when it must be dropped"""
+        try:
+            frame = decode_frame(data)
+        except (ValueError, struct.error):
+            self.malformed += 1
+            return None
+
+        # sequence numbers are compared modulo 2**32 so they may wrap
+        if self.last_seq is not None and not 0 < ((frame.seq - self.last_seq) & SEQ_MASK) < 0x80000000:
+            self.out_of_order += 1
+            return None
+        self.last_seq = frame.seq
+
+        delay = (time.time() if now is None else now) - frame.timestamp
+        if self.min_delay is None or delay < self.min_delay:
+            self.min_delay = delay
+        elif delay - self.min_delay > self.max_age:
+            self.stale += 1
+            return None
+
+        self.accepted += 1
+        return frame
+
+    def stats(self):
+        return {
+            "accepted": self.accepted,
+            "out_of_order": self.out_of_order,
+            "stale": self.stale,
+            "malformed": self.malformed,
+            "last_seq": self.last_seq,
+        }
+
+
+class DriveChannelClient:
+    """aiohttp client side of /ws/drive"""
+
+    def __init__(self, url="ws://127.0.0.1:5000/ws/drive", session=None):
+        self.url = url
+        self.session = session
+        self.ws = None
+        self.encoder = DriveFrameEncoder()
+        self._own_session = session is None
+
+    async def connect(self):
+        import aiohttp
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        self.ws = await self.session.ws_connect(self.url)
+        return self
+
+    async def send(self, speed, angle, lights=0):
+        """send one setpoint, returns its sequence number"""
+        await self.ws.send_bytes(self.encoder.encode(speed, angle, lights))
+        return self.encoder.seq
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+            self.ws = None
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
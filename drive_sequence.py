@@ -0,0 +1,164 @@
+# drive_sequence.py
+# Timed setpoint sequences run on the server (POST /drive/sequence in
+# robot_control.py).
+#
+# A sequence is a list of (offset_ms, speed, angle, lights) steps. Offsets are
+# relative to the start of the sequence and every step is scheduled on an
+# absolute monotonic deadline, so write time and sleep inaccuracy never
+# accumulate. Starting a new sequence replaces the running one, cancel()
+# stops it; start() and cancel() are serialized, so overlapping requests
+# never leave a sequence running that the runner lost track of. Every step
+# records how far its write started from its planned time.
+
+import asyncio
+import itertools
+import time
+from collections import namedtuple
+from latency_stats import RunningStats
+
+Step = namedtuple("Step", "offset_ms speed angle lights")
+
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+REPLACED = "replaced"
+FAILED = "failed"
+
+
+class Sequence:
+    def __init__(self, sequence_id, steps):
+        self.id = sequence_id
+        self.steps = steps
+        self.state = RUNNING
+        self.error = None
+        self.started_at = None   # monotonic
+        self.finished_at = None
+        self.results = []        # one dict per step that was written
+        self.timing_error = RunningStats()
+
+    def report(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "error": self.error,
+            "steps": len(self.steps),
+            "steps_done": len(self.results),
+            "duration_ms": None if self.finished_at is None else (self.finished_at - self.started_at) * 1000,
+            "timing_error_ms": self.timing_error.as_dict(1000),
+            "results": self.results,
+        }
+
+
+class SequenceRunner:
+    def __init__(self, drive, history=8):
+        """
+        drive: async callable (speed, angle, lights), e.g. TechnicMoveHub.drive
+        history: number of finished sequences kept for get()
+        """
+        self.drive = drive
+        self.history = history
+        self.current = None
+        self.sequences = {}
+        self._task = None
+        self._ids = itertools.count(1)
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        # a start() or cancel() in progress counts as running, a takeover must wait for it
+        return self._lock.locked() or (self._task is not None and not self._task.done())
+
+    async def start(self, steps):
+        """
+        run `steps` (Step or (offset_ms, speed, angle, lights) tuples), replacing a running sequence
+        the replaced sequence has finished (its last write settled) before the new one begins
+        returns the new Sequence
+        """
+        steps = sorted((Step(*step) for step in steps), key=lambda step: step.offset_ms)
+        if not steps:
+            raise ValueError("a sequence needs at least one step")
+        if steps[0].offset_ms < 0:
+            raise ValueError("step offsets must not be negative")
+
+        async with self._lock:
+            if self._task is not None and not self._task.done():
+                self.current.state = REPLACED
+                task = self._task
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+            sequence = Sequence(next(self._ids), steps)
+            self.sequences[sequence.id] = sequence
+            for old_id in list(self.sequences)[:-self.history]:
+                del self.sequences[old_id]
+            self.current = sequence
+            self._task = asyncio.get_running_loop().create_task(self._run(sequence),
+                                                                name=f"drive sequence {sequence.id}")
+            return sequence
+
+    async def cancel(self, stop=True):
+        """
+        cancel the running sequence, returns it (None if nothing was running)
+        with stop, the vehicle is stopped afterwards
+        """
+        if not self.running:
+            return None
+        async with self._lock:
+            # the sequence may have finished while this waited for a start() or cancel()
+            if self._task is None or self._task.done():
+                return None
+            sequence, task = self.current, self._task
+            sequence.state = CANCELLED
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            if stop:
+                await self.drive(0, 0, sequence.results[-1]["lights"] if sequence.results else 0)
+            return sequence
+
+    def get(self, sequence_id=None):
+        if sequence_id is None:
+            return self.current
+        return self.sequences.get(sequence_id)
+
+    async def _run(self, sequence):
+        sequence.started_at = start = time.monotonic()
+        try:
+            for index, step in enumerate(sequence.steps):
+                deadline = start + step.offset_ms / 1000
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                began = time.monotonic()
+                await self.drive(step.speed, step.angle, step.lights)
+                written = time.monotonic()
+
+                error = began - deadline
+                sequence.timing_error.add(error)
+                sequence.results.append({
+                    "step": index,
+                    "planned_ms": step.offset_ms,
+                    "actual_ms": (began - start) * 1000,
+                    "error_ms": error * 1000,
+                    "write_ms": (written - began) * 1000,
+                    "speed": step.speed,
+                    "angle": step.angle,
+                    "lights": step.lights,
+                })
+            sequence.state = DONE
+        except asyncio.CancelledError:
+            if sequence.state == RUNNING:
+                sequence.state = CANCELLED
+            raise
+        except Exception as e:
+            sequence.state = FAILED
+            sequence.error = str(e)
+            print(f"drive sequence {sequence.id} failed: {e}")
+        finally:
+            sequence.finished_at = time.monotonic()
@@ -9,7 +9,7 @@ This module defines classes for controlling audio and LEDs for a droid. It conta
 """
 
 from enum import IntEnum
-from droiddepot.utils import  int_to_hex
+from droiddepot.utils import int_to_hex, int_to_bytes
 from droiddepot.protocol import DroidMultipurposeCommand, DroidAffiliation
 from droiddepot.hardware import DroidLedIdentifier, get_shutdown_audio_track
 
@@ -116,6 +116,21 @@ class DroidAudioController(object):
         command_data = "%s%s"  % (command_id, data)
         await self.droid.send_droid_multi_command(DroidMultipurposeCommand.AudioControllerCommand, command_data)
 
+    async def execute_audio_command_bytes(self, command_id: int, data: bytes = b"\x00") -> None:
+        """
+        Executes an audio command on the Droid, with the data given as bytes.
+
+        Args:
+            command_id (int): The ID of the audio command to execute.
+            data (bytes): The data to send with the audio command, if any.
+
+        Returns:
+            None
+        """
+
+        await self.droid.send_droid_multi_command_bytes(DroidMultipurposeCommand.AudioControllerCommand,
+                                                        int_to_bytes(command_id), data)
+
     async def play_audio(self, sound_id: int = None, bank_id: int = None, cycle: bool = False, volume: int = None) -> None:
         """
         Plays audio on the Droid.
@@ -137,11 +152,11 @@ class DroidAudioController(object):
         if bank_id and (not hasattr(self, "sound_bank") or self.sound_bank != bank_id):
             await self.set_audio_bank(bank_id)
 
-        sound_id = int_to_hex(sound_id - 1 if sound_id != None else 0)
-        bank_id = int_to_hex(bank_id)
+        sound_id = int_to_bytes(sound_id - 1 if sound_id != None else 0)
+        bank_id = int_to_bytes(bank_id)
 
-        audio_command = "00"
-        audio_parameter = "00"
+        audio_command = 0
+        audio_parameter = b"\x00"
 
         if sound_id:
             audio_command = DroidAudioCommand.PlayAudioFromSelectedGroup
@@ -152,7 +167,7 @@ class DroidAudioController(object):
             audio_command = DroidAudioCommand.PlayAudioFromGroupByValue
             audio_parameter = bank_id
         
-        await self.execute_audio_command(audio_command, audio_parameter)
+        await self.execute_audio_command_bytes(audio_command, audio_parameter)
 
     async def play_shutdown_audio(self) -> None:
         """
@@ -173,7 +188,7 @@ class DroidAudioController(object):
         bank_id = int_to_hex(bank_id if bank_id != None else 0)
         self.sound_bank = bank_id
 
-        await self.execute_audio_command(DroidAudioCommand.SetSelectedSoundBank, bank_id)
+        await self.execute_audio_command_bytes(DroidAudioCommand.SetSelectedSoundBank, bytes.fromhex(bank_id))
 
     async def set_volume(self, volume_level: int) -> None:
         """
@@ -183,8 +198,8 @@ class DroidAudioController(object):
             volume_level (int): The volume level to set.
         """
 
-        volume_level = int_to_hex(volume_level if volume_level != None else 0)
-        await self.execute_audio_command(DroidAudioCommand.SetVolume, volume_level)
+        volume_level = int_to_bytes(volume_level if volume_level != None else 0)
+        await self.execute_audio_command_bytes(DroidAudioCommand.SetVolume, volume_level)
 
     async def reset_head_leds(self) -> None:
         """
@@ -196,7 +211,8 @@ class DroidAudioController(object):
         """
         """
 
-        await self.execute_audio_command(DroidAudioCommand.DisableHeadLeds, led_identifier)
+        # the identifier is sent with its decimal digits as hex digits
+        await self.execute_audio_command_bytes(DroidAudioCommand.DisableHeadLeds, bytes.fromhex("%s" % led_identifier))
 
         if led_identifier not in self.disabled_leds:
             self.disabled_leds.append(led_identifier)
@@ -206,7 +222,7 @@ class DroidAudioController(object):
         """
 
         led_identifier = int_to_hex(led_identifier)
-        await self.execute_audio_command(DroidAudioCommand.EnableHeadLeds, led_identifier)
+        await self.execute_audio_command_bytes(DroidAudioCommand.EnableHeadLeds, bytes.fromhex(led_identifier))
 
         if led_identifier in self.disabled_leds:
             self.disabled_leds.remove(led_identifier)
@@ -216,7 +232,7 @@ class DroidAudioController(object):
         """
 
         led_identifier = int_to_hex(led_identifier)
-        await self.execute_audio_command(DroidAudioCommand.SetLedOn, led_identifier)
+        await self.execute_audio_command_bytes(DroidAudioCommand.SetLedOn, bytes.fromhex(led_identifier))
 
         if not led_identifier in self.turned_on_leds:
             self.turned_on_leds.append(led_identifier)
@@ -226,7 +242,7 @@ class DroidAudioController(object):
         """
 
         led_identifier = int_to_hex(led_identifier)
-        await self.execute_audio_command(DroidAudioCommand.SetLedOff, led_identifier)
+        await self.execute_audio_command_bytes(DroidAudioCommand.SetLedOff, bytes.fromhex(led_identifier))
 
         if led_identifier in self.turned_on_leds:
             self.turned_on_leds.remove(led_identifier)
\ No newline at end of file
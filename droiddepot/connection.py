@@ -11,8 +11,11 @@ to manage the droid's audio, motor, and script functions.
 
 import asyncio
 import logging
-from time import sleep
-from threading import Thread
+import struct
+from contextlib import nullcontext
+from enum import IntEnum
+from time import monotonic
+from typing import AsyncIterator
 from bleak import BleakScanner, BleakClient
 from droiddepot.protocol import *
 from droiddepot.audio import DroidAudioController
@@ -21,6 +24,49 @@ from droiddepot.script import DroidScriptEngine, DroidScripts
 from droiddepot.voice import DroidVoiceController
 from droiddepot.notify import DroidNotificationProcessor
 from droiddepot.hardware import DroidPersonalityIdentifier, DroidAffiliation
+from droiddepot.utils import int_to_decimal_byte
+
+DroidCommandHeader = struct.Struct("BBBB")
+DroidMultiCommandPrefix = b"\x44"
+DroidHeartbeatInterval = 10.0
+DroidPairingSequenceDuration = 4.0
+
+class DroidConnectionState(IntEnum):
+    """
+    Enumeration of the phases a DroidConnection goes through while connecting.
+    """
+
+    Disconnected = 0
+    Scanning = 1
+    Connecting = 2
+    Handshaking = 3
+    Ready = 4
+    Failed = 5
+
+class DroidConnectionEvent(object):
+    """
+    A state change of a DroidConnection, passed to the handlers subscribed with subscribe_connection_events.
+    """
+
+    def __init__(self, state: DroidConnectionState, previous_state: DroidConnectionState, duration: float, error: Exception = None) -> None:
+        """
+        Initializes a new instance of the DroidConnectionEvent class.
+
+        Args:
+            state (DroidConnectionState): The state the connection entered.
+            previous_state (DroidConnectionState): The state the connection left.
+            duration (float): Seconds the connection spent in the previous state.
+            error (Exception): The error that failed the connection, if any.
+        """
+
+        self.state = state
+        self.previous_state = previous_state
+        self.duration = duration
+        self.error = error
+
+    def __repr__(self) -> str:
+        return "DroidConnectionEvent(%s -> %s after %.3fs%s)" % (self.previous_state.name, self.state.name, self.duration,
+                                                                ", error=%r" % self.error if self.error is not None else "")
 
 class DroidConnection(object):
     """
@@ -48,8 +94,16 @@ class DroidConnection(object):
             audio_controller: An instance of the DroidAudioController class.
             script_engine: An instance of the DroidScriptEngine class.
             motor_controller: An instance of the DroidMotorController class.
-            heartbeat_loop: An asyncio event loop used for the heartbeat thread.
-            heartbeat_thread: A thread that runs the heartbeat_loop.
+            heartbeat_interval: Seconds without any command after which a heartbeat is sent to keep the link alive.
+            heartbeat_task: The asyncio task sending heartbeats on the connection's event loop while connected.
+            heartbeats_sent: Number of heartbeats sent.
+            heartbeats_skipped: Number of heartbeats skipped because other commands kept the link busy.
+            heartbeat_failures: Number of heartbeats whose write failed.
+            last_command_time: Monotonic time of the last command written to the droid.
+            state: The DroidConnectionState of the connection.
+            phase_timeouts: Seconds each connect phase (Scanning, Connecting, Handshaking) may take before connect fails.
+            phase_durations: Seconds each connect phase took during the last connect.
+            tracer: Optional tracer (e.g. tracing.Tracer); send_droid_command opens a span per write of a traced request when set.
         """
         
         self.profile = profile
@@ -64,22 +118,102 @@ class DroidConnection(object):
         self.voice_controller = DroidVoiceController(self)
         self.notify_processor = DroidNotificationProcessor(self)
 
-        self.heartbeat_loop = asyncio.new_event_loop()
-        self.heartbeat_thread = None
+        self.heartbeat_interval = DroidHeartbeatInterval
+        self.heartbeat_task = None
+        self.heartbeats_sent = 0
+        self.heartbeats_skipped = 0
+        self.heartbeat_failures = 0
+        self.last_command_time = monotonic()
+        self.tracer = None
+
+        self.state = DroidConnectionState.Disconnected
+        self.phase_timeouts = {
+            DroidConnectionState.Scanning: 10.0,
+            DroidConnectionState.Connecting: 10.0,
+            DroidConnectionState.Handshaking: 10.0,
+        }
+        self.phase_durations = {}
+        self.__state_time = monotonic()
+        self.__connection_event_handlers = []
+
+    def subscribe_connection_events(self, handler: object) -> None:
+        """
+        Subscribes a handler to the connection's state changes. The handler is called with a DroidConnectionEvent.
+        """
+
+        if handler not in self.__connection_event_handlers:
+            self.__connection_event_handlers.append(handler)
 
-    async def connect(self, silent: bool = False) -> None:
+    def unsubscribe_connection_events(self, handler: object) -> None:
         """
-        Connect to the Droid using BLE.
+        Unsubscribes a handler from the connection's state changes.
+        """
+
+        if handler in self.__connection_event_handlers:
+            self.__connection_event_handlers.remove(handler)
+
+    def __set_state(self, state: DroidConnectionState, error: Exception = None) -> None:
+        """
+        Moves the connection to a new state, records how long the previous one took and notifies the subscribed handlers.
+        """
+
+        now = monotonic()
+        previous_state, duration = self.state, now - self.__state_time
+        if previous_state in self.phase_timeouts:
+            self.phase_durations[previous_state] = duration
+
+        self.state = state
+        self.__state_time = now
+        logging.debug("Droid connection %s -> %s after %.3f seconds" % (previous_state.name, state.name, duration))
+
+        event = DroidConnectionEvent(state, previous_state, duration, error)
+        for handler in list(self.__connection_event_handlers):
+            try:
+                handler(event)
+            except Exception as e:
+                logging.error("Droid connection event handler failed: %s" % e)
+
+    async def __run_phase(self, state: DroidConnectionState, phase: object) -> None:
+        """
+        Enters a connect phase and runs it, failing with a TimeoutError when it takes longer than its phase timeout.
+        """
+
+        self.__set_state(state)
+        timeout = self.phase_timeouts.get(state)
+        try:
+            await asyncio.wait_for(phase(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Droid connection timed out after %.1f seconds while %s" % (timeout, state.name.lower()))
+
+    async def __scan(self) -> None:
         """
+        Resolves the droid's address to a BLE device. Droids found by discover_droids are already resolved.
+        """
+
+        if not isinstance(self.profile, str):
+            return
 
-        timeout = 0.0
-        self.droid = BleakClient(self.profile)
+        device = await BleakScanner.find_device_by_address(self.profile, timeout=self.phase_timeouts[DroidConnectionState.Scanning])
+        if device is None:
+            raise Exception("Droid %s was not found" % self.profile)
+        self.profile = device
+
+    async def __open_link(self) -> None:
+        """
+        Opens the BLE connection to the droid and subscribes to its notifications.
+        """
+
+        self.droid = BleakClient(self.profile, disconnected_callback=self.__on_link_lost)
         await self.droid.connect()
         await self.droid.start_notify(DroidBluetoothCharacteristics.DroidNotifyCharacteristic, self.notification_handler)
 
-        while not self.droid.is_connected and timeout < 10:
-            sleep (.1)
-            timeout += .1
+        while not self.droid.is_connected:
+            await asyncio.sleep(.1)
+
+    async def __handshake(self, silent: bool) -> None:
+        """
+        Sends the connect code, reads the droid's identity from its manufacturer data and plays the pairing sequence.
+        """
 
         connect_code = bytearray.fromhex("222001")
         await self.droid.write_gatt_char(0x000d, connect_code, False)
@@ -90,14 +224,76 @@ class DroidConnection(object):
         droid_data_len = len(droid_data)
         self.personality_id = droid_data[droid_data_len - 1]
         self.affiliation_id = (droid_data[droid_data_len - 2] - 0x80) / 2
-        
+
         if not silent:
             await self.script_engine.execute_script(DroidScripts.DroidPairingSequence1)
-            sleep(4)
+            await asyncio.sleep(DroidPairingSequenceDuration)
+
+    def __on_link_lost(self, client: object) -> None:
+        """
+        Called by bleak when the BLE connection to the droid is closed.
+        """
+
+        if self.state not in (DroidConnectionState.Disconnected, DroidConnectionState.Failed):
+            self.__set_state(DroidConnectionState.Disconnected)
+
+    async def connect(self, silent: bool = False) -> None:
+        """
+        Connect to the Droid using BLE.
+
+        The connection goes through the Scanning, Connecting and Handshaking phases before it is Ready. Every phase
+        awaits instead of blocking, so other droids and tasks on the same event loop keep running meanwhile.
+        If a phase fails or takes longer than its timeout in phase_timeouts, the connection ends up Failed
+        and the error (a TimeoutError for a timeout) is raised.
+        """
+
+        self.phase_durations = {}
+        try:
+            await self.__run_phase(DroidConnectionState.Scanning, self.__scan)
+            await self.__run_phase(DroidConnectionState.Connecting, self.__open_link)
+            await self.__run_phase(DroidConnectionState.Handshaking, lambda: self.__handshake(silent))
+        except asyncio.CancelledError as e:
+            self.__set_state(DroidConnectionState.Failed, e)
+            # the cleanup runs shielded, so cancelling again while it runs neither interrupts nor swallows it
+            try:
+                await asyncio.shield(self.__close_failed_link())
+            except asyncio.CancelledError:
+                pass
+            raise
+        except Exception as e:
+            self.__set_state(DroidConnectionState.Failed, e)
+            await self.__close_failed_link()
+            raise
+
+        self.__set_state(DroidConnectionState.Ready)
+        self.start_heartbeat()
+
+    async def __close_failed_link(self) -> None:
+        """
+        Closes the link of a failed connect, if it got that far. Errors are logged, the connect error is what counts.
+        """
+
+        if self.droid is None or not self.droid.is_connected:
+            return
+
+        try:
+            await self.droid.disconnect()
+        except Exception as e:
+            logging.warning("Failed to disconnect after a failed connect: %s" % e)
+
+    def connection_stats(self) -> dict:
+        """
+        Returns the connection state and the duration of every connect phase.
+
+        Returns:
+            dict: The state name, the seconds spent in it so far and the connect phase durations in seconds.
+        """
 
-        self.heartbeat_thread = Thread(target=self.__start_heartbeat_loop, args=(self.heartbeat_loop,), daemon=True)
-        self.heartbeat_thread.start()
-        asyncio.run_coroutine_threadsafe(self.__send_heartbeat_command(), self.heartbeat_loop)
+        return {
+            "state": self.state.name,
+            "state_s": monotonic() - self.__state_time,
+            "phases_s": {state.name: duration for state, duration in self.phase_durations.items()},
+        }
 
     async def __aenter__(self) -> object:
         """
@@ -115,29 +311,81 @@ class DroidConnection(object):
 
         await self.notify_processor.handle_incoming_message(sender, data)
 
-    def __start_heartbeat_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+    def start_heartbeat(self) -> None:
         """
-        Starts the heartbeat event loop
+        Starts sending heartbeats as a task on the running event loop, the loop the droid was connected on.
         """
 
-        asyncio.set_event_loop(loop)
-        loop.run_forever()
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = asyncio.get_running_loop().create_task(self.__send_heartbeat_command(),
+                                                                         name="droid heartbeat")
+
+    async def stop_heartbeat(self) -> None:
+        """
+        Stops the heartbeat task and waits for it to finish.
+        """
+
+        if self.heartbeat_task is None:
+            return
+
+        task, self.heartbeat_task = self.heartbeat_task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
 
     async def __send_heartbeat_command(self) -> None:
         """
-        Sends a harmless unused command every 10 seconds to keep our connection to the droid alive even when not in use.
+        Sends a harmless unused command to keep our connection to the droid alive even when not in use.
+
+        A heartbeat only goes out when no other command was written within heartbeat_interval seconds,
+        so a droid that is busy receiving commands gets no heartbeats at all.
+        """
+
+        heartbeat_time = None
+        while self.droid is not None and self.droid.is_connected:
+            idle = monotonic() - self.last_command_time
+            if idle < self.heartbeat_interval:
+                if self.last_command_time != heartbeat_time:
+                    self.heartbeats_skipped += 1
+                await asyncio.sleep(self.heartbeat_interval - idle)
+                continue
+
+            try:
+                await self.send_droid_command_bytes(DroidCommandId.ConnectionHeartbeat)
+                self.heartbeats_sent += 1
+            except Exception as e:
+                self.heartbeat_failures += 1
+                logging.warning("Failed to send heartbeat: %s" % e)
+                self.last_command_time = monotonic()
+            heartbeat_time = self.last_command_time
+
+    def heartbeat_stats(self) -> dict:
+        """
+        Returns the heartbeat counters of the connection.
+
+        Returns:
+            dict: Whether the heartbeat is running, its interval, the heartbeats sent, skipped and failed
+            and the seconds since the last command.
         """
 
-        while self.droid.is_connected:
-            await self.send_droid_command(DroidCommandId.ConnectionHeartbeat)
-            sleep(10)
+        return {
+            "running": self.heartbeat_task is not None and not self.heartbeat_task.done(),
+            "interval_s": self.heartbeat_interval,
+            "sent": self.heartbeats_sent,
+            "skipped": self.heartbeats_skipped,
+            "failures": self.heartbeat_failures,
+            "idle_s": monotonic() - self.last_command_time,
+        }
 
     async def disconnect(self, silent: bool = False) -> None:
         """
         Disconnect from the Droid.
         """
 
-        if not self.droid.is_connected:
+        await self.stop_heartbeat()
+        if self.droid is None or not self.droid.is_connected:
             return
         
         # Perform shutdown operations
@@ -150,9 +398,7 @@ class DroidConnection(object):
                 await self.audio_controller.play_shutdown_audio()
         finally:
             await self.droid.disconnect()
-
-            if self.heartbeat_loop != None:
-                self.heartbeat_loop.stop()
+            self.__on_link_lost(self.droid)
 
     async def __aexit__(self, exc_type: object, exc_value: object, traceback: object) -> None:
         """
@@ -201,6 +447,43 @@ class DroidConnection(object):
         
         return command_bytes
 
+    def build_droid_command_bytes(self, command_id: int, *data: bytes) -> bytes:
+        """
+        Creates the bytes of a command for a Droid from bytes-like data parts, the byte form of build_droid_command.
+        The parts are copied in order after the header, so callers never format or parse hex strings.
+
+        If the command id or the data length do not fit in the header, a ValueError is raised.
+
+        Args:
+            command_id (int): The command id to be included in the Droid command
+            data (bytes): The data parts to be included in the Droid command
+
+        Returns:
+            bytes: The byte representation of the Droid command.
+        """
+
+        payload = data[0] if len(data) == 1 else b"".join(data)
+        try:
+            header = DroidCommandHeader.pack((len(payload) + 3) | 0x20, 0x42 if command_id == 15 else 0x00,
+                                             command_id, len(payload) + 0x40)
+        except struct.error:
+            raise ValueError("Failed to pack droid command (%s) with data (%s). Data is malformed" % (command_id, bytes(payload).hex()))
+
+        return header + payload
+
+    async def __write_command(self, command_id: int, command: bytes) -> None:
+        """
+        Writes a packed command to the droid's command characteristic.
+        """
+
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('Sending command: %s' % command.hex())
+        span = self.tracer.child_span("send_droid_command", cat="ble", command_id=command_id, size=len(command)) \
+            if self.tracer is not None else nullcontext()
+        self.last_command_time = monotonic()
+        with span:
+            await self.droid.write_gatt_char(DroidBluetoothCharacteristics.DroidCommandCharacteristic, command)
+
     async def send_droid_command(self, command_id: int, data: str = "") -> None:
         """
         Sends a command to the Droid, composed of a command ID and optional data.
@@ -213,8 +496,19 @@ class DroidConnection(object):
         """
 
         command = self.build_droid_command(command_id, data)
-        logging.debug('Sending command: %s' % command.hex())
-        await self.droid.write_gatt_char(DroidBluetoothCharacteristics.DroidCommandCharacteristic, bytearray.fromhex(command.hex()))
+        await self.__write_command(command_id, command)
+
+    async def send_droid_command_bytes(self, command_id: int, *data: bytes) -> None:
+        """
+        Sends a command to the Droid, composed of a command ID and bytes-like data parts.
+
+        Args:
+            command_id (int): The ID of the command to send.
+            data (bytes): Optional data parts to include in the command.
+        """
+
+        command = self.build_droid_command_bytes(command_id, *data)
+        await self.__write_command(command_id, command)
 
     async def send_droid_multi_command(self, command_id: int, data: str = "") -> None:
         """
@@ -230,6 +524,19 @@ class DroidConnection(object):
         command = "44%s%s" % ("{:02d}".format(command_id), data)
         await self.send_droid_command(DroidCommandId.MultipurposeCommand, command)
 
+    async def send_droid_multi_command_bytes(self, command_id: int, *data: bytes) -> None:
+        """
+        Sends a multi command to the Droid, composed of a command ID and bytes-like data parts.
+        Like send_droid_multi_command the command ID is sent with its decimal digits as hex digits.
+
+        Args:
+            command_id (int): The ID of the command to send.
+            data (bytes): Optional data parts to include in the command.
+        """
+
+        await self.send_droid_command_bytes(DroidCommandId.MultipurposeCommand, DroidMultiCommandPrefix,
+                                            int_to_decimal_byte(command_id), *data)
+
     async def get_droid_firmware_information(self) -> None:
         """
         Requests the droid firmware information. Currently the contents of this data
@@ -251,9 +558,7 @@ class DroidConnection(object):
             state (bool): State to set the led to
         """
 
-        data = "00"
-        data += "ff" if state else "00"
-        await self.send_droid_command(DroidCommandId.SetPairingLedState, data)
+        await self.send_droid_command_bytes(DroidCommandId.SetPairingLedState, b"\x00", b"\xff" if state else b"\x00")
 
     async def set_rgb_led(self, state: bool) -> None:
         """
@@ -264,9 +569,7 @@ class DroidConnection(object):
             state (bool): State to set the led to
         """
 
-        data = "00"
-        data += "ff" if state else "00"
-        await self.send_droid_command(DroidCommandId.SetRGBLedState, data)
+        await self.send_droid_command_bytes(DroidCommandId.SetRGBLedState, b"\x00", b"\xff" if state else b"\x00")
 
     async def flash_pairing_led(self, data: str) -> None:
         """
@@ -278,65 +581,91 @@ class DroidConnection(object):
 
         await self.send_droid_command(DroidCommandId.FlashPairingLed, data)
 
-async def discover_droids(retry: bool = False) -> list:
+async def stream_droids(timeout: float = None) -> AsyncIterator[DroidConnection]:
+    """
+    Scans for nearby Bluetooth devices manufactured by Disney that have the device name of "DROID" and yields a
+    DroidConnection for each one the moment its first advertisement arrives. Every droid is yielded once, even though it
+    keeps advertising. The scan stops when the caller stops iterating or after timeout seconds.
+
+    Args:
+        timeout (float): seconds to scan for, None to scan until the caller stops iterating
+
+    Yields:
+        a DroidConnection object for every discovered "DROID" Bluetooth device
+    """
+
+    loop = asyncio.get_running_loop()
+    discovered = asyncio.Queue()
+    seen = set()
+
+    def detection_callback(ble_device: object, advertising_data: object) -> None:
+        if ble_device.address in seen:
+            return
+
+        manufacturer_data = advertising_data.manufacturer_data or {}
+        name = advertising_data.local_name or ble_device.name
+        if name == "DROID" and DisneyBLEManufacturerId.DroidManufacturerId in manufacturer_data:
+            seen.add(ble_device.address)
+            discovered.put_nowait((ble_device, manufacturer_data))
+
+    deadline = None if timeout is None else loop.time() + timeout
+    async with BleakScanner(detection_callback=detection_callback):
+        while True:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return
+
+            try:
+                discovered_droid = await asyncio.wait_for(discovered.get(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+            logging.info(f"Droid successfully discovered: [ {discovered_droid[0]} ]")
+            yield DroidConnection(*discovered_droid)
+
+async def discover_droids(retry: bool = False, timeout: float = 5.0) -> list:
     """
     Scans for nearby Bluetooth devices manufactured by Disney and have the device name of "DROID" if any are found they will be
-    converted to a DroidConnection and added to a list to return. If retry is False, the function will out after a set
-    period of time and return without discovering any droids.
+    converted to a DroidConnection and added to a list to return. If retry is False, the function will time out after
+    timeout seconds and return without discovering any droids.
 
     Args:
         retry (bool): whether or not to continue scanning until a device is found or the function is interrupted
+        timeout (float): seconds to collect droids for in each scan
 
     Returns:
         a list of DroidConnection objects representing the discovered "DROID" Bluetooth devices if any. Otherwise an empty list
     """
 
-    async with BleakScanner() as scanner:      
-        droid_connections = []
-        droids = []
-        
-        while True:
-            possible_droids = scanner.discovered_devices_and_advertisement_data
-            if len(possible_droids) == 0:
-                await asyncio.sleep(5)
-                continue
+    droid_connections = []
+    while True:
+        async for droid_connection in stream_droids(timeout):
+            droid_connections.append(droid_connection)
 
-            for possible_droid_address in possible_droids:
-                ble_device, advertising_data = possible_droids[possible_droid_address]
-                manufacturer_ids = list(advertising_data.manufacturer_data.keys()) if advertising_data.manufacturer_data != None else []
-
-                if ble_device.name == "DROID" and DisneyBLEManufacturerId.DroidManufacturerId in manufacturer_ids:
-                    droids.append((ble_device, advertising_data.manufacturer_data))
-                    
-            if len(droids) == 0:
-                if not retry:
-                    logging.error("Droid discovery failed. Retrying...")
-                    await asyncio.sleep(5)
-                    continue
-                else:
-                    logging.warning("Droid discovery failed. Retrying...")
-                    await asyncio.sleep(5)
-                    continue
-            else:
-                for discovered_droid in droids:
-                    logging.info(f"Droid successfully discovered: [ {discovered_droid[0]} ]")
-                    droid_connections.append(DroidConnection(*discovered_droid))
-                break
-    
-    return droid_connections
-
-async def discover_droid(retry: bool = False) -> DroidConnection:
+        if len(droid_connections) > 0 or not retry:
+            return droid_connections
+        logging.warning("Droid discovery failed. Retrying...")
+
+async def discover_droid(retry: bool = False, timeout: float = 5.0) -> DroidConnection:
     """
-    Scans for nearby Bluetooth devices manufactured by Disney and have the device name of "DROID" and returns if found. If retry is True, the function will
-    continue scanning until it finds a device or is interrupted. If retry is False, the function will time out after a
-    set period of time and return without discovering a device.
+    Scans for nearby Bluetooth devices manufactured by Disney and have the device name of "DROID" and returns as soon as one is found.
+    If retry is True, the function will continue scanning until it finds a device or is interrupted. If retry is False, the function
+    will time out after timeout seconds and return without discovering a device.
 
     Args:
         retry (bool): whether or not to continue scanning until a device is found or the function is interrupted
+        timeout (float): seconds to scan for when retry is False
 
     Returns:
         a DroidConnection object representing the discovered "DROID" Bluetooth device if any. Otherwise None
     """
 
-    discovered_droids = await discover_droids(retry)
-    return None if len(discovered_droids) == 0 else discovered_droids[0]
\ No newline at end of file
+    droids = stream_droids(None if retry else timeout)
+    try:
+        async for droid_connection in droids:
+            return droid_connection
+    finally:
+        await droids.aclose()
+
+    logging.error("Droid discovery failed. No droid found within %s seconds" % timeout)
+    return None
@@ -6,7 +6,7 @@ This module provides classes for controlling the motor functions of a SWGE Droid
 """
 
 from enum import IntEnum
-from droiddepot.utils import int_to_hex
+from droiddepot.utils import int_to_bytes
 from droiddepot.protocol import DroidCommandId, DroidMultipurposeCommand
 
 class DroidMotorDirection(object):
@@ -98,15 +98,14 @@ class DroidMotorController(object):
             ramp_speed (int): An integer representing the motor ramp speed. Defaults to 300.
         """
 
-        delay_hex = int_to_hex(delay)
-        if len(delay_hex) < 4:
-            missing = 4 - len(delay_hex)
-            for x in range(missing):
-                delay_hex = '0' + delay_hex
+        # the direction and motor id are sent as the two hex digits of one byte
+        if 0 <= direction <= 9 and 0 <= motor_id <= 9:
+            motor_select = bytes(((direction << 4) | motor_id,))
+        else:
+            motor_select = bytes.fromhex("%s%d" % (direction, motor_id))
 
-        motor_select = "%s%d" % (direction, motor_id)
-        motor_command = "%s%s%s%s" % (motor_select, int_to_hex(speed), int_to_hex(ramp_speed), delay_hex)
-        await self.droid.send_droid_command(DroidCommandId.SetMotorSpeed, motor_command)
+        await self.droid.send_droid_command_bytes(DroidCommandId.SetMotorSpeed, motor_select, int_to_bytes(speed),
+                                                  int_to_bytes(ramp_speed), int_to_bytes(delay, 2))
 
     async def set_drive_speed(self, direction: int, speed: int = 160, ramp_speed: int = 300) -> None:
         """
@@ -147,11 +146,11 @@ class DroidMotorController(object):
         if (direction != DroidMotorDirection.Forward and direction != DroidMotorDirection.Backwards):
             raise ValueError("Direction is invalid. Expected values are 0 (Forward/Left) and 8 (Backwards/Right)")
 
-        dir_hex = "00" if direction == DroidMotorDirection.Forward else "FF"
-        command_data = "%s%s%s0000" % (dir_hex, int_to_hex(speed), int_to_hex(ramp_speed))
+        command_data = (b"\x00" if direction == DroidMotorDirection.Forward else b"\xff", int_to_bytes(speed),
+                        int_to_bytes(ramp_speed), b"\x00\x00")
 
-        await self.droid.send_droid_multi_command(DroidMultipurposeCommand.RotateBUnitHead, command_data)
-        await self.droid.send_droid_multi_command(DroidMultipurposeCommand.RotateRUnitHead, command_data)
+        await self.droid.send_droid_multi_command_bytes(DroidMultipurposeCommand.RotateBUnitHead, *command_data)
+        await self.droid.send_droid_multi_command_bytes(DroidMultipurposeCommand.RotateRUnitHead, *command_data)
 
     async def center_head(self, speed: int = 255, offset: int  = 0) -> None:
         """
@@ -162,5 +161,5 @@ class DroidMotorController(object):
             offset (int): An integer representing the offset from center. Defaults to 0.
         """
 
-        command_data = "%s%s" % (int_to_hex(speed), int_to_hex(offset))
-        await self.droid.send_droid_multi_command(DroidMultipurposeCommand.CenterRUnitHead, command_data)
+        await self.droid.send_droid_multi_command_bytes(DroidMultipurposeCommand.CenterRUnitHead, int_to_bytes(speed),
+                                                        int_to_bytes(offset))
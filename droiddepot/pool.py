@@ -0,0 +1,394 @@
+"""
+Copyright (c) Jordan Maxwell, All Rights Reserved.
+See LICENSE file in the project root for full license information.
+
+This module provides the DroidPool class, which connects to several SWGE DroidDepot droids from one event loop
+and runs commands on them.
+
+Droids are connected in parallel, at most max_parallel_connects at a time, since BLE adapters do not like many
+simultaneous connection attempts. Every droid gets its own command queue served by its own task, so commands
+to one droid run in order while a slow droid only delays its own commands. Fan-out commands such as stop_all
+are queued on every droid at once and awaited together with asyncio.gather.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+from typing import Awaitable, Callable
+from droiddepot.connection import DroidConnection, DroidConnectionState, stream_droids
+
+DroidCommand = Callable[[DroidConnection], Awaitable]
+
+class CommandDropped(Exception):
+    """
+    Raised to the caller of a queued command that was dropped before it ran, e.g. by stop_all.
+    """
+
+def droid_address(connection: DroidConnection) -> str:
+    """
+    Returns the BLE address of a droid connection, used to tell the droids of a pool apart.
+    """
+
+    profile = connection.profile
+    return profile if isinstance(profile, str) else profile.address
+
+def summarize_latencies(latencies: list) -> dict:
+    """
+    Summarizes command latencies given in seconds.
+
+    Returns:
+        dict: The number of samples and their mean, p50, p95, p99 and maximum in milliseconds.
+    """
+
+    if len(latencies) == 0:
+        return {"count": 0}
+
+    ordered = sorted(latencies)
+    last = len(ordered) - 1
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) * 1000,
+        "p50": ordered[int(last * 0.50)] * 1000,
+        "p95": ordered[int(last * 0.95)] * 1000,
+        "p99": ordered[int(last * 0.99)] * 1000,
+        "max": ordered[last] * 1000,
+    }
+
+class DroidPoolMember(object):
+    """
+    A connected droid in a DroidPool, with its own command queue and the task that serves it.
+    """
+
+    def __init__(self, connection: DroidConnection, queue_size: int = 32, latency_samples: int = 1000) -> None:
+        """
+        Initializes a new instance of the DroidPoolMember class.
+
+        Args:
+            connection (DroidConnection): The connected droid.
+            queue_size (int): The maximum number of queued commands, submitting to a full queue waits.
+            latency_samples (int): The number of most recent command latencies kept for the statistics.
+
+        Attributes:
+            address: The BLE address of the droid.
+            commands: Number of commands completed.
+            failures: Number of commands that raised an exception.
+            dropped: Number of queued commands dropped before they ran.
+            latencies: Seconds from submitting to completing the most recent commands.
+            connect_duration: Seconds the connect took.
+        """
+
+        self.connection = connection
+        self.address = droid_address(connection)
+        self.queue = asyncio.Queue(queue_size)
+        self.commands = 0
+        self.failures = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=latency_samples)
+        self.connect_duration = None
+        self.__worker = None
+
+    @property
+    def running(self) -> bool:
+        return self.__worker is not None and not self.__worker.done()
+
+    def start(self) -> None:
+        """
+        Starts serving the command queue on the running event loop.
+        """
+
+        if not self.running:
+            self.__worker = asyncio.get_running_loop().create_task(self.__serve(), name="droid %s commands" % self.address)
+
+    async def stop(self) -> None:
+        """
+        Stops serving the command queue. Commands still queued are dropped.
+        """
+
+        if self.__worker is not None:
+            worker, self.__worker = self.__worker, None
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self.clear("the droid's command queue was stopped")
+
+    def clear(self, reason: str = "the droid's command queue was cleared") -> int:
+        """
+        Drops every queued command that has not started yet. Their callers get a CommandDropped exception.
+
+        Args:
+            reason (str): Why the commands were dropped, used as the exception message.
+
+        Returns:
+            int: The number of dropped commands.
+        """
+
+        dropped = 0
+        while not self.queue.empty():
+            _, future, _ = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(CommandDropped("Command for droid %s dropped: %s" % (self.address, reason)))
+                dropped += 1
+        self.dropped += dropped
+        return dropped
+
+    async def submit(self, command: DroidCommand) -> asyncio.Future:
+        """
+        Queues a command for the droid.
+
+        Args:
+            command (DroidCommand): A coroutine function called with the DroidConnection, e.g.
+                lambda droid: droid.motor_controller.stop_all_motors()
+
+        Returns:
+            asyncio.Future: Resolves to the result of the command once the droid has run it.
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((command, future, monotonic()))
+        return future
+
+    async def run(self, command: DroidCommand) -> object:
+        """
+        Queues a command for the droid and waits for its result.
+        """
+
+        return await (await self.submit(command))
+
+    async def __serve(self) -> None:
+        """
+        Runs the queued commands one after another.
+        """
+
+        while True:
+            command, future, submitted = await self.queue.get()
+            if future.done():
+                continue
+
+            try:
+                result = await command(self.connection)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failures += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.commands += 1
+                self.latencies.append(monotonic() - submitted)
+
+    def stats(self) -> dict:
+        """
+        Returns the health and command statistics of the droid.
+        """
+
+        client = self.connection.droid
+        return {
+            "connected": client is not None and client.is_connected,
+            "state": self.connection.state.name,
+            "connect_s": self.connect_duration,
+            "queued": self.queue.qsize(),
+            "commands": self.commands,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "latency_ms": summarize_latencies(self.latencies),
+            "heartbeat": self.connection.heartbeat_stats(),
+        }
+
+class DroidPool(object):
+    """
+    Connects to several droids from one event loop and runs commands on them.
+    """
+
+    def __init__(self, max_parallel_connects: int = 2, queue_size: int = 32) -> None:
+        """
+        Initializes a new instance of the DroidPool class.
+
+        Args:
+            max_parallel_connects (int): The maximum number of droids connecting at the same time.
+            queue_size (int): The maximum number of queued commands per droid.
+
+        Attributes:
+            members: The DroidPoolMember of every connected droid by BLE address.
+            connect_failures: Number of droids that failed to connect.
+        """
+
+        self.max_parallel_connects = max_parallel_connects
+        self.queue_size = queue_size
+        self.members = {}
+        self.connect_failures = 0
+
+    @property
+    def addresses(self) -> list:
+        return list(self.members)
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __getitem__(self, address: str) -> DroidPoolMember:
+        return self.members[address]
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.members
+
+    async def discover(self, count: int = None, timeout: float = 5.0) -> list:
+        """
+        Scans for droids that are not in the pool yet.
+
+        Args:
+            count (int): Stop scanning once this many droids were found, None to scan for the whole timeout.
+            timeout (float): The maximum number of seconds to scan for.
+
+        Returns:
+            list: A DroidConnection for every droid found.
+        """
+
+        found = []
+        droids = stream_droids(timeout)
+        try:
+            async for connection in droids:
+                if droid_address(connection) in self.members:
+                    continue
+
+                found.append(connection)
+                if count is not None and len(found) >= count:
+                    break
+        finally:
+            await droids.aclose()
+        return found
+
+    async def __connect_one(self, connection: DroidConnection, semaphore: asyncio.Semaphore, silent: bool) -> float:
+        """
+        Connects to one droid once a connect slot is free and returns how many seconds the connect took.
+        """
+
+        async with semaphore:
+            start = monotonic()
+            await connection.connect(silent)
+            return monotonic() - start
+
+    async def connect(self, count: int = None, timeout: float = 5.0, silent: bool = True) -> list:
+        """
+        Discovers droids and connects to them in parallel, at most max_parallel_connects at a time.
+        A droid that fails to connect is logged and left out of the pool.
+
+        Args:
+            count (int): The maximum number of droids to connect, None for every droid found.
+            timeout (float): The maximum number of seconds to scan for droids.
+            silent (bool): Whether to skip the pairing sequence of every droid.
+
+        Returns:
+            list: The addresses of the droids that were connected.
+        """
+
+        connections = await self.discover(count, timeout)
+        semaphore = asyncio.Semaphore(self.max_parallel_connects)
+        results = await asyncio.gather(*(self.__connect_one(connection, semaphore, silent) for connection in connections),
+                                       return_exceptions=True)
+
+        connected = []
+        for connection, result in zip(connections, results):
+            address = droid_address(connection)
+            if isinstance(result, BaseException):
+                self.connect_failures += 1
+                logging.error("Failed to connect to droid %s: %s" % (address, result))
+                continue
+
+            self.add(connection).connect_duration = result
+            connected.append(address)
+
+        logging.info("%d of %d droids connected" % (len(connected), len(connections)))
+        return connected
+
+    def add(self, connection: DroidConnection) -> DroidPoolMember:
+        """
+        Takes over a droid that was connected elsewhere and starts serving its command queue.
+
+        Returns:
+            DroidPoolMember: The pool member of the droid.
+        """
+
+        member = DroidPoolMember(connection, self.queue_size)
+        self.members[member.address] = member
+        member.start()
+        return member
+
+    async def run(self, address: str, command: DroidCommand) -> object:
+        """
+        Runs a command on one droid through its command queue and returns its result.
+        """
+
+        return await self.members[address].run(command)
+
+    async def fan_out(self, command: DroidCommand, addresses: list = None) -> dict:
+        """
+        Runs a command on several droids at once, each through its own command queue.
+
+        Args:
+            command (DroidCommand): A coroutine function called with the DroidConnection of every droid.
+            addresses (list): The droids to run the command on, None for every droid in the pool.
+
+        Returns:
+            dict: The result of the command by address, or the exception it raised on that droid.
+        """
+
+        members = [self.members[address] for address in (addresses if addresses is not None else self.members)]
+        results = await asyncio.gather(*(member.run(command) for member in members), return_exceptions=True)
+        return {member.address: result for member, result in zip(members, results)}
+
+    async def stop_all(self) -> dict:
+        """
+        Stops every motor of every droid. Commands still queued are dropped first, so the stop is not held up behind them;
+        their callers get a CommandDropped exception.
+        """
+
+        for member in self.members.values():
+            member.clear("stop_all")
+        return await self.fan_out(lambda droid: droid.motor_controller.stop_all_motors())
+
+    async def play_audio_on_all(self, sound_id: int = None, bank_id: int = None, cycle: bool = False, volume: int = None) -> dict:
+        """
+        Plays audio on every droid, see DroidAudioController.play_audio for the arguments.
+        """
+
+        return await self.fan_out(lambda droid: droid.audio_controller.play_audio(sound_id, bank_id, cycle, volume))
+
+    async def disconnect(self, silent: bool = True) -> None:
+        """
+        Stops the command queues and disconnects from every droid.
+        """
+
+        members = list(self.members.values())
+        self.members.clear()
+        for member in members:
+            await member.stop()
+        await asyncio.gather(*(member.connection.disconnect(silent) for member in members), return_exceptions=True)
+
+    def stats(self) -> dict:
+        """
+        Returns the pool-wide health and latency statistics and those of every droid.
+        """
+
+        latencies = []
+        for member in self.members.values():
+            latencies.extend(member.latencies)
+
+        members = {address: member.stats() for address, member in self.members.items()}
+        return {
+            "droids": len(members),
+            "connected": sum(1 for member in members.values() if member["connected"]),
+            "ready": sum(1 for member in self.members.values() if member.connection.state == DroidConnectionState.Ready),
+            "connect_failures": self.connect_failures,
+            "commands": sum(member.commands for member in self.members.values()),
+            "failures": sum(member.failures for member in self.members.values()),
+            "dropped": sum(member.dropped for member in self.members.values()),
+            "queued": sum(member.queue.qsize() for member in self.members.values()),
+            "latency_ms": summarize_latencies(latencies),
+            "members": members,
+        }
@@ -14,6 +14,7 @@ import logging
 from datetime import datetime
 from dbeacon import scanner, beacon
 from droiddepot.protocol import DroidCommandId
+from droiddepot.utils import int_to_decimal_byte
 
 class DroidScripts(object):
     """
@@ -81,8 +82,8 @@ class DroidScriptEngine(object):
         if script_id == 13:
             raise ValueError("Attempted to use a dangerous script. Execution denied")
 
-        command_data = "%s%s" % ("{:02d}".format(script_id), "{:02d}".format(script_action))
-        await self.droid.send_droid_command(DroidCommandId.ScriptActionComand, command_data)
+        await self.droid.send_droid_command_bytes(DroidCommandId.ScriptActionComand, int_to_decimal_byte(script_id),
+                                                  int_to_decimal_byte(script_action))
 
     async def execute_script(self, script_id: int) -> None:
         """
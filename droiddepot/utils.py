@@ -22,6 +22,47 @@ def int_to_hex(num: int) -> str:
     
     return hex_str
 
+_SINGLE_BYTES = [bytes((value,)) for value in range(256)]
+_DECIMAL_BYTES = [bytes(((value // 10) << 4 | value % 10,)) for value in range(100)]
+
+def int_to_bytes(num: int, min_length: int = 1) -> bytes:
+    """
+    Converts an integer to big endian bytes, the byte form of int_to_hex.
+
+    Like int_to_hex the integer takes as few bytes as it needs (at least min_length),
+    so bytes.fromhex(int_to_hex(num)) == int_to_bytes(num).
+
+    Args:
+        num (int): The integer to be converted, must not be negative.
+        min_length (int): The minimum number of bytes, padded with leading zeros.
+
+    Returns:
+        bytes: The big endian byte representation of the integer.
+    """
+
+    if min_length == 1 and 0 <= num < 256:
+        return _SINGLE_BYTES[num]
+    if num < 0:
+        raise ValueError("Cannot convert negative integer %d to bytes" % num)
+    return num.to_bytes(max(min_length, (num.bit_length() + 7) // 8), "big")
+
+def int_to_decimal_byte(num: int) -> bytes:
+    """
+    Packs the decimal digits of an integer as hex digits, the byte form of "{:02d}".format(num).
+
+    The protocol sends some identifiers this way (e.g. 12 is sent as 0x12).
+
+    Args:
+        num (int): The integer to be converted.
+
+    Returns:
+        bytes: The decimal digits of the integer read as hex digits.
+    """
+
+    if 0 <= num < 100:
+        return _DECIMAL_BYTES[num]
+    return bytes.fromhex("{:02d}".format(num))
+
 def hex_to_int(hex_str: str) -> int:
     """
     Converts a hexadecimal string to an integer.
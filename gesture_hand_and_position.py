@@ -3,7 +3,11 @@ import mediapipe as mp
 from mediapipe.tasks import python
 from mediapipe.tasks.python import vision
 import aiohttp
+import argparse
 import asyncio
+from contextlib import nullcontext
+from setpoint_mailbox import DEFAULT_MAILBOX_PATH, MailboxClient
+from tracing import TRACEPARENT, Tracer
 
 # Initialize MediaPipe Hands and Drawing Utilities
 mp_hands = mp.solutions.hands
@@ -50,22 +54,31 @@ def detectAndProcessGesture(image):
 
     return horizontal, vertical, sound
 
-async def infoProtocol(session, horizontal, vertical):
+async def infoProtocol(session, horizontal, vertical, mailbox=None, tracer=None):
     # horizontal = -1 left, 0 center, 1 right
     # vertical = -1 forward, 0 stop, 1 backward
 
+    if mailbox is not None:
+        # --shm: shared memory write to a robot_control.py on this machine, no HTTP round trip
+        await mailbox.send(vertical * 100, horizontal * 100)
+        return
+
     # Send the command to the robot control endpoint
-    try:
-        async with session.post('http://localhost:5000/drive', json={
-            'speed': vertical * 100,  # Assuming speed is controlled by vertical gesture
-            'angle': horizontal * 100  # Assuming angle is controlled by horizontal position
-        }) as response:
-            if response.status == 200:
-                print("Drive command sent successfully")
-            else:
-                print(f"Failed to send drive command: {response.status}")
-    except Exception as e:
-        print(f"Error sending drive command: {e}")
+    span = tracer.span("infoProtocol") if tracer is not None else nullcontext()
+    with span:
+        # --trace: the server continues this trace
+        headers = {TRACEPARENT: span.traceparent()} if tracer is not None else None
+        try:
+            async with session.post('http://localhost:5000/drive', json={
+                'speed': vertical * 100,  # Assuming speed is controlled by vertical gesture
+                'angle': horizontal * 100  # Assuming angle is controlled by horizontal position
+            }, headers=headers) as response:
+                if response.status == 200:
+                    print("Drive command sent successfully")
+                else:
+                    print(f"Failed to send drive command: {response.status}")
+        except Exception as e:
+            print(f"Error sending drive command: {e}")
 
 async def sendSoundCommand(session):
     # Send the sound command to the robot control endpoint
@@ -112,9 +125,11 @@ def getHorizontalPositionHand(image):
     else:
         return 0 # center - rotation stops
 
-async def main():
+async def main(args):
     cap = cv2.VideoCapture(1)
     previous_command = None
+    mailbox = await MailboxClient(args.shm, args.shm_vehicle).connect() if args.shm else None
+    tracer = Tracer(args.trace, "gesture_hand_and_position") if args.trace else None
 
     async with aiohttp.ClientSession() as session:
         while cap.isOpened():
@@ -123,8 +138,12 @@ async def main():
                 print("Ignoring empty camera frame.")
                 continue
 
+            # one trace per camera frame: gesture recognition, then the drive command
+            frame = tracer.start_span("camera frame") if tracer is not None else None
+
             # Process each frame for both gesture and position
-            horizontal, vertical, sound = detectAndProcessGesture(image)
+            with tracer.span("detectAndProcessGesture") if tracer is not None else nullcontext():
+                horizontal, vertical, sound = detectAndProcessGesture(image)
 
             # Determine the command to send based on the detected gesture
             if vertical != 0:
@@ -137,12 +156,14 @@ async def main():
             # Check if the command has changed
             if command != previous_command:
                 if command[0] == 'vertical':
-                    await infoProtocol(session, 0, command[1])
+                    await infoProtocol(session, 0, command[1], mailbox, tracer)
                 elif command[0] == 'horizontal':
-                    await infoProtocol(session, command[1], 0)
+                    await infoProtocol(session, command[1], 0, mailbox, tracer)
                 elif command[0] == 'stop':
-                    await infoProtocol(session, 0, 0)
+                    await infoProtocol(session, 0, 0, mailbox, tracer)
                 previous_command = command
+            if frame is not None:
+                frame.end()
 
             # Send sound command if sound gesture is detected
             if sound:
@@ -155,6 +176,22 @@ async def main():
 
     cap.release()
     cv2.destroyAllWindows()
+    if mailbox is not None:
+        await mailbox.close()
+    if tracer is not None:
+        tracer.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hand gesture client for robot_control.py")
+    parser.add_argument("--shm", nargs="?", const=DEFAULT_MAILBOX_PATH, default=None, metavar="PATH",
+                        help="write drive setpoints into the shared memory mailbox of robot_control.py --mailbox "
+                             "running on this machine")
+    parser.add_argument("--shm-vehicle", default="0",
+                        help="vehicle id (BLE address) or slot index in the mailbox")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write a span per camera frame and per drive command to a Chrome trace file and send "
+                             "a traceparent header with every POST /drive, see tracing.py")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
\ No newline at end of file
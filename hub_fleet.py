@@ -0,0 +1,193 @@
+# hub_fleet.py
+# Drive several LEGO Technic Move Hubs from one process and one event loop.
+#
+# One scan collects up to N matching hubs, then they are connected in parallel
+# (at most max_parallel at a time, BLE adapters do not like many simultaneous
+# connection attempts). Every hub gets its own background writer, so drive
+# and LED commands are handed over without waiting and a slow link only
+# delays its own car.
+
+import argparse
+import asyncio
+import time
+from bleak import BleakScanner
+from LEGO_Technic_42176_XBOX_RC import TechnicMoveHub
+
+
+class HubFleet:
+    def __init__(self, device_name="Technic Move", max_parallel=2, response=False, registry=None):
+        self.device_name = device_name
+        self.max_parallel = max_parallel
+        self.response = response
+        self.registry = registry
+        self.hubs = {} # hub id (BLE address) -> TechnicMoveHub
+
+    @property
+    def ids(self):
+        return list(self.hubs)
+
+    def __len__(self):
+        return len(self.hubs)
+
+    def __getitem__(self, hub_id):
+        return self.hubs[hub_id]
+
+    def __contains__(self, hub_id):
+        return hub_id in self.hubs
+
+    def add(self, hub, hub_id=None):
+        """
+        take over a hub that was connected elsewhere (e.g. with scan_and_connect)
+        hub_id defaults to its BLE address, returns the id
+        """
+        if hub_id is None:
+            hub_id = hub.client.address
+        self.hubs[hub_id] = hub
+        return hub_id
+
+    async def discover(self, count=None, timeout=10.0):
+        """
+        scan until `count` distinct hubs have been seen or `timeout` expires
+        returns the list of BLEDevices found
+        """
+        probe = TechnicMoveHub(self.device_name)
+        found = {}
+        enough = asyncio.Event()
+
+        def on_detect(device, advertisement_data):
+            if device.address in found or device.address in self.hubs:
+                return
+            if probe.matches(device, advertisement_data):
+                print(f"Found device: {device.name} with address: {device.address}")
+                found[device.address] = device
+                if count is not None and len(found) >= count:
+                    enough.set()
+
+        print(f"searching for {count if count else 'all'} Technic Move Hubs...")
+        async with BleakScanner(detection_callback=on_detect):
+            try:
+                await asyncio.wait_for(enough.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(found.values())
+
+    async def _connect_one(self, device, semaphore, calibrate):
+        hub = TechnicMoveHub(self.device_name, registry=self.registry)
+        try:
+            async with semaphore:
+                start = time.monotonic()
+                if not await hub.connect_device(device):
+                    return None
+                hub.connect_metrics["total_s"] = time.monotonic() - start
+                if self.registry is not None:
+                    self.registry.remember(device.address, device.name or self.device_name)
+            hub.start_writer(response=self.response)
+            if calibrate:
+                await hub.calibrate_steering()
+        except Exception:
+            # connect() leaves failed hubs out of the fleet, don't leave their writer or connection behind
+            await self._teardown(hub)
+            raise
+        return hub
+
+    async def _teardown(self, hub):
+        await hub.stop_writer(flush=False)
+        try:
+            await hub.disconnect()
+        except Exception as e:
+            print(f"Failed to disconnect {hub.device_name}: {e}")
+
+    async def connect(self, count=None, timeout=10.0, calibrate=True):
+        """
+        discover and connect up to `count` hubs, returns the ids of the connected ones
+        """
+        devices = await self.discover(count, timeout)
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        results = await asyncio.gather(*(self._connect_one(device, semaphore, calibrate) for device in devices),
+                                       return_exceptions=True)
+
+        connected = []
+        for device, result in zip(devices, results):
+            if isinstance(result, Exception):
+                print(f"Failed to connect to {device.address}: {result}")
+            elif result is not None:
+                self.hubs[device.address] = result
+                connected.append(device.address)
+        print(f"{len(connected)} of {len(devices)} hubs connected")
+        return connected
+
+    def _targets(self, hub_id):
+        if hub_id is None:
+            return list(self.hubs.values())
+        return [self.hubs[hub_id]]
+
+    def drive(self, speed=0, angle=0, lights=0x00, hub_id=None):
+        """
+        set the drive state of one hub, or of every hub when hub_id is None
+        returns immediately, each hub's writer sends its newest state
+        """
+        for hub in self._targets(hub_id):
+            hub.submit_drive(speed, angle, lights)
+
+    async def change_led_color(self, colorID, hub_id=None):
+        for hub in self._targets(hub_id):
+            await hub.change_led_color(colorID)
+
+    def stop(self, hub_id=None):
+        """brake one hub, or every hub when hub_id is None"""
+        for hub in self._targets(hub_id):
+            hub.submit_drive(0, 0, hub.LIGHTS_OFF_ON)
+
+    async def disconnect(self):
+        await asyncio.gather(*(hub.disconnect() for hub in self.hubs.values()), return_exceptions=True)
+        self.hubs.clear()
+
+    def stats(self):
+        """per hub: connection state, connect timings, link (GATT write) latency and writer stats"""
+        return {
+            hub_id: {
+                "name": hub.device_name,
+                "connected": hub.client is not None and hub.client.is_connected,
+                "connect": hub.connect_metrics,
+                "ble_writes": hub.write_metrics.as_dict(),
+                "writer": hub.writer_stats(),
+            }
+            for hub_id, hub in self.hubs.items()
+        }
+
+
+async def main(args):
+    fleet = HubFleet(max_parallel=args.parallel)
+    if not await fleet.connect(count=args.count, timeout=args.timeout):
+        print("No Technic hub found!")
+        return
+    try:
+        # wiggle the steering of every car so they can be told apart
+        for hub_id in fleet.ids:
+            print(f"steering {hub_id}")
+            fleet.drive(0, 60, hub_id=hub_id)
+            await asyncio.sleep(0.5)
+            fleet.drive(0, 0, hub_id=hub_id)
+        await asyncio.sleep(0.5)
+    finally:
+        for hub_id, hub_stats in fleet.stats().items():
+            print(hub_id, hub_stats)
+        await fleet.disconnect()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Connect to several LEGO Technic Move Hubs at once")
+    parser.add_argument("--count", type=int, default=None, help="number of hubs to connect (default: all found)")
+    parser.add_argument("--parallel", type=int, default=2, help="maximum concurrent connection attempts")
+    parser.add_argument("--timeout", type=float, default=10.0, help="scan timeout in seconds")
+    parser.add_argument("--simulate", type=int, default=0, metavar="N",
+                        help="use the in-process BLE simulator with N simulated hubs")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.simulate:
+        import ble_sim
+        ble_sim.install(ble_sim.default_world(hubs=args.simulate, droids=0))
+    asyncio.run(main(args))
@@ -0,0 +1,56 @@
+# hub_registry.py
+# On-disk registry of previously connected hubs (address, name, last seen).
+#
+# Used by TechnicMoveHub.scan_and_connect() to try a direct connection to the
+# last known address before falling back to a scan.
+
+import json
+import os
+import time
+
+DEFAULT_REGISTRY_PATH = os.path.join(os.path.expanduser("~"), ".technic_move_hubs.json")
+
+
+class HubRegistry:
+    def __init__(self, path=DEFAULT_REGISTRY_PATH):
+        self.path = path
+        self.hubs = {} # address -> {"address", "name", "last_seen"}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.hubs = json.load(f).get("hubs", {})
+        except FileNotFoundError:
+            self.hubs = {}
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable hub registry {self.path}: {e}")
+            self.hubs = {}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"hubs": self.hubs}, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save hub registry {self.path}: {e}")
+
+    def find(self, device_name):
+        """entries whose name contains device_name, most recently seen first"""
+        entries = [entry for entry in self.hubs.values()
+                   if entry.get("name") and device_name in entry["name"]]
+        return sorted(entries, key=lambda entry: entry.get("last_seen", 0), reverse=True)
+
+    def get(self, device_name):
+        """most recently seen entry matching device_name, or None"""
+        entries = self.find(device_name)
+        return entries[0] if entries else None
+
+    def remember(self, address, name):
+        self.hubs[address] = {"address": address, "name": name, "last_seen": time.time()}
+        self.save()
+
+    def forget(self, address):
+        if self.hubs.pop(address, None) is not None:
+            self.save()
@@ -0,0 +1,324 @@
+# hub_telemetry.py
+# Notification subscription layer for the LEGO Technic Move Hub.
+#
+# Upstream LEGO Wireless Protocol messages (hub properties, port values, port
+# output feedback, attached I/O and errors) are decoded into typed records as
+# they arrive. Each record kind goes into a fixed-size ring buffer that can be
+# consumed with `async for`, and the newest record per (kind, key) is kept in
+# a latest-value cache so closed-loop code can read sensor state without any
+# extra round trip to the hub.
+#
+# see https://lego.github.io/lego-ble-wireless-protocol-docs/
+
+import asyncio
+import struct
+import time
+from collections import deque, namedtuple
+from lwp_codec import encode_hub_property, encode_port_input_format
+
+# upstream message types
+MSG_HUB_PROPERTIES = 0x01
+MSG_HUB_ATTACHED_IO = 0x04
+MSG_GENERIC_ERROR = 0x05
+MSG_PORT_VALUE_SINGLE = 0x45
+MSG_PORT_VALUE_COMBINED = 0x46
+MSG_PORT_INPUT_FORMAT_SINGLE = 0x47
+MSG_PORT_OUTPUT_FEEDBACK = 0x82
+
+# hub property ids
+PROP_ADVERTISING_NAME = 0x01
+PROP_BUTTON = 0x02
+PROP_FW_VERSION = 0x03
+PROP_HW_VERSION = 0x04
+PROP_RSSI = 0x05
+PROP_BATTERY_VOLTAGE = 0x06
+PROP_BATTERY_TYPE = 0x07
+PROP_MANUFACTURER_NAME = 0x08
+PROP_RADIO_FW_VERSION = 0x09
+PROP_LWP_VERSION = 0x0A
+PROP_SYSTEM_TYPE_ID = 0x0B
+PROP_HW_NETWORK_ID = 0x0C
+PROP_PRIMARY_MAC = 0x0D
+PROP_SECONDARY_MAC = 0x0E
+PROP_HW_NETWORK_FAMILY = 0x0F
+
+HUB_PROP_OP_ENABLE_UPDATES = 0x02
+HUB_PROP_OP_DISABLE_UPDATES = 0x03
+HUB_PROP_OP_REQUEST_UPDATE = 0x05
+HUB_PROP_OP_UPDATE = 0x06
+
+# port output command feedback bits
+FEEDBACK_IN_PROGRESS = 0x01
+FEEDBACK_COMPLETED = 0x02
+FEEDBACK_DISCARDED = 0x04
+FEEDBACK_IDLE = 0x08
+FEEDBACK_BUSY = 0x10
+
+# record kinds, also the keys of HubTelemetry.buffers
+HUB_PROPERTY = "hub_property"
+PORT_VALUE = "port_value"
+PORT_FEEDBACK = "port_feedback"
+PORT_INPUT_FORMAT = "port_input_format"
+ATTACHED_IO = "attached_io"
+ERROR = "error"
+
+HubProperty = namedtuple("HubProperty", "timestamp property value")
+PortValue = namedtuple("PortValue", "timestamp port values raw")
+PortFeedback = namedtuple("PortFeedback", "timestamp port flags")
+PortInputFormat = namedtuple("PortInputFormat", "timestamp port mode delta notify")
+AttachedIO = namedtuple("AttachedIO", "timestamp port event io_type")
+GenericError = namedtuple("GenericError", "timestamp command code")
+
+_INT_PROPERTIES = {
+    PROP_BUTTON: "<B",
+    PROP_FW_VERSION: "<i",
+    PROP_HW_VERSION: "<i",
+    PROP_RSSI: "<b",
+    PROP_BATTERY_VOLTAGE: "<B",
+    PROP_BATTERY_TYPE: "<B",
+    PROP_LWP_VERSION: "<H",
+    PROP_SYSTEM_TYPE_ID: "<B",
+    PROP_HW_NETWORK_ID: "<B",
+    PROP_HW_NETWORK_FAMILY: "<B",
+}
+_STR_PROPERTIES = (PROP_ADVERTISING_NAME, PROP_MANUFACTURER_NAME, PROP_RADIO_FW_VERSION)
+_MAC_PROPERTIES = (PROP_PRIMARY_MAC, PROP_SECONDARY_MAC)
+
+
+def _decode_hub_property(prop, payload):
+    if prop in _INT_PROPERTIES:
+        return struct.unpack_from(_INT_PROPERTIES[prop], payload)[0]
+    if prop in _STR_PROPERTIES:
+        return bytes(payload).decode("utf-8", errors="replace")
+    if prop in _MAC_PROPERTIES:
+        return ":".join(f"{b:02X}" for b in payload)
+    return bytes(payload)
+
+
+def decode_message(data, port_formats=None, timestamp=None):
+    """
+    decode one upstream message into a (kind, key, record) tuple
+    port_formats maps port id -> struct format of that port's value (see HubTelemetry.subscribe_port)
+    returns None for message types that are not decoded
+    raises ValueError on truncated messages
+    """
+    if timestamp is None:
+        timestamp = time.monotonic()
+    if len(data) < 3:
+        raise ValueError(f"message too short: {bytes(data).hex()}")
+
+    # length is one byte, or two when the MSB of the first one is set
+    if data[0] & 0x80:
+        length = (data[0] & 0x7F) | (data[1] << 7)
+        offset = 2
+    else:
+        length = data[0]
+        offset = 1
+    if len(data) < length:
+        raise ValueError(f"truncated message, expected {length} bytes: {bytes(data).hex()}")
+
+    msg_type = data[offset + 1]
+    payload = memoryview(data)[offset + 2:length]
+
+    if msg_type == MSG_HUB_PROPERTIES:
+        prop, op = payload[0], payload[1]
+        if op != HUB_PROP_OP_UPDATE:
+            return None
+        return HUB_PROPERTY, prop, HubProperty(timestamp, prop, _decode_hub_property(prop, payload[2:]))
+
+    if msg_type == MSG_PORT_VALUE_SINGLE:
+        port = payload[0]
+        raw = bytes(payload[1:])
+        fmt = port_formats.get(port) if port_formats else None
+        values = None
+        if fmt is not None:
+            size = struct.calcsize(fmt)
+            values = tuple(v for off in range(0, len(raw) - size + 1, size)
+                           for v in struct.unpack_from(fmt, raw, off))
+        return PORT_VALUE, port, PortValue(timestamp, port, values, raw)
+
+    if msg_type == MSG_PORT_VALUE_COMBINED:
+        # mode pointer first, the values themselves depend on the combined modes set up
+        port = payload[0]
+        return PORT_VALUE, port, PortValue(timestamp, port, None, bytes(payload[1:]))
+
+    if msg_type == MSG_PORT_OUTPUT_FEEDBACK:
+        # may carry several (port, flags) pairs, the last one is returned,
+        # use decode_feedback() to get all of them
+        port, flags = payload[-2], payload[-1]
+        return PORT_FEEDBACK, port, PortFeedback(timestamp, port, flags)
+
+    if msg_type == MSG_PORT_INPUT_FORMAT_SINGLE:
+        port, mode = payload[0], payload[1]
+        delta, notify = struct.unpack_from("<IB", payload, 2)
+        return PORT_INPUT_FORMAT, port, PortInputFormat(timestamp, port, mode, delta, bool(notify))
+
+    if msg_type == MSG_HUB_ATTACHED_IO:
+        port, event = payload[0], payload[1]
+        io_type = struct.unpack_from("<H", payload, 2)[0] if event != 0 else None
+        return ATTACHED_IO, port, AttachedIO(timestamp, port, event, io_type)
+
+    if msg_type == MSG_GENERIC_ERROR:
+        return ERROR, payload[0], GenericError(timestamp, payload[0], payload[1])
+
+    return None
+
+
+def decode_feedback(data, timestamp=None):
+    """all (port, flags) pairs of a port output command feedback message"""
+    if timestamp is None:
+        timestamp = time.monotonic()
+    return [PortFeedback(timestamp, data[i], data[i + 1]) for i in range(3, len(data) - 1, 2)]
+
+
+class RingBuffer:
+    """
+    fixed-size buffer of the most recent records
+    `async for record in buffer` yields records appended after iteration starts;
+    a consumer that falls more than `capacity` records behind skips ahead and
+    the number of records it missed is counted in its `lost` attribute
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.total = 0 # sequence number of the newest record
+        self._items = deque(maxlen=capacity)
+        self._waiters = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(list(self._items))
+
+    def append(self, record):
+        self._items.append(record)
+        self.total += 1
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def latest(self):
+        return self._items[-1] if self._items else None
+
+    def get(self, seq):
+        """record by sequence number, None if it is not in the buffer any more"""
+        oldest = self.total - len(self._items) + 1
+        if seq < oldest or seq > self.total:
+            return None
+        return self._items[seq - oldest]
+
+    async def wait(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def __aiter__(self):
+        return RingBufferIterator(self)
+
+
+class RingBufferIterator:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.next_seq = buffer.total + 1
+        self.lost = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        buffer = self.buffer
+        while self.next_seq > buffer.total:
+            await buffer.wait()
+
+        oldest = buffer.total - len(buffer) + 1
+        if self.next_seq < oldest:
+            self.lost += oldest - self.next_seq
+            self.next_seq = oldest
+
+        record = buffer.get(self.next_seq)
+        self.next_seq += 1
+        return record
+
+
+class HubTelemetry:
+    KINDS = (HUB_PROPERTY, PORT_VALUE, PORT_FEEDBACK, PORT_INPUT_FORMAT, ATTACHED_IO, ERROR)
+
+    def __init__(self, hub, capacity=256):
+        """
+        hub: a connected TechnicMoveHub
+        capacity: number of records kept per kind
+        """
+        self.hub = hub
+        self.buffers = {kind: RingBuffer(capacity) for kind in self.KINDS}
+        self.latest = {}        # (kind, key) -> newest record
+        self.port_formats = {}  # port -> struct format of its values
+        self.received = 0
+        self.ignored = 0
+        self.malformed = 0
+        self.started = False
+
+    async def start(self):
+        await self.hub.client.start_notify(self.hub.char_uuid, self.handle_notification)
+        self.started = True
+
+    async def stop(self):
+        if self.started and self.hub.client is not None and self.hub.client.is_connected:
+            await self.hub.client.stop_notify(self.hub.char_uuid)
+        self.started = False
+
+    def handle_notification(self, sender, data):
+        self.received += 1
+        try:
+            decoded = decode_message(data, self.port_formats)
+        except (ValueError, IndexError, struct.error) as e:
+            self.malformed += 1
+            print(f"Malformed hub notification {bytes(data).hex()}: {e}")
+            return
+        if decoded is None:
+            self.ignored += 1
+            return
+
+        kind, key, record = decoded
+        if kind == PORT_FEEDBACK and len(data) > 5:
+            for feedback in decode_feedback(data, record.timestamp):
+                self._store(kind, feedback.port, feedback)
+            return
+        self._store(kind, key, record)
+
+    def _store(self, kind, key, record):
+        self.latest[(kind, key)] = record
+        self.buffers[kind].append(record)
+
+    def stream(self, kind):
+        """async iterator over new records of one kind"""
+        return aiter(self.buffers[kind])
+
+    def get_latest(self, kind, key):
+        return self.latest.get((kind, key))
+
+    def battery_level(self):
+        """battery charge in percent from the latest hub property update, None if not known yet"""
+        record = self.get_latest(HUB_PROPERTY, PROP_BATTERY_VOLTAGE)
+        return None if record is None else record.value
+
+    def port_value(self, port):
+        """latest decoded values of a port, None if not known yet"""
+        record = self.get_latest(PORT_VALUE, port)
+        return None if record is None else record.values
+
+    async def enable_hub_property(self, prop, enable=True):
+        op = HUB_PROP_OP_ENABLE_UPDATES if enable else HUB_PROP_OP_DISABLE_UPDATES
+        await self.hub.send_data(encode_hub_property(prop, op))
+
+    async def request_hub_property(self, prop):
+        await self.hub.send_data(encode_hub_property(prop, HUB_PROP_OP_REQUEST_UPDATE))
+
+    async def subscribe_port(self, port, mode, value_format="<h", delta=1, notify=True):
+        """
+        ask the hub to send the value of `port` in `mode` whenever it changes by `delta`
+        value_format is the struct format of one dataset of that mode, used to decode port values
+        """
+        self.port_formats[port] = value_format
+        await self.hub.send_data(encode_port_input_format(port, mode, delta, notify))
@@ -1,38 +1,29 @@
 import pygame
 import aiohttp
+import argparse
 import asyncio
-import time
+from contextlib import nullcontext
+from drive_channel import DriveChannelClient
+from setpoint_mailbox import DEFAULT_MAILBOX_PATH, MailboxClient
+from tracing import TRACEPARENT, Tracer
+from joystick_input import JoystickInput
+from response_curves import AxisMapping, g923_profile, xbox_profile
 
-def normalize(value):
-    if value == 0:
-        return 0
-    else:
-        return (-value + 1)/2
+G923 = g923_profile()
+XBOX = xbox_profile()
+LEFT_STICK_Y = AxisMapping(1, deadzone=0.03, invert=True)
+RIGHT_STICK_X = AxisMapping(2, deadzone=0.03)
 
-def ease_in_quad(x: float) -> float:
-    return x ** 2
+BRAKE_PULSE_S = 0.4 # how long a bumper press holds the brake frame
 
 def get_left_joystick(joystick):
-    x = round(joystick.get_axis(0)*100)
-    y = -round(joystick.get_axis(1)*100)
-    return (x,y)
+    return (XBOX.steering.read(joystick), LEFT_STICK_Y.read(joystick))
 
 def get_right_joystick(joystick):
-    x = round(joystick.get_axis(2)*100)
-    y = -round(joystick.get_axis(3)*100)
-    return (x,y)
+    return (RIGHT_STICK_X.read(joystick), XBOX.throttle.read(joystick))
 
 def get_steering_wheel(joystick):
-    steering = joystick.get_axis(0)
-    accelerator_pedal = normalize(joystick.get_axis(1))
-    break_pedal = normalize(joystick.get_axis(2))
-
-    if break_pedal > 0.1:
-        throttle = -ease_in_quad(break_pedal)
-    else:
-        throttle = ease_in_quad(accelerator_pedal)
-        
-    return round(steering*100), round(throttle*100)
+    return G923.map(joystick)
 
 def get_Y_button(joystick):
     return joystick.get_button(3)
@@ -43,11 +34,25 @@ def get_right_bumper(joystick):
 def get_sound_button(joystick):
     return joystick.get_button(4)  # Assuming button 4 is used for playing sounds
 
-async def send_request(session, url, json_data):
-    async with session.post(url, json=json_data) as response:
+async def send_request(session, url, json_data, headers=None):
+    async with session.post(url, json=json_data, headers=headers) as response:
         return await response.text()
 
-async def main():
+async def send_drive(session, channel, speed, angle, lights, tracer=None, brake=False):
+    # one binary websocket frame with --ws, a shared memory write with --shm, one JSON POST otherwise
+    # brake marks the brake pulse, so the server admits it past its rate limiter
+    # with --trace the POST carries a traceparent header, so the server continues the trace
+    span = tracer.span("send_drive", transport="channel" if channel is not None else "http") \
+        if tracer is not None else nullcontext()
+    with span:
+        if channel is not None:
+            await channel.send(speed, angle, lights)
+        else:
+            headers = {TRACEPARENT: span.traceparent()} if tracer is not None else None
+            await send_request(session, 'http://127.0.0.1:5000/drive',
+                               {"speed": speed, "angle": angle, "lights": lights, "brake": brake}, headers)
+
+async def main(args):
     pygame.init()
     pygame.joystick.init()
 
@@ -66,23 +71,44 @@ async def main():
     steering_old = 0
     lights_old = 0
     was_brake = False
+    braking = False
+    sound_old = False
+
+    inputs = JoystickInput(joystick)
+
+    def end_brake_pulse():
+        nonlocal braking
+        braking = False
+
+    tracer = Tracer(args.trace, "joystick_control") if args.trace else None
 
     async with aiohttp.ClientSession() as session:
+        channel = None
+        if args.shm:
+            channel = await MailboxClient(args.shm, args.shm_vehicle).connect()
+        elif args.ws:
+            channel = await DriveChannelClient(args.ws_url, session).connect()
         try:
             while True:
-                pygame.event.pump()
-
-                # steering, throttle = get_steering_wheel(joystick)
-                throttle = get_right_joystick(joystick)[1]
-                steering = get_left_joystick(joystick)[0]
+                # sleep until the controller state changes instead of polling it
+                if not await inputs.wait_changed(timeout=1.0):
+                    continue
+                state = inputs.snapshot
+                # one trace per controller change, starting at the pygame event
+                sample = tracer.start_span("joystick sample", start=state.timestamp, seq=state.seq) \
+                    if tracer is not None else None
+
+                # steering, throttle = get_steering_wheel(state)
+                throttle = get_right_joystick(state)[1]
+                steering = get_left_joystick(state)[0]
 
                 # Ensure values are within the range 0 to 100
                 # throttle = max(0, min(100, throttle))
                 # steering = max(0, min(100, steering))
 
-                brake = get_right_bumper(joystick)
-                toggle = get_Y_button(joystick)
-                sound_button = get_sound_button(joystick)
+                brake = get_right_bumper(state)
+                toggle = get_Y_button(state)
+                sound_button = get_sound_button(state)
                 
                 if toggle and not toggle_old:
                     if lights == 0:
@@ -95,34 +121,57 @@ async def main():
 
                 if brake and not was_brake:
                     joystick.rumble(0.0, 0.3, 300)
-                    await send_request(session, 'http://127.0.0.1:5000/drive', {"speed": 0, "angle": steering, "lights": 1})
-                    time.sleep(0.4)
+                    await send_drive(session, channel, 0, steering, 1, tracer, brake=True)
+                    # hold the brake frame without stalling the input loop
+                    braking = True
+                    asyncio.get_running_loop().call_later(BRAKE_PULSE_S, end_brake_pulse)
                     throttle = 0
                     throttle_old = 0
 
-                if not brake and was_brake:
-                    await send_request(session, 'http://127.0.0.1:5000/drive', {"speed": throttle, "angle": steering, "lights": lights})
+                if not brake and was_brake and not braking:
+                    await send_drive(session, channel, throttle, steering, lights, tracer)
 
                 was_brake = brake
 
-                # Send request only if there are significant changes
-                if abs(steering - steering_old) > 2 or abs(throttle - throttle_old) > 2 or lights != lights_old:
-                    print("throttle", throttle, "steering", steering)
-                    await send_request(session, 'http://127.0.0.1:5000/drive', {"speed": throttle, "angle": steering, "lights": lights})
+                # Send request only if there are significant changes, changes during the brake pulse wait for its end
+                if not braking:
+                    if abs(steering - steering_old) > 2 or abs(throttle - throttle_old) > 2 or lights != lights_old:
+                        print("throttle", throttle, "steering", steering)
+                        await send_drive(session, channel, throttle, steering, lights, tracer)
 
-                if sound_button:
-                    await send_request(session, 'http://127.0.0.1:5000/sounds', {"soundID": 1})  # Example sound ID
-
-                throttle_old = throttle
-                steering_old = steering
-                lights_old = lights
+                    throttle_old = throttle
+                    steering_old = steering
+                    lights_old = lights
 
-                await asyncio.sleep(0.1)  # Adjust the sleep time to reduce the frequency of requests
+                if sound_button and not sound_old:
+                    await send_request(session, 'http://127.0.0.1:5000/sounds', {"soundID": 1})  # Example sound ID
+                sound_old = sound_button
+                if sample is not None:
+                    sample.end()
 
         except KeyboardInterrupt:
             pass
         finally:
+            if channel is not None:
+                await channel.close()
+            if tracer is not None:
+                tracer.close()
             pygame.quit()
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Joystick client for robot_control.py")
+    parser.add_argument("--ws", action="store_true",
+                        help="stream drive setpoints as binary frames over the /ws/drive websocket")
+    parser.add_argument("--ws-url", default="ws://127.0.0.1:5000/ws/drive")
+    parser.add_argument("--shm", nargs="?", const=DEFAULT_MAILBOX_PATH, default=None, metavar="PATH",
+                        help="write drive setpoints into the shared memory mailbox of robot_control.py --mailbox "
+                             "running on this machine")
+    parser.add_argument("--shm-vehicle", default="0",
+                        help="vehicle id (BLE address) or slot index in the mailbox")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write a span per controller change and per send to a Chrome trace file and send a "
+                             "traceparent header with every POST /drive, see tracing.py")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
\ No newline at end of file
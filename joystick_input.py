@@ -0,0 +1,149 @@
+# joystick_input.py
+# Event-driven joystick input shared by the XBOX/G923 loop, joystick_control.py
+# and joystick_module.py.
+#
+# Instead of pumping pygame and reading every axis and button on each
+# iteration, JoystickInput waits for JOYAXISMOTION / JOYBUTTON* / JOYHATMOTION
+# events (with a timeout) and keeps a compact snapshot of the controller.
+# Axis values go through a change threshold, and subscribers are only called
+# when a value actually changes. Raw values are kept as they are: deadzones
+# depend on the kind of axis (raw 0 is mid travel on a pedal) and belong to
+# the per-axis AxisMapping.deadzone in response_curves.py.
+#
+# SDL expects its events to be pumped on the thread that initialised the
+# joystick, so wait_changed() polls on the event loop thread and sleeps a
+# short interval between polls instead of handing pygame to a worker thread.
+# Only joystick events are taken from the queue; every other event type is
+# left where it is for whatever else uses pygame (QUIT, window events, ...).
+
+import asyncio
+import time
+import pygame
+
+JOYSTICK_EVENTS = (pygame.JOYAXISMOTION, pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP,
+                   pygame.JOYHATMOTION, pygame.JOYDEVICEADDED, pygame.JOYDEVICEREMOVED)
+
+
+class InputSnapshot:
+    """
+    latest filtered state of one joystick
+    get_axis/get_button/get_hat mirror pygame.joystick.Joystick, so the mapping
+    helpers (get_steering_wheel, get_left_joystick, ...) accept a snapshot as is
+    """
+
+    __slots__ = ("axes", "buttons", "hats", "seq", "timestamp", "connected")
+
+    def __init__(self, axes, buttons, hats):
+        self.axes = axes
+        self.buttons = buttons
+        self.hats = hats
+        self.seq = 0          # incremented on every change
+        self.timestamp = 0.0  # monotonic time of the last change
+        self.connected = True
+
+    def get_axis(self, i):
+        return self.axes[i]
+
+    def get_button(self, i):
+        return self.buttons[i]
+
+    def get_hat(self, i):
+        return self.hats[i]
+
+    def get_numaxes(self):
+        return len(self.axes)
+
+    def get_numbuttons(self):
+        return len(self.buttons)
+
+
+class JoystickInput:
+    def __init__(self, joystick, threshold=0.01, interval=0.004):
+        """
+        joystick: an initialized pygame.joystick.Joystick
+        threshold: smallest axis change that counts as a change
+        interval: seconds between two polls while waiting, 4 ms is about the report rate of a USB controller
+        """
+        self.joystick = joystick
+        self.instance_id = joystick.get_instance_id()
+        self.threshold = threshold
+        self.interval = interval
+        self.events = 0
+        self._subscribers = []
+
+        self.snapshot = InputSnapshot(
+            [joystick.get_axis(i) for i in range(joystick.get_numaxes())],
+            [joystick.get_button(i) for i in range(joystick.get_numbuttons())],
+            [joystick.get_hat(i) for i in range(joystick.get_numhats())])
+
+    def subscribe(self, callback):
+        """callback(snapshot, changes) is called with a list of ("axis"|"button"|"hat", index, value)"""
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def _apply(self, event, changes):
+        if getattr(event, "instance_id", self.instance_id) != self.instance_id:
+            return
+        snapshot = self.snapshot
+
+        if event.type == pygame.JOYAXISMOTION:
+            value = event.value
+            old = snapshot.axes[event.axis]
+            # always let the axis settle exactly on 0 or its end stops
+            if abs(value - old) >= self.threshold or (value != old and (value == 0.0 or abs(value) >= 1.0)):
+                snapshot.axes[event.axis] = value
+                changes.append(("axis", event.axis, value))
+        elif event.type in (pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP):
+            value = 1 if event.type == pygame.JOYBUTTONDOWN else 0
+            if snapshot.buttons[event.button] != value:
+                snapshot.buttons[event.button] = value
+                changes.append(("button", event.button, value))
+        elif event.type == pygame.JOYHATMOTION:
+            if snapshot.hats[event.hat] != event.value:
+                snapshot.hats[event.hat] = event.value
+                changes.append(("hat", event.hat, event.value))
+        elif event.type == pygame.JOYDEVICEREMOVED:
+            snapshot.connected = False
+            changes.append(("device", self.instance_id, 0))
+
+    def poll(self, timeout_ms=0):
+        """
+        process pending joystick events, waiting up to timeout_ms for the first one
+        (0 returns at once); returns the list of changes, empty when nothing changed
+        best called from the thread that initialised the joystick, SDL pumps its events there
+        """
+        deadline = time.monotonic() + timeout_ms / 1000
+        while True:
+            # pumps SDL and takes only the joystick events, the other event types stay queued
+            events = pygame.event.get(JOYSTICK_EVENTS)
+            if events or time.monotonic() >= deadline:
+                break
+            time.sleep(self.interval)
+
+        changes = []
+        for event in events:
+            self.events += 1
+            self._apply(event, changes)
+
+        if changes:
+            self.snapshot.seq += 1
+            self.snapshot.timestamp = time.monotonic()
+            for callback in self._subscribers:
+                callback(self.snapshot, changes)
+        return changes
+
+    async def wait_changed(self, timeout=None):
+        """
+        wait without blocking the event loop until a filtered value changes
+        polls on the loop thread every `interval` seconds, returns the list of changes, empty on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changes = self.poll()
+            if changes or (deadline is not None and time.monotonic() >= deadline):
+                return changes
+            await asyncio.sleep(self.interval)
@@ -3,10 +3,10 @@ import pygame
 from fastapi import FastAPI
 from pydantic import BaseModel
 import threading
-import time
 import random
 from enum import Enum
 from itertools import product
+from joystick_input import JoystickInput
 
 app = FastAPI()
 
@@ -32,19 +32,25 @@ def init_joystick():
 
 def update_joystick_values(joystick):
     global joystick_values
-    while True:
-        pygame.event.pump()  # Update joystick state
+    inputs = JoystickInput(joystick)
+
+    def on_change(state, changes):
+        global joystick_values
         joystick_values = {
-            'steering': joystick.get_axis(0),  # Left stick horizontal axis
-            'accelerator_pedal': joystick.get_axis(5),  # Right trigger
-            'A_button': joystick.get_button(0),  # A button
-            'B_button': joystick.get_button(1),  # B button
-            'X_button': joystick.get_button(2),
-            'Y_button': joystick.get_button(3),
-            'left_bumper': joystick.get_button(4),
-            'right_bumper': joystick.get_button(5)
+            'steering': state.get_axis(0),  # Left stick horizontal axis
+            'accelerator_pedal': state.get_axis(5),  # Right trigger
+            'A_button': state.get_button(0),  # A button
+            'B_button': state.get_button(1),  # B button
+            'X_button': state.get_button(2),
+            'Y_button': state.get_button(3),
+            'left_bumper': state.get_button(4),
+            'right_bumper': state.get_button(5)
         }
-        time.sleep(0.1)  # Adjust the sleep time as needed
+
+    on_change(inputs.snapshot, [])
+    inputs.subscribe(on_change)
+    while True:
+        inputs.poll(timeout_ms=500)  # blocks until the joystick state changes
 
 joystick = init_joystick()
 joystick_thread = threading.Thread(target=update_joystick_values, args=(joystick,))
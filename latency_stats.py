@@ -0,0 +1,179 @@
+# latency_stats.py
+# Small running statistics helper shared by the control loop, hub writers and benchmarks.
+
+import math
+
+
+class RunningStats:
+    """
+    count, mean, min, max and standard deviation of a stream of samples
+    (Welford's algorithm, constant memory)
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.last = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.last = value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def stdev(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self.count - 1))
+
+    def as_dict(self, scale=1.0):
+        """summary dict, values multiplied by scale (e.g. 1000 for seconds -> ms)"""
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.mean * scale,
+            "min": self.min * scale,
+            "max": self.max * scale,
+            "stdev": self.stdev * scale,
+            "last": self.last * scale,
+        }
+
+
+def percentile(sorted_values, q):
+    """q-th percentile (0-100) of an already sorted list, linear interpolation"""
+    if not sorted_values:
+        return None
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    pos = (len(sorted_values) - 1) * q / 100.0
+    lower = int(pos)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+
+def summarize(samples, scale=1.0, percentiles=(50, 95, 99)):
+    """count, mean, min, max and percentiles of a list of samples, values multiplied by scale"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    summary = {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) * scale,
+        "min": ordered[0] * scale,
+        "max": ordered[-1] * scale,
+    }
+    for q in percentiles:
+        summary[f"p{q}"] = percentile(ordered, q) * scale
+    return summary
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies: log-linear buckets with a bounded
+    relative error (1/64 with the default 7 sub bucket bits), constant
+    memory and O(1) record(), so it can stay on for every request.
+    Values are in seconds and counted in `unit` steps (1 µs by default).
+    """
+
+    def __init__(self, unit=1e-6, highest=60.0, sub_bucket_bits=7):
+        self.unit = unit
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_count = self.sub_bucket_count // 2
+        self.highest_units = int(highest / unit)
+        self.counts = [0] * (self._index(self.highest_units) + 1)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, units):
+        if units < self.sub_bucket_count:
+            return units
+        shift = units.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.half_count + (units >> shift) - self.half_count
+
+    def _upper_bound(self, index):
+        """largest value (in units) that falls into bucket `index`"""
+        if index < self.sub_bucket_count:
+            return index
+        shift, sub = divmod(index - self.sub_bucket_count, self.half_count)
+        shift += 1
+        return ((sub + self.half_count + 1) << shift) - 1
+
+    def record(self, value):
+        units = int(value / self.unit)
+        if units < 0:
+            units = 0
+        elif units > self.highest_units:
+            units = self.highest_units
+        self.counts[self._index(units)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.unit != self.unit or len(other.counts) != len(self.counts):
+            raise ValueError("histograms must have the same layout to be merged")
+        for i, n in enumerate(other.counts):
+            if n:
+                self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def value_at_percentile(self, q):
+        """upper bound of the bucket holding the q-th percentile (0-100), in seconds"""
+        if self.count == 0:
+            return None
+        target = max(1, math.ceil(self.count * q / 100.0))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self._upper_bound(index) * self.unit, self.max)
+        return self.max
+
+    def buckets(self, scale=1.0):
+        """[(upper bound, count)] of the non-empty buckets, values multiplied by scale"""
+        return [(self._upper_bound(index) * self.unit * scale, n) for index, n in enumerate(self.counts) if n]
+
+    def as_dict(self, scale=1.0, percentiles=(50, 90, 95, 99, 99.9)):
+        """count, mean, min, max and percentiles, values multiplied by scale"""
+        if self.count == 0:
+            return {"count": 0}
+        summary = {
+            "count": self.count,
+            "mean": self.mean * scale,
+            "min": self.min * scale,
+            "max": self.max * scale,
+        }
+        for q in percentiles:
+            summary[f"p{q:g}"] = self.value_at_percentile(q) * scale
+        return summary
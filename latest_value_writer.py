@@ -0,0 +1,151 @@
+# latest_value_writer.py
+# Background writer that always sends the newest pending value.
+#
+# Callers hand values to submit() and return immediately. One task per link
+# writes them out at whatever pace the link accepts; a value submitted while
+# an older one is still waiting replaces it, so the link never falls behind
+# the input. Values that must not be coalesced (e.g. LED or calibration
+# commands) go through enqueue() and are written in order ahead of the
+# pending value.
+
+import asyncio
+import time
+from collections import deque
+from latency_stats import RunningStats
+
+
+class LatestValueWriter:
+    def __init__(self, write, name="writer"):
+        """
+        write: async callable taking a single value, raising on failure
+        """
+        self.write = write
+        self.name = name
+
+        self.seq = 0            # sequence number of the last submitted value
+        self.sent_seq = 0       # sequence number of the last value written
+        self.in_flight_seq = 0  # sequence number of the value being written, 0 for queued commands
+        self.sent = 0
+        self.superseded = 0
+        self.dropped = 0
+
+        self.write_latency = RunningStats() # seconds per successful write
+
+        self._queue = deque()
+        self._pending = None
+        self._pending_seq = 0
+        self._has_pending = False
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    @property
+    def pending(self):
+        return self._has_pending
+
+    @property
+    def queue_depth(self):
+        """values waiting to be written, queued commands plus the pending value"""
+        return len(self._queue) + int(self._has_pending)
+
+    def start(self):
+        """Start the writer task on the running event loop."""
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        if self._has_pending or self._queue:
+            self._wakeup.set()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name=self.name)
+
+    async def stop(self, flush=True):
+        """
+        Stop the writer. With flush, the write in flight and the pending value
+        are completed first; otherwise both are dropped.
+        """
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        if flush:
+            self._stopping = True
+            self._wakeup.set()
+            await task
+            return
+
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        if self._has_pending:
+            self._has_pending = False
+            self._pending = None
+            self.dropped += 1
+
+    def submit(self, value):
+        """Replace the pending value and wake the writer. Returns its sequence number."""
+        if self._has_pending:
+            self.superseded += 1
+        self.seq += 1
+        self._pending = value
+        self._pending_seq = self.seq
+        self._has_pending = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return self.seq
+
+    def enqueue(self, value):
+        """queue a value that is written in order and never superseded"""
+        self._queue.append(value)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stats(self):
+        return {
+            "submitted": self.seq,
+            "sent": self.sent,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "queue_depth": self.queue_depth,
+            "last_sent_seq": self.sent_seq,
+            "write_latency_ms": self.write_latency.as_dict(1000),
+        }
+
+    async def _write(self, value):
+        start = time.monotonic()
+        try:
+            await self.write(value)
+        except asyncio.CancelledError:
+            self.dropped += 1
+            raise
+        except Exception as e:
+            self.dropped += 1
+            print(f"{self.name}: failed to write: {e}")
+            return False
+        self.write_latency.add(time.monotonic() - start)
+        self.sent += 1
+        return True
+
+    async def _run(self):
+        while True:
+            if self._queue:
+                self.in_flight_seq = 0
+                await self._write(self._queue.popleft())
+            elif self._has_pending:
+                value, seq = self._pending, self._pending_seq
+                self._pending = None
+                self._has_pending = False
+                self.in_flight_seq = seq
+                if await self._write(value):
+                    self.sent_seq = seq
+            elif self._stopping:
+                return
+            else:
+                await self._wakeup.wait()
+                self._wakeup.clear()
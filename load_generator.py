@@ -0,0 +1,323 @@
+# load_generator.py
+# Load generator for robot_control.py and bb8_server.py: finds the request
+# rate at which a server starts degrading.
+#
+# Every concurrency level runs N virtual clients for --duration seconds.
+# Each client samples a joystick-like pattern at --client-rate and, like
+# joystick_control.py, POSTs /drive only when the setpoint changed by more
+# than 2. Now and then it POSTs /sounds. Clients are closed loop: a client
+# waits for its response, and ticks missed meanwhile are skipped and counted
+# as late. Patterns:
+#
+#   sweep  slow sine sweeps of throttle and steering
+#   hold   a setpoint held for 0.5-2 s, then a jump to a new one
+#   burst  holds broken up by 0.3 s of rapid full-stick jerks
+#   brake  sweep with a stop (speed 0) every few seconds
+#   mix    clients take turns over the patterns above
+#
+# Throughput, latency percentiles (HDR histogram), status codes and error
+# rates are reported per level and route. The first level that misses
+# --slo-p99 or --max-error-rate is reported as the knee. --spawn starts the
+# server on the simulated BLE transport:
+#
+#   python load_generator.py --spawn --server bb8_server --concurrency 1,4,16,64 --output load.json
+
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import time
+from latency_stats import LatencyHistogram
+from bench_latency import wait_for_port
+
+PATTERNS = ("sweep", "hold", "burst", "brake")
+
+
+class Pattern:
+    """joystick-like (speed, angle) over time, one instance per client"""
+
+    def __init__(self, kind, rng):
+        self.kind = kind
+        self.rng = rng
+        self.phase = rng.uniform(0, 2 * math.pi)
+        self.frequency = rng.uniform(0.2, 0.6)
+        self.value = (0, 0)
+        self.next_change = 0.0
+        self.burst_until = -1.0
+        self.next_brake = rng.uniform(2.0, 5.0)
+
+    def _random_setpoint(self):
+        return self.rng.randint(-100, 100), self.rng.randint(-100, 100)
+
+    def _sweep(self, t):
+        return (int(100 * math.sin(2 * math.pi * self.frequency * t + self.phase)),
+                int(100 * math.sin(2 * math.pi * self.frequency * 0.7 * t)))
+
+    def sample(self, t):
+        if self.kind == "sweep":
+            return self._sweep(t)
+
+        if self.kind == "brake":
+            if t >= self.next_brake:
+                if t < self.next_brake + 0.5:
+                    return 0, self._sweep(t)[1]
+                self.next_brake = t + self.rng.uniform(2.0, 5.0)
+            return self._sweep(t)
+
+        if self.kind == "burst":
+            if t < self.burst_until:
+                return self._random_setpoint()
+            if t >= self.next_change:
+                self.burst_until = t + 0.3
+                self.next_change = t + self.rng.uniform(1.0, 3.0)
+
+        # hold (and burst between its bursts)
+        if t >= self.next_change:
+            self.value = self._random_setpoint()
+            self.next_change = t + self.rng.uniform(0.5, 2.0)
+        return self.value
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.status = {}
+        self.latency = LatencyHistogram()
+
+    def record(self, status, elapsed):
+        self.requests += 1
+        self.status[status] = self.status.get(status, 0) + 1
+        if status != 200:
+            self.errors += 1
+        else:
+            self.latency.record(elapsed)
+
+    def as_dict(self, duration):
+        return {
+            "requests": self.requests,
+            "throughput_per_s": self.requests / duration,
+            "errors": self.errors,
+            "error_rate": self.errors / self.requests if self.requests else 0.0,
+            "status": {str(status): n for status, n in sorted(self.status.items(), key=str)},
+            "latency_ms": self.latency.as_dict(1000),
+        }
+
+
+class VirtualClient:
+    def __init__(self, index, url, server, pattern, rate_hz, sound_rate, seed):
+        self.index = index
+        self.url = url.rstrip("/")
+        self.server = server
+        self.rng = random.Random(seed * 100003 + index)
+        self.pattern = Pattern(pattern, self.rng)
+        self.rate_hz = rate_hz
+        self.sound_rate = sound_rate
+        self.ticks = 0
+        self.late_ticks = 0
+
+    def _drive_payload(self, speed, angle):
+        payload = {"speed": speed, "angle": angle}
+        if self.server == "robot_control":
+            payload["lights"] = 0
+        return payload
+
+    def _sound_payload(self):
+        if self.server == "robot_control":
+            return {"colorID": self.rng.randint(0, 10)}
+        return {"soundID": self.rng.randint(1, 4)}
+
+    async def _post(self, session, route, payload, routes):
+        start = time.perf_counter()
+        try:
+            async with session.post(self.url + route, json=payload) as response:
+                await response.read()
+                status = response.status
+        except asyncio.TimeoutError:
+            status = "timeout"
+        except Exception:
+            status = "error"
+        routes[route].record(status, time.perf_counter() - start)
+
+    async def run(self, session, start, duration, routes):
+        period = 1.0 / self.rate_hz
+        sound_probability = self.sound_rate * period
+        last_sent = None
+        tick = 0
+        while True:
+            deadline = start + tick * period
+            now = time.monotonic()
+            if deadline - start >= duration:
+                return
+            if deadline > now:
+                await asyncio.sleep(deadline - now)
+            self.ticks += 1
+
+            speed, angle = self.pattern.sample(deadline - start)
+            # same change filter as joystick_control.py, stops are always sent
+            if (last_sent is None or abs(speed - last_sent[0]) > 2 or abs(angle - last_sent[1]) > 2
+                    or (speed == 0 and last_sent[0] != 0)):
+                await self._post(session, "/drive", self._drive_payload(speed, angle), routes)
+                last_sent = (speed, angle)
+            if self.rng.random() < sound_probability:
+                await self._post(session, "/sounds", self._sound_payload(), routes)
+
+            # closed loop: ticks that passed while waiting for responses are skipped
+            next_tick = tick + 1
+            behind = int((time.monotonic() - start) / period)
+            if behind > next_tick:
+                self.late_ticks += behind - next_tick
+                next_tick = behind
+            tick = next_tick
+
+
+async def fetch_metrics(url):
+    import aiohttp
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url.rstrip("/") + "/metrics") as response:
+                return await response.json() if response.status == 200 else None
+    except Exception:
+        return None
+
+
+def ble_writes(server_metrics, server):
+    """total BLE writes the server reports in /metrics, None when unknown"""
+    if not server_metrics:
+        return None
+    if server == "robot_control":
+        return (server_metrics.get("hub") or {}).get("ble_writes", {}).get("writes")
+    return (server_metrics.get("droid") or {}).get("drive_writes", {}).get("writes")
+
+
+async def run_level(args, concurrency):
+    import aiohttp
+
+    routes = {"/drive": RouteStats(), "/sounds": RouteStats()}
+    patterns = PATTERNS if args.pattern == "mix" else (args.pattern,)
+    clients = [VirtualClient(i, args.url, args.server, patterns[i % len(patterns)], args.client_rate,
+                             args.sound_rate, args.seed) for i in range(concurrency)]
+
+    writes_before = ble_writes(await fetch_metrics(args.url), args.server)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    sessions = [aiohttp.ClientSession(timeout=timeout, headers={"X-Client-Id": f"load-{client.index}"})
+                for client in clients]
+    try:
+        start = time.monotonic() + 0.05
+        await asyncio.gather(*(client.run(session, start, args.duration, routes)
+                               for client, session in zip(clients, sessions)))
+        elapsed = time.monotonic() - start
+    finally:
+        await asyncio.gather(*(session.close() for session in sessions))
+    writes_after = ble_writes(await fetch_metrics(args.url), args.server)
+
+    total = RouteStats()
+    for stats in routes.values():
+        total.requests += stats.requests
+        total.errors += stats.errors
+        for status, n in stats.status.items():
+            total.status[status] = total.status.get(status, 0) + n
+        total.latency.merge(stats.latency)
+
+    ticks = sum(client.ticks for client in clients)
+    late = sum(client.late_ticks for client in clients)
+    return {
+        "concurrency": concurrency,
+        "duration_s": elapsed,
+        "total": total.as_dict(elapsed),
+        "routes": {route: stats.as_dict(elapsed) for route, stats in routes.items()},
+        "late_tick_ratio": late / max(1, ticks + late), # samples skipped while clients waited for responses
+        "ble_writes_per_s": None if writes_before is None or writes_after is None
+                            else (writes_after - writes_before) / elapsed,
+    }
+
+
+def degraded(result, slo_p99, max_error_rate):
+    total = result["total"]
+    p99 = total["latency_ms"].get("p99")
+    return total["error_rate"] > max_error_rate or (p99 is not None and p99 > slo_p99)
+
+
+async def main(args):
+    results = []
+    knee = None
+    for concurrency in args.concurrency:
+        result = await run_level(args, concurrency)
+        results.append(result)
+        total = result["total"]
+        latency = total["latency_ms"]
+        print(f"{concurrency:>5} clients  {total['throughput_per_s']:8.1f} req/s  p50 {latency.get('p50', 0):7.2f} ms  "
+              f"p99 {latency.get('p99', 0):7.2f} ms  p99.9 {latency.get('p99.9', 0):7.2f} ms  "
+              f"errors {total['error_rate'] * 100:5.1f} %", file=sys.stderr)
+        if knee is None and degraded(result, args.slo_p99, args.max_error_rate):
+            knee = concurrency
+            print(f"degraded at {concurrency} clients (p99 > {args.slo_p99} ms or errors > "
+                  f"{args.max_error_rate * 100:g} %)", file=sys.stderr)
+        await asyncio.sleep(args.pause)
+
+    return json.dumps({
+        "benchmark": "control_server_load",
+        "server": args.server,
+        "url": args.url,
+        "server_args": args.server_args,
+        "pattern": args.pattern,
+        "client_rate_hz": args.client_rate,
+        "sound_rate_per_s": args.sound_rate,
+        "slo": {"p99_ms": args.slo_p99, "max_error_rate": args.max_error_rate},
+        "knee_concurrency": knee,
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "results": results,
+    }, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate joystick-like load on robot_control.py or bb8_server.py")
+    parser.add_argument("--server", choices=("robot_control", "bb8_server"), default="robot_control")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="server base URL")
+    parser.add_argument("--spawn", action="store_true", help="start the server on the simulated BLE transport")
+    parser.add_argument("--server-args", default="",
+                        help="extra arguments for the spawned server, e.g. --server-args=\"--register --rate-limit\"")
+    parser.add_argument("--concurrency", type=lambda s: [int(n) for n in s.split(",")], default=[1, 2, 4, 8, 16, 32],
+                        help="comma separated numbers of concurrent clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per concurrency level")
+    parser.add_argument("--pause", type=float, default=1.0, help="seconds between levels, lets the server drain")
+    parser.add_argument("--pattern", choices=PATTERNS + ("mix",), default="mix")
+    parser.add_argument("--client-rate", type=float, default=50.0, help="joystick sample rate of every client in Hz")
+    parser.add_argument("--sound-rate", type=float, default=0.2, help="/sounds requests per second per client")
+    parser.add_argument("--timeout", type=float, default=5.0, help="request timeout in seconds")
+    parser.add_argument("--slo-p99", type=float, default=100.0, help="p99 latency in ms above which a level degrades")
+    parser.add_argument("--max-error-rate", type=float, default=0.01,
+                        help="error rate (non-200 answers, timeouts) above which a level degrades")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = None
+    if args.spawn:
+        server = subprocess.Popen([sys.executable, f"{args.server}.py", "--simulate"] + args.server_args.split(),
+                                  stdout=subprocess.DEVNULL)
+        if not wait_for_port(args.url):
+            server.terminate()
+            sys.exit(f"{args.server}.py did not start")
+    try:
+        stdout = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            report = asyncio.run(main(args))
+        print(report, file=stdout)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(report)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
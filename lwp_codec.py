@@ -0,0 +1,379 @@
+# lwp_codec.py
+# Downstream LEGO Wireless Protocol frames for the Technic Move Hub.
+#
+# Every downstream message type has an encode_* function returning bytes,
+# built from precompiled struct layouts. decode_downstream() turns a frame
+# back into a typed record, e.g. for logging or the codec microbenchmark
+# (bench_lwp_codec.py).
+#
+# The drive frame is sent on every input change, so DriveEncoder keeps two
+# preallocated frames and patches speed, angle and lights in place: encoding
+# a drive command allocates nothing. The inactive frame is only reused once
+# the writer has taken the active one, so a frame is never modified while a
+# write of it may still be in flight.
+#
+# see https://lego.github.io/lego-ble-wireless-protocol-docs/
+
+import struct
+from collections import namedtuple
+
+# downstream message types
+MSG_HUB_PROPERTIES = 0x01
+MSG_HUB_ACTIONS = 0x02
+MSG_HUB_ALERTS = 0x03
+MSG_PORT_INFORMATION_REQUEST = 0x21
+MSG_PORT_MODE_INFORMATION_REQUEST = 0x22
+MSG_PORT_INPUT_FORMAT_SETUP_SINGLE = 0x41
+MSG_PORT_INPUT_FORMAT_SETUP_COMBINED = 0x42
+MSG_VIRTUAL_PORT_SETUP = 0x61
+MSG_PORT_OUTPUT_COMMAND = 0x81
+
+# hub property operations
+HUB_PROP_OP_SET = 0x01
+HUB_PROP_OP_ENABLE_UPDATES = 0x02
+HUB_PROP_OP_DISABLE_UPDATES = 0x03
+HUB_PROP_OP_RESET = 0x04
+HUB_PROP_OP_REQUEST_UPDATE = 0x05
+
+# hub actions
+HUB_ACTION_SWITCH_OFF = 0x01
+HUB_ACTION_DISCONNECT = 0x02
+HUB_ACTION_VCC_PORT_CONTROL_ON = 0x03
+HUB_ACTION_VCC_PORT_CONTROL_OFF = 0x04
+HUB_ACTION_BUSY_INDICATION_ON = 0x05
+HUB_ACTION_BUSY_INDICATION_OFF = 0x06
+
+# hub alerts and their operations
+ALERT_LOW_VOLTAGE = 0x01
+ALERT_HIGH_CURRENT = 0x02
+ALERT_LOW_SIGNAL = 0x03
+ALERT_OVER_POWER = 0x04
+ALERT_OP_ENABLE_UPDATES = 0x01
+ALERT_OP_DISABLE_UPDATES = 0x02
+ALERT_OP_REQUEST_UPDATE = 0x03
+
+# port information types
+PORT_INFO_VALUE = 0x00
+PORT_INFO_MODE_INFO = 0x01
+PORT_INFO_POSSIBLE_COMBINATIONS = 0x02
+
+# virtual port setup
+VIRTUAL_PORT_DISCONNECT = 0x00
+VIRTUAL_PORT_CONNECT = 0x01
+
+# Technic Move Hub ports
+PORT_A = 0x32
+PORT_B = 0x33
+PORT_C = 0x34
+PORT_DRIVE = 0x36 # virtual drive port: speed, steering angle and lights in one command
+PORT_LED = 0x3F
+
+# port output startup / completion flags
+SC_BUFFER_NO_FEEDBACK = 0x00
+SC_BUFFER_FEEDBACK = 0x01
+SC_IMMEDIATE_NO_FEEDBACK = 0x10
+SC_IMMEDIATE_FEEDBACK = 0x11
+
+# port output sub commands
+OUT_START_POWER = 0x01
+OUT_START_POWER_DUAL = 0x02
+OUT_SET_ACC_TIME = 0x05
+OUT_SET_DEC_TIME = 0x06
+OUT_START_SPEED = 0x07
+OUT_START_SPEED_DUAL = 0x08
+OUT_START_SPEED_FOR_TIME = 0x09
+OUT_START_SPEED_FOR_DEGREES = 0x0B
+OUT_GOTO_ABSOLUTE_POSITION = 0x0D
+OUT_WRITE_DIRECT_MODE_DATA = 0x51
+
+# modes used with write direct mode data
+MOTOR_MODE_POWER = 0x00
+LED_MODE_COLOR = 0x00
+LED_MODE_RGB = 0x01
+DRIVE_MODE = 0x00
+DRIVE_COMMAND = 0x03
+
+# motor power values and end states
+POWER_FLOAT = 0
+POWER_BRAKE = 127
+END_STATE_FLOAT = 0
+END_STATE_HOLD = 126
+END_STATE_BRAKE = 127
+
+# acceleration / deceleration profile flags
+PROFILE_NONE = 0x00
+PROFILE_ACC = 0x01
+PROFILE_DEC = 0x02
+
+# lights byte of the drive command
+LIGHTS_ON_ON = 0b000
+LIGHTS_OFF_OFF = 0b100
+LIGHTS_OFF_ON = 0b101
+CALIBRATE_STEERING_START = 0x10
+CALIBRATE_STEERING_CENTER = 0x08
+
+_HEADER = struct.Struct("<BBB")
+_ONE_BYTE = struct.Struct("<BBBB")     # header + one byte argument
+_TWO_BYTES = struct.Struct("<BBBBB")
+_THREE_BYTES = struct.Struct("<BBBBBB")
+_PORT_INPUT_FORMAT = struct.Struct("<BBBBBIB")
+_DIRECT_MODE = struct.Struct("<BBBBBBBB")
+_DIRECT_MODE_INT8 = struct.Struct("<BBBBBBBb")
+_DIRECT_MODE_RGB = struct.Struct("<BBBBBBBBBB")
+_DRIVE = struct.Struct("<BBBBBBBBBbbBB")
+
+# output sub command payloads after the sub command byte
+_OUTPUT_PAYLOADS = {
+    OUT_START_POWER: struct.Struct("<b"),
+    OUT_START_POWER_DUAL: struct.Struct("<bb"),
+    OUT_SET_ACC_TIME: struct.Struct("<HB"),
+    OUT_SET_DEC_TIME: struct.Struct("<HB"),
+    OUT_START_SPEED: struct.Struct("<bBB"),
+    OUT_START_SPEED_DUAL: struct.Struct("<bbBB"),
+    OUT_START_SPEED_FOR_TIME: struct.Struct("<HbBBB"),
+    OUT_START_SPEED_FOR_DEGREES: struct.Struct("<ibBBB"),
+    OUT_GOTO_ABSOLUTE_POSITION: struct.Struct("<ibBBB"),
+}
+
+DRIVE_FRAME_LENGTH = _DRIVE.size
+
+
+def _int8(value):
+    """wrap like the original `value & 0xFF` byte literals did"""
+    return ((value + 128) & 0xFF) - 128
+
+
+def _frame(layout, msg_type, *fields):
+    return layout.pack(layout.size, 0x00, msg_type, *fields)
+
+
+# --- hub level messages ---
+
+def encode_hub_property(prop, op, payload=b""):
+    """payload is only used with HUB_PROP_OP_SET"""
+    if payload:
+        return bytes([5 + len(payload), 0x00, MSG_HUB_PROPERTIES, prop, op]) + bytes(payload)
+    return _frame(_TWO_BYTES, MSG_HUB_PROPERTIES, prop, op)
+
+
+def encode_hub_action(action):
+    return _frame(_ONE_BYTE, MSG_HUB_ACTIONS, action)
+
+
+def encode_hub_alert(alert, op):
+    return _frame(_TWO_BYTES, MSG_HUB_ALERTS, alert, op)
+
+
+def encode_port_information_request(port, info_type=PORT_INFO_MODE_INFO):
+    return _frame(_TWO_BYTES, MSG_PORT_INFORMATION_REQUEST, port, info_type)
+
+
+def encode_port_mode_information_request(port, mode, info_type):
+    return _frame(_THREE_BYTES, MSG_PORT_MODE_INFORMATION_REQUEST, port, mode, info_type)
+
+
+def encode_port_input_format(port, mode, delta=1, notify=True):
+    return _frame(_PORT_INPUT_FORMAT, MSG_PORT_INPUT_FORMAT_SETUP_SINGLE, port, mode, delta, 1 if notify else 0)
+
+
+def encode_port_input_format_combined(port, subcommand, payload=b""):
+    return bytes([5 + len(payload), 0x00, MSG_PORT_INPUT_FORMAT_SETUP_COMBINED, port, subcommand]) + bytes(payload)
+
+
+def encode_virtual_port_connect(port_a, port_b):
+    return _frame(_THREE_BYTES, MSG_VIRTUAL_PORT_SETUP, VIRTUAL_PORT_CONNECT, port_a, port_b)
+
+
+def encode_virtual_port_disconnect(port):
+    return _frame(_TWO_BYTES, MSG_VIRTUAL_PORT_SETUP, VIRTUAL_PORT_DISCONNECT, port)
+
+
+# --- port output commands ---
+
+def encode_port_output(port, subcommand, *args, flags=SC_IMMEDIATE_FEEDBACK):
+    """port output command with one of the OUT_* sub commands and its arguments"""
+    payload = _OUTPUT_PAYLOADS[subcommand].pack(*args)
+    return bytes([6 + len(payload), 0x00, MSG_PORT_OUTPUT_COMMAND, port, flags, subcommand]) + payload
+
+
+def encode_start_power(port, power, flags=SC_IMMEDIATE_FEEDBACK):
+    return encode_port_output(port, OUT_START_POWER, _int8(power), flags=flags)
+
+
+def encode_start_speed(port, speed, max_power=100, profile=PROFILE_NONE, flags=SC_IMMEDIATE_FEEDBACK):
+    return encode_port_output(port, OUT_START_SPEED, _int8(speed), max_power, profile, flags=flags)
+
+
+def encode_start_speed_for_time(port, time_ms, speed, max_power=100, end_state=END_STATE_BRAKE,
+                                profile=PROFILE_NONE, flags=SC_IMMEDIATE_FEEDBACK):
+    return encode_port_output(port, OUT_START_SPEED_FOR_TIME, time_ms, _int8(speed), max_power, end_state, profile,
+                              flags=flags)
+
+
+def encode_start_speed_for_degrees(port, degrees, speed, max_power=100, end_state=END_STATE_BRAKE,
+                                   profile=PROFILE_NONE, flags=SC_IMMEDIATE_FEEDBACK):
+    return encode_port_output(port, OUT_START_SPEED_FOR_DEGREES, degrees, _int8(speed), max_power, end_state, profile,
+                              flags=flags)
+
+
+def encode_goto_absolute_position(port, position, speed, max_power=100, end_state=END_STATE_BRAKE,
+                                  profile=PROFILE_NONE, flags=SC_IMMEDIATE_FEEDBACK):
+    return encode_port_output(port, OUT_GOTO_ABSOLUTE_POSITION, position, _int8(speed), max_power, end_state, profile,
+                              flags=flags)
+
+
+def encode_set_acc_time(port, time_ms, profile_id=0, flags=SC_IMMEDIATE_FEEDBACK):
+    return encode_port_output(port, OUT_SET_ACC_TIME, time_ms, profile_id, flags=flags)
+
+
+def encode_set_dec_time(port, time_ms, profile_id=0, flags=SC_IMMEDIATE_FEEDBACK):
+    return encode_port_output(port, OUT_SET_DEC_TIME, time_ms, profile_id, flags=flags)
+
+
+def encode_write_direct_mode(port, mode, payload, flags=SC_IMMEDIATE_FEEDBACK):
+    return bytes([7 + len(payload), 0x00, MSG_PORT_OUTPUT_COMMAND, port, flags, OUT_WRITE_DIRECT_MODE_DATA, mode]) \
+        + bytes(payload)
+
+
+def encode_motor_power(port, power, flags=SC_BUFFER_NO_FEEDBACK):
+    """power -100..100, POWER_FLOAT or POWER_BRAKE, through write direct mode data"""
+    return _frame(_DIRECT_MODE_INT8, MSG_PORT_OUTPUT_COMMAND, port, flags, OUT_WRITE_DIRECT_MODE_DATA,
+                  MOTOR_MODE_POWER, _int8(power))
+
+
+def encode_led_color(color_id, port=PORT_LED, flags=SC_IMMEDIATE_FEEDBACK):
+    return _frame(_DIRECT_MODE, MSG_PORT_OUTPUT_COMMAND, port, flags, OUT_WRITE_DIRECT_MODE_DATA,
+                  LED_MODE_COLOR, color_id & 0xFF)
+
+
+def encode_led_rgb(red, green, blue, port=PORT_LED, flags=SC_IMMEDIATE_FEEDBACK):
+    return _frame(_DIRECT_MODE_RGB, MSG_PORT_OUTPUT_COMMAND, port, flags, OUT_WRITE_DIRECT_MODE_DATA,
+                  LED_MODE_RGB, red & 0xFF, green & 0xFF, blue & 0xFF)
+
+
+def encode_drive(speed=0, angle=0, lights=LIGHTS_ON_ON, flags=SC_IMMEDIATE_FEEDBACK):
+    """a new drive frame, see DriveEncoder for the allocation free version"""
+    return _frame(_DRIVE, MSG_PORT_OUTPUT_COMMAND, PORT_DRIVE, flags, OUT_WRITE_DIRECT_MODE_DATA,
+                  DRIVE_MODE, DRIVE_COMMAND, 0x00, _int8(speed), _int8(angle), lights & 0xFF, 0x00)
+
+
+CALIBRATE_STEERING = (encode_drive(0, 0, CALIBRATE_STEERING_START),
+                      encode_drive(0, 0, CALIBRATE_STEERING_CENTER))
+
+
+class DriveEncoder:
+    """
+    two preallocated drive frames patched in place
+    encode() writes into the active frame, swap() makes the other one active
+    """
+
+    def __init__(self, flags=SC_IMMEDIATE_FEEDBACK):
+        self.frames = (bytearray(encode_drive(flags=flags)), bytearray(encode_drive(flags=flags)))
+        self.active = 0
+
+    @property
+    def frame(self):
+        return self.frames[self.active]
+
+    def swap(self):
+        self.active ^= 1
+        return self.frames[self.active]
+
+    def encode(self, speed=0, angle=0, lights=LIGHTS_ON_ON):
+        frame = self.frames[self.active]
+        # 0d 00 81 36 flags 51 00 03 00 speed angle lights 00
+        frame[9] = speed & 0xFF
+        frame[10] = angle & 0xFF
+        frame[11] = lights & 0xFF
+        return frame
+
+
+# --- decoder ---
+
+HubPropertyRequest = namedtuple("HubPropertyRequest", "property op payload")
+HubAction = namedtuple("HubAction", "action")
+HubAlertRequest = namedtuple("HubAlertRequest", "alert op")
+PortInformationRequest = namedtuple("PortInformationRequest", "port info_type")
+PortModeInformationRequest = namedtuple("PortModeInformationRequest", "port mode info_type")
+PortInputFormatSetup = namedtuple("PortInputFormatSetup", "port mode delta notify")
+PortInputFormatSetupCombined = namedtuple("PortInputFormatSetupCombined", "port subcommand payload")
+VirtualPortSetup = namedtuple("VirtualPortSetup", "connect ports")
+PortOutputCommand = namedtuple("PortOutputCommand", "port flags subcommand args")
+WriteDirectMode = namedtuple("WriteDirectMode", "port flags mode payload")
+DriveCommand = namedtuple("DriveCommand", "flags speed angle lights")
+
+# smallest body (after the 3 byte header) of every downstream message type
+_MIN_BODY = {
+    MSG_HUB_PROPERTIES: 2,
+    MSG_HUB_ACTIONS: 1,
+    MSG_HUB_ALERTS: 2,
+    MSG_PORT_INFORMATION_REQUEST: 2,
+    MSG_PORT_MODE_INFORMATION_REQUEST: 3,
+    MSG_PORT_INPUT_FORMAT_SETUP_SINGLE: _PORT_INPUT_FORMAT.size - _HEADER.size,
+    MSG_PORT_INPUT_FORMAT_SETUP_COMBINED: 2,
+    MSG_VIRTUAL_PORT_SETUP: 2,
+    MSG_PORT_OUTPUT_COMMAND: 3,
+}
+
+
+def _truncated(data):
+    return ValueError(f"frame too short for its message type: {bytes(data).hex()}")
+
+
+def decode_downstream(data):
+    """
+    decode one downstream frame into one of the records above
+    raises ValueError for malformed or unknown frames
+    """
+    if len(data) < 3:
+        raise ValueError(f"frame too short: {bytes(data).hex()}")
+    length, _, msg_type = _HEADER.unpack_from(data)
+    if length != len(data):
+        raise ValueError(f"length byte {length} does not match frame length {len(data)}: {bytes(data).hex()}")
+    body = memoryview(data)[3:]
+    min_body = _MIN_BODY.get(msg_type)
+    if min_body is None:
+        raise ValueError(f"unknown downstream message type 0x{msg_type:02x}")
+    if len(body) < min_body:
+        raise _truncated(data)
+
+    if msg_type == MSG_HUB_PROPERTIES:
+        return HubPropertyRequest(body[0], body[1], bytes(body[2:]))
+    if msg_type == MSG_HUB_ACTIONS:
+        return HubAction(body[0])
+    if msg_type == MSG_HUB_ALERTS:
+        return HubAlertRequest(body[0], body[1])
+    if msg_type == MSG_PORT_INFORMATION_REQUEST:
+        return PortInformationRequest(body[0], body[1])
+    if msg_type == MSG_PORT_MODE_INFORMATION_REQUEST:
+        return PortModeInformationRequest(body[0], body[1], body[2])
+    if msg_type == MSG_PORT_INPUT_FORMAT_SETUP_SINGLE:
+        port, mode, delta, notify = struct.unpack_from("<BBIB", body)
+        return PortInputFormatSetup(port, mode, delta, bool(notify))
+    if msg_type == MSG_PORT_INPUT_FORMAT_SETUP_COMBINED:
+        return PortInputFormatSetupCombined(body[0], body[1], bytes(body[2:]))
+    if msg_type == MSG_VIRTUAL_PORT_SETUP:
+        if body[0] == VIRTUAL_PORT_CONNECT:
+            if len(body) < 3:
+                raise _truncated(data)
+            return VirtualPortSetup(True, (body[1], body[2]))
+        return VirtualPortSetup(False, (body[1],))
+    return _decode_port_output(data, body)
+
+
+def _decode_port_output(data, body):
+    port, flags, subcommand = body[0], body[1], body[2]
+    if subcommand == OUT_WRITE_DIRECT_MODE_DATA:
+        if len(body) < 4:
+            raise _truncated(data)
+        mode = body[3]
+        if port == PORT_DRIVE and mode == DRIVE_MODE and len(data) == DRIVE_FRAME_LENGTH and body[4] == DRIVE_COMMAND:
+            _, _, _, _, _, _, _, _, _, speed, angle, lights, _ = _DRIVE.unpack(data)
+            return DriveCommand(flags, speed, angle, lights)
+        return WriteDirectMode(port, flags, mode, bytes(body[4:]))
+    layout = _OUTPUT_PAYLOADS.get(subcommand)
+    if layout is None:
+        return PortOutputCommand(port, flags, subcommand, (bytes(body[3:]),))
+    if len(body) < 3 + layout.size:
+        raise _truncated(data)
+    return PortOutputCommand(port, flags, subcommand, layout.unpack_from(body, 3))
@@ -0,0 +1,136 @@
+# metrics.py
+# Request and BLE metrics for the control servers (GET /metrics in
+# robot_control.py and bb8_server.py).
+#
+# A middleware times every HTTP request with a monotonic clock and records
+# it per route (method + route template) into request / error counters and
+# an HDR-style latency histogram. Servers add BLE write latency, command
+# rates and connection state through extra providers. Nothing is printed per
+# request unless verbose is set.
+
+import time
+from collections import deque
+from latency_stats import LatencyHistogram
+
+
+class RateMeter:
+    """events per second over a sliding window"""
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self.total = 0
+        self._events = deque()
+
+    def mark(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.total += 1
+        self._events.append(now)
+        self._trim(now)
+
+    def _trim(self, now):
+        cutoff = now - self.window
+        events = self._events
+        while events and events[0] < cutoff:
+            events.popleft()
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._trim(now)
+        return len(self._events) / self.window
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = LatencyHistogram()
+        self.status = {}
+
+    def record(self, elapsed, status):
+        self.requests += 1
+        if status >= 400:
+            self.errors += 1
+        self.status[status] = self.status.get(status, 0) + 1
+        self.latency.record(elapsed)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "status": {str(code): n for code, n in sorted(self.status.items())},
+            "latency_ms": self.latency.as_dict(1000),
+        }
+
+
+class Metrics:
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.started = time.monotonic()
+        self.routes = {}     # "POST /drive" -> RouteMetrics
+        self.providers = {}  # name -> callable returning a dict, evaluated on every /metrics
+
+    def route(self, name):
+        metrics = self.routes.get(name)
+        if metrics is None:
+            metrics = self.routes[name] = RouteMetrics()
+        return metrics
+
+    def record(self, name, elapsed, status):
+        self.route(name).record(elapsed, status)
+        if self.verbose:
+            print(f"{name} processed in {elapsed:.4f} seconds")
+
+    def add_provider(self, name, provider):
+        self.providers[name] = provider
+
+    def install(self, app):
+        """time every HTTP request of a FastAPI / Starlette app"""
+
+        @app.middleware("http")
+        async def record_request(request, call_next):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await call_next(request)
+                status = response.status_code
+                return response
+            finally:
+                route = request.scope.get("route")
+                path = getattr(route, "path", None) or "unmatched"
+                self.record(f"{request.method} {path}", time.perf_counter() - start, status)
+
+    def as_dict(self):
+        report = {
+            "uptime_s": time.monotonic() - self.started,
+            "routes": {name: route.as_dict() for name, route in sorted(self.routes.items())},
+        }
+        for name, provider in self.providers.items():
+            try:
+                report[name] = provider()
+            except Exception as e:
+                report[name] = {"error": str(e)}
+        return report
+
+
+class WriteMetrics:
+    """BLE write latency histogram, commands per second and failures of one link"""
+
+    def __init__(self, window=5.0):
+        self.latency = LatencyHistogram()
+        self.rate = RateMeter(window)
+        self.failures = 0
+
+    def record(self, elapsed, ok=True):
+        if not ok:
+            self.failures += 1
+            return
+        self.latency.record(elapsed)
+        self.rate.mark()
+
+    def as_dict(self):
+        return {
+            "writes": self.rate.total,
+            "failures": self.failures,
+            "commands_per_s": self.rate.rate(),
+            "latency_ms": self.latency.as_dict(1000),
+        }
@@ -0,0 +1,182 @@
+# rate_limit.py
+# Admission control for the control servers (--rate-limit in robot_control.py
+# and bb8_server.py).
+#
+# Every BLE link can only take so many writes per second. WriteBudget turns
+# the measured write latency of a link into that budget. A RateLimiter gives
+# every route a share of it, with one token bucket per route (all clients)
+# and one per client and route. A request costs as many tokens as the BLE
+# writes it triggers. A request that finds either bucket empty is answered
+# at once with 429 and a Retry-After, instead of queueing behind the radio.
+# Priority requests (stop / brake) are always admitted; they still use up
+# tokens, so the requests after them are throttled.
+
+import math
+import time
+from collections import namedtuple
+
+# cost: BLE writes one request triggers
+# share: fraction of the link's write budget the route may use, over all clients
+RouteLimit = namedtuple("RouteLimit", "cost share")
+
+
+def is_stop(speed, angle, brake=False):
+    """
+    priority setpoints: a stop (speed and angle 0) or a brake pulse the client marked as one (speed 0)
+    steering at a standstill is not a stop, it is limited like any other setpoint
+    """
+    return speed == 0 and (angle == 0 or brake)
+
+
+class WriteBudget:
+    def __init__(self, write_metrics, writes_per_sample=1, default=50.0, headroom=0.8, minimum=5.0, maximum=100.0,
+                 min_samples=20, fixed=None):
+        """
+        BLE writes per second a link can take, from its measured write latency
+        write_metrics: metrics.WriteMetrics of the link
+        writes_per_sample: BLE writes covered by one recorded sample (e.g. 2 for both motors of a droid)
+        default: budget until min_samples writes were measured
+        headroom: fraction of the measured capacity handed out
+        fixed: use this budget instead of measuring
+        """
+        self.write_metrics = write_metrics
+        self.writes_per_sample = writes_per_sample
+        self.default = default
+        self.headroom = headroom
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_samples = min_samples
+        self.fixed = fixed
+
+    def __call__(self):
+        if self.fixed is not None:
+            return self.fixed
+        latency = self.write_metrics.latency
+        if latency.count < self.min_samples or latency.mean <= 0:
+            return self.default
+        per_write = latency.mean / self.writes_per_sample
+        return max(self.minimum, min(self.maximum, self.headroom / per_write))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost, now, force=False):
+        """
+        take `cost` tokens, returns 0.0 when they were taken, otherwise the seconds until they would be there
+        with force the tokens are taken (down to 0) in any case
+        """
+        self.refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        if force:
+            self.tokens = 0.0
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def give(self, cost):
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+
+class RateLimiter:
+    def __init__(self, budget, routes, burst=0.25, client_share=0.5, idle_timeout=60.0):
+        """
+        budget: callable returning the link's write budget in writes per second (e.g. a WriteBudget)
+        routes: route name -> RouteLimit; routes not listed are not limited
+        burst: seconds of budget a bucket holds, so short bursts pass
+        client_share: fraction of a route's share one client may use
+        idle_timeout: seconds after which an idle client's buckets are forgotten
+        """
+        self.budget = budget
+        self.routes = routes
+        self.burst = burst
+        self.client_share = client_share
+        self.idle_timeout = idle_timeout
+        self._route_buckets = {}
+        self._client_buckets = {} # (client, route) -> TokenBucket
+        self.counts = {route: {"admitted": 0, "rejected": 0, "bypassed": 0} for route in routes}
+        self.rejected_clients = {}
+
+    def _bucket(self, buckets, key, rate, cost, now):
+        capacity = max(cost, rate * self.burst)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, capacity, now)
+        else:
+            # the budget follows the measured link, earlier tokens are refilled at the old rate
+            bucket.refill(now)
+            bucket.rate = rate
+            bucket.capacity = capacity
+        return bucket
+
+    def _forget_idle(self, now):
+        cutoff = now - self.idle_timeout
+        for key in [key for key, bucket in self._client_buckets.items() if bucket.updated < cutoff]:
+            del self._client_buckets[key]
+
+    def check(self, client, route, priority=False, now=None):
+        """
+        admit one request of `client` on `route`
+        returns 0.0 when admitted, otherwise the seconds after which it would be
+        """
+        limit = self.routes.get(route)
+        if limit is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        if len(self._client_buckets) > 256:
+            self._forget_idle(now)
+
+        rate = self.budget() * limit.share
+        route_bucket = self._bucket(self._route_buckets, route, rate, limit.cost, now)
+        client_bucket = self._bucket(self._client_buckets, (client, route), rate * self.client_share, limit.cost, now)
+        counts = self.counts[route]
+
+        if priority:
+            client_bucket.take(limit.cost, now, force=True)
+            route_bucket.take(limit.cost, now, force=True)
+            counts["bypassed"] += 1
+            return 0.0
+
+        wait = client_bucket.take(limit.cost, now)
+        if not wait:
+            wait = route_bucket.take(limit.cost, now)
+            if wait:
+                client_bucket.give(limit.cost)
+        if wait:
+            counts["rejected"] += 1
+            self.rejected_clients[client] = self.rejected_clients.get(client, 0) + 1
+            return wait
+        counts["admitted"] += 1
+        return 0.0
+
+    def reject(self, request, route, priority=False):
+        """
+        check a FastAPI / Starlette request, returns None when admitted and a 429 response otherwise
+        clients are told apart by an X-Client-Id header, falling back to their address
+        """
+        from fastapi.responses import JSONResponse
+
+        client = request.headers.get("x-client-id") or (request.client.host if request.client else "unknown")
+        wait = self.check(client, route, priority)
+        if not wait:
+            return None
+        return JSONResponse({"status": "error", "message": f"rate limit exceeded on {route}", "retry_after": wait},
+                            status_code=429, headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+    def stats(self):
+        return {
+            "budget_writes_per_s": self.budget(),
+            "routes": {route: dict(counts, rate_per_s=self.budget() * self.routes[route].share / self.routes[route].cost)
+                       for route, counts in self.counts.items()},
+            "rejected_clients": dict(self.rejected_clients),
+            "clients": len({client for client, _ in self._client_buckets}),
+        }
@@ -0,0 +1,292 @@
+# response_curves.py
+# Throttle / steering response curves compiled into integer lookup tables.
+#
+# An AxisMapping combines a raw joystick axis (-1 to 1), a named curve, a
+# deadzone and a clamp. compile() evaluates all of that once into a table
+# indexed by the quantized raw value, so mapping an axis on every poll is a
+# single table lookup instead of floating point math and rounding.
+#
+# A Profile bundles the axis mappings of one controller (G923 wheel and
+# pedals, XBOX sticks) and can be swapped at runtime. User curves and
+# profiles can be loaded from a JSON config. A curve is either a list of
+# [x, y] points (linear in between) or a power:
+#
+#   {
+#     "curves": {
+#       "soft": [[0, 0], [0.5, 0.15], [1, 1]],
+#       "cubic": {"power": 3}
+#     },
+#     "profiles": {
+#       "wheel_soft": {
+#         "mapping": "wheel",
+#         "steering": {"axis": 0, "curve": "soft", "deadzone": 0.03},
+#         "throttle": {"axis": 1, "curve": "cubic", "kind": "pedal"},
+#         "brake": {"axis": 2, "curve": "quad", "kind": "pedal", "deadzone": 0.1}
+#       }
+#     }
+#   }
+
+import bisect
+import json
+
+RESOLUTION = 2048 # table steps per half axis, the table has 2 * RESOLUTION + 1 entries
+
+AXIS_SIGNED = "signed"       # -1..1 -> -clamp..clamp, curve applied to |value| (sticks, wheel)
+AXIS_UNIPOLAR = "unipolar"   # -1..1 -> 0..clamp (triggers)
+AXIS_PEDAL = "pedal"         # 1..-1 -> 0..clamp, raw 0 reads as released (G923 pedals)
+
+MAPPING_WHEEL = "wheel" # steering + accelerator + brake pedal, brake has priority
+MAPPING_STICK = "stick" # steering + signed throttle axis
+
+
+def normalize(value):
+    """
+    input -1 to 1
+    return 0 to 1
+    """
+    if value == 0:
+        return 0
+    else:
+        return (-value + 1)/2
+
+def linear(x: float) -> float:
+    return x
+
+def ease_in_expo(x: float) -> float:
+    """ https://easings.net/#easeInExpo """
+    if x == 0:
+        return 0
+    return 2 ** (10 * x - 10)
+
+def ease_in_quart(x: float) -> float:
+    """ https://easings.net/#easeInQuart """
+    return x ** 4
+
+def ease_in_quad(x: float) -> float:
+    """ https://easings.net/#easeInQuad """
+    return x ** 2
+
+
+CURVES = {
+    "linear": linear,
+    "quad": ease_in_quad,
+    "quart": ease_in_quart,
+    "expo": ease_in_expo,
+}
+
+
+def power_curve(exponent):
+    def curve(x):
+        return x ** exponent
+    return curve
+
+
+def point_curve(points):
+    """piecewise linear curve through [(x, y), ...] with x and y in 0..1"""
+    points = sorted((float(x), float(y)) for x, y in points)
+    if len(points) < 2:
+        raise ValueError("a point curve needs at least two points")
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+
+    def curve(x):
+        if x <= xs[0]:
+            return ys[0]
+        if x >= xs[-1]:
+            return ys[-1]
+        i = bisect.bisect_right(xs, x)
+        x0, x1, y0, y1 = xs[i - 1], xs[i], ys[i - 1], ys[i]
+        return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+    return curve
+
+
+def register_curve(name, spec):
+    """
+    add a user curve: a callable, a list of [x, y] points or {"power": p}
+    """
+    if callable(spec):
+        curve = spec
+    elif isinstance(spec, dict) and "power" in spec:
+        curve = power_curve(float(spec["power"]))
+    elif isinstance(spec, (list, tuple)):
+        curve = point_curve(spec)
+    else:
+        raise ValueError(f"unsupported curve definition for {name!r}: {spec!r}")
+    CURVES[name] = curve
+    return curve
+
+
+class AxisMapping:
+    def __init__(self, axis, curve="linear", deadzone=0.0, clamp=100, invert=False, kind=AXIS_SIGNED,
+                 min_output=0):
+        """
+        axis: joystick axis index
+        curve: name in CURVES, maps 0..1 to 0..1
+        deadzone: inputs (0..1, before the curve) below this map to 0
+        clamp: output range, the result is an int in -clamp..clamp (0..clamp for unipolar/pedal)
+        invert: flip the direction of the axis
+        kind: AXIS_SIGNED, AXIS_UNIPOLAR or AXIS_PEDAL
+        min_output: outputs smaller than this (after the curve) map to 0
+        """
+        if curve not in CURVES:
+            raise ValueError(f"unknown curve {curve!r}, known curves: {', '.join(CURVES)}")
+        if kind not in (AXIS_SIGNED, AXIS_UNIPOLAR, AXIS_PEDAL):
+            raise ValueError(f"unknown axis kind {kind!r}")
+        self.axis = axis
+        self.curve = curve
+        self.deadzone = deadzone
+        self.clamp = clamp
+        self.invert = invert
+        self.kind = kind
+        self.min_output = min_output
+        self.table = self.compile()
+        # whether the axis is pressed past its deadzone, before min_output zeroes small outputs
+        self.engaged = [self._magnitude(i / RESOLUTION - 1)[0] >= max(self.deadzone, 1e-9)
+                        for i in range(2 * RESOLUTION + 1)]
+        # pygame reports an exact 0 until a pedal has been moved once
+        self.rest = 0 if kind == AXIS_PEDAL else self._evaluate(0.0)
+
+    def _magnitude(self, raw):
+        """raw axis value -> (magnitude 0..1, sign)"""
+        if self.invert:
+            raw = -raw
+        if self.kind == AXIS_SIGNED:
+            return abs(raw), -1 if raw < 0 else 1
+        elif self.kind == AXIS_UNIPOLAR:
+            return (raw + 1) / 2, 1
+        return (1 - raw) / 2, 1
+
+    def _evaluate(self, raw):
+        curve = CURVES[self.curve]
+        magnitude, sign = self._magnitude(raw)
+        if magnitude < self.deadzone:
+            return 0
+        value = max(0, min(self.clamp, round(curve(magnitude) * self.clamp)))
+        if value < self.min_output:
+            return 0
+        return sign * value
+
+    def compile(self):
+        return [self._evaluate(i / RESOLUTION - 1) for i in range(2 * RESOLUTION + 1)]
+
+    def __call__(self, raw):
+        """raw axis value (-1 to 1) -> int"""
+        return self.table[int((raw + 1.0) * RESOLUTION + 0.5)] if raw else self.rest
+
+    def read(self, joystick):
+        return self(joystick.get_axis(self.axis))
+
+    def to_dict(self):
+        return {"axis": self.axis, "curve": self.curve, "deadzone": self.deadzone,
+                "clamp": self.clamp, "invert": self.invert, "kind": self.kind,
+                "min_output": self.min_output}
+
+
+class Profile:
+    def __init__(self, name, steering, throttle, brake=None, mapping=MAPPING_STICK):
+        """
+        steering, throttle, brake: AxisMapping
+        mapping: MAPPING_WHEEL (throttle is the accelerator pedal, brake pedal
+                 has priority and drives backwards) or MAPPING_STICK
+        """
+        if mapping == MAPPING_WHEEL and brake is None:
+            raise ValueError("a wheel profile needs a brake axis")
+        if mapping == MAPPING_STICK:
+            brake = None
+        self.name = name
+        self.steering = steering
+        self.throttle = throttle
+        self.brake = brake
+        self.mapping = mapping
+
+    def map(self, joystick):
+        """returns (steering, throttle) as ints"""
+        get_axis = joystick.get_axis
+        steering = self.steering
+        raw = get_axis(steering.axis)
+        steering = steering.table[int((raw + 1.0) * RESOLUTION + 0.5)] if raw else steering.rest
+        brake = self.brake
+        if brake is not None:
+            raw = get_axis(brake.axis)
+            # priority is decided on the raw pedal: a light press that min_output maps to 0 still holds the throttle at 0
+            if raw:
+                index = int((raw + 1.0) * RESOLUTION + 0.5)
+                if brake.engaged[index]:
+                    return steering, -brake.table[index]
+        throttle = self.throttle
+        raw = get_axis(throttle.axis)
+        return steering, throttle.table[int((raw + 1.0) * RESOLUTION + 0.5)] if raw else throttle.rest
+
+    @classmethod
+    def from_dict(cls, name, config):
+        def axis(key):
+            return AxisMapping(**config[key]) if key in config else None
+        return cls(name, axis("steering"), axis("throttle"), axis("brake"), config.get("mapping", MAPPING_STICK))
+
+    def to_dict(self):
+        config = {"mapping": self.mapping, "steering": self.steering.to_dict(), "throttle": self.throttle.to_dict()}
+        if self.brake is not None:
+            config["brake"] = self.brake.to_dict()
+        return config
+
+
+def g923_profile(min_output=0):
+    # G923 Racing Wheel for PlayStation and PC
+    return Profile("g923",
+                   steering=AxisMapping(0, "linear", deadzone=0.03, min_output=min_output),  # volante
+                   throttle=AxisMapping(1, "quad", kind=AXIS_PEDAL, min_output=min_output),  # acelerador
+                   brake=AxisMapping(2, "quad", deadzone=0.1, kind=AXIS_PEDAL,               # freio, priority
+                                     min_output=min_output),
+                   mapping=MAPPING_WHEEL)
+
+
+def xbox_profile(min_output=0):
+    # left stick steers, right stick drives
+    return Profile("xbox",
+                   steering=AxisMapping(0, "linear", deadzone=0.03, min_output=min_output),
+                   throttle=AxisMapping(3, "linear", deadzone=0.03, invert=True, min_output=min_output),
+                   mapping=MAPPING_STICK)
+
+
+class ProfileSet:
+    """named profiles with one active, swap() and cycle() change it at runtime"""
+
+    def __init__(self, profiles, active=None):
+        self.profiles = {profile.name: profile for profile in profiles}
+        self.active = self.profiles[active] if active else next(iter(self.profiles.values()))
+
+    def add(self, profile):
+        self.profiles[profile.name] = profile
+
+    def swap(self, name):
+        if name not in self.profiles:
+            raise KeyError(f"unknown profile {name!r}, known profiles: {', '.join(self.profiles)}")
+        self.active = self.profiles[name]
+        return self.active
+
+    def cycle(self):
+        names = list(self.profiles)
+        return self.swap(names[(names.index(self.active.name) + 1) % len(names)])
+
+    def map(self, joystick):
+        return self.active.map(joystick)
+
+
+def load_config(path, profiles=None):
+    """
+    register the curves and build the profiles defined in a JSON config file
+    returns the list of profiles, added to `profiles` (a ProfileSet) if given
+    """
+    with open(path, "r") as f:
+        config = json.load(f)
+    for name, spec in config.get("curves", {}).items():
+        register_curve(name, spec)
+    loaded = [Profile.from_dict(name, spec) for name, spec in config.get("profiles", {}).items()]
+    if profiles is not None:
+        for profile in loaded:
+            profiles.add(profile)
+    return loaded
+
+
+def default_profiles(min_output=0, active="g923"):
+    return ProfileSet([g923_profile(min_output), xbox_profile(min_output)], active=active)
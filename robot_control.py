@@ -1,77 +1,389 @@
 # robot_control.py
 
-from flask import Flask, request, jsonify
-import asyncio
-import time
-import signal
-import sys
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import List, Tuple, Union
+import argparse
 from LEGO_Technic_42176_XBOX_RC import TechnicMoveHub
+from hub_fleet import HubFleet
+from drive_channel import DriveFrameFilter
+from latest_value_writer import LatestValueWriter
+from drive_sequence import SequenceRunner
+from metrics import Metrics
+from setpoint_mailbox import DEFAULT_MAILBOX_PATH, MailboxReader, SetpointMailbox
+from rate_limit import RateLimiter, RouteLimit, WriteBudget, is_stop
+from tracing import Tracer
 
-app = Flask(__name__)
-hub = None
+hub = None   # the vehicle behind /drive, /drive/sequence, /sounds and /ws/drive
+fleet = None # every connected vehicle, /vehicles/{id}/...
+sequences = None
+register_mode = False # --register: /drive stores the setpoint and returns before it is written
+vehicle_count = 0     # --vehicles N: connect N hubs, each with its own background writer
+mailbox_path = None   # --mailbox: shared memory setpoint slots for local clients, see setpoint_mailbox.py
+mailbox_reader = None
+rate_limit = None     # --rate-limit: RateLimiter settings, one limiter per vehicle link
+rate_limits = {}      # TechnicMoveHub -> RateLimiter
+tracer = None         # --trace: spans of requests that carry a traceparent header and of their BLE writes
+
+# BLE writes per request and share of a link's write budget per route
+ROUTE_LIMITS = {
+    "drive": RouteLimit(cost=1, share=1.0),
+    "lights": RouteLimit(cost=1, share=0.25),
+    "sequence": RouteLimit(cost=1, share=0.1),
+}
+metrics = Metrics() # --verbose prints every request's time
+ws_frames = {"connections": 0, "open": 0, "accepted": 0, "out_of_order": 0, "stale": 0, "malformed": 0}
+
+@asynccontextmanager
+async def lifespan(app):
+    # the hub is connected on the server's event loop, so every request
+    # reuses the same BleakClient without any loop handoff
+    global hub, fleet, sequences, mailbox_reader
+    device_name = "Technic Move"  # Replace with your BLE device's name
+    fleet = HubFleet(device_name, response=False)
+    if vehicle_count:
+        # every hub gets its own writer, so a slow link only delays its own car
+        ids = await fleet.connect(count=vehicle_count)
+        if not ids:
+            fleet = None
+            raise RuntimeError("Technic hub not found!")
+        hub = fleet[ids[0]]
+    else:
+        hub = TechnicMoveHub(device_name)
+        if not await hub.scan_and_connect():
+            hub = fleet = None
+            raise RuntimeError("Technic hub not found!")
+
+        await hub.calibrate_steering()
+        if register_mode:
+            # one writer per hub flushes the newest setpoint at the link's pace
+            hub.start_writer(response=False)
+        fleet.add(hub)
+    sequences = SequenceRunner(hub.drive)
+    print(f"{len(fleet)} hub(s) connected and calibrated")
+    if tracer is not None:
+        for hub_id in fleet.ids:
+            fleet[hub_id].tracer = tracer
+    mailbox_writers = []
+    if mailbox_path:
+        mailbox = SetpointMailbox.create(fleet.ids, mailbox_path)
+        # like /ws/drive: one writer per vehicle keeps only its newest setpoint while a write is in flight
+        for hub_id in fleet.ids:
+            vehicle = fleet[hub_id]
+            writer = LatestValueWriter(lambda setpoint, vehicle=vehicle: manual_drive(vehicle, setpoint),
+                                       name=f"mailbox {hub_id} writer")
+            writer.start()
+            mailbox_writers.append(writer)
+        mailbox_reader = MailboxReader(mailbox, lambda slot, setpoint: mailbox_writers[slot].submit(
+            (max(-100, min(100, setpoint.speed)), max(-100, min(100, setpoint.angle)), max(0, min(1, setpoint.lights)))))
+        mailbox_reader.start()
+        print(f"setpoint mailbox at {mailbox_path}: {', '.join(fleet.ids)}")
+    if rate_limit is not None:
+        for hub_id in fleet.ids:
+            vehicle = fleet[hub_id]
+            budget = WriteBudget(vehicle.write_metrics, fixed=rate_limit["budget"])
+            rate_limits[vehicle] = RateLimiter(budget, ROUTE_LIMITS, rate_limit["burst"], rate_limit["client_share"])
+    try:
+        yield
+    finally:
+        print("Shutting down.")
+        if mailbox_reader is not None:
+            await mailbox_reader.stop()
+            for writer in mailbox_writers:
+                await writer.stop()
+            mailbox_reader.mailbox.unlink()
+            mailbox_reader.mailbox.close()
+            mailbox_reader = None
+        await sequences.cancel()
+        await fleet.disconnect()
+        rate_limits.clear()
+        hub = fleet = None
+        if tracer is not None:
+            tracer.close()
+
+app = FastAPI(lifespan=lifespan)
+metrics.install(app)
+
+def hub_metrics():
+    if hub is None:
+        return {"connected": False}
+    return {
+        "connected": hub.client is not None and hub.client.is_connected,
+        "connect": hub.connect_metrics,
+        "ble_writes": hub.write_metrics.as_dict(),
+        "writer": hub.writer_stats(),
+    }
+
+metrics.add_provider("hub", hub_metrics)
+metrics.add_provider("ws_drive", lambda: ws_frames)
+metrics.add_provider("vehicles", lambda: fleet.stats() if fleet is not None else {})
+metrics.add_provider("rate_limit", lambda: {hub_id: rate_limits[fleet[hub_id]].stats()
+                                             for hub_id in (fleet.ids if fleet is not None else [])
+                                             if fleet[hub_id] in rate_limits})
+metrics.add_provider("mailbox", lambda: mailbox_reader.stats() if mailbox_reader is not None else None)
+
+async def manual_drive(vehicle, setpoint):
+    # /ws/drive and mailbox setpoints take over from a running sequence, like /drive
+    if vehicle is hub and sequences is not None and sequences.running:
+        await sequences.cancel(stop=False)
+    await vehicle.drive(*setpoint)
+
+def rate_limited(request, vehicle, route, priority=False):
+    # None when the request may go on, a 429 response when the vehicle's link budget is used up
+    limiter = rate_limits.get(vehicle)
+    if limiter is None:
+        return None
+    return limiter.reject(request, route, priority)
 
 # Expected ranges for POST data:
 # speed: -100 to 100
 # angle: -100 to 100
 # lights: 0 to 1 (assuming binary state for lights, adjust if different)
-@app.route('/drive', methods=['POST'])
-async def drive():
-    start_time = time.time()
-    try:
-        data = request.json
-        speed = data.get('speed', 0)
-        angle = data.get('angle', 0)
-        lights = data.get('lights', 0)
+class DriveRequest(BaseModel):
+    speed: int = 0
+    angle: int = 0
+    lights: int = 0
+    brake: bool = False # brake pulse (speed 0), admitted past the rate limiter like a stop
+
+class LightsRequest(BaseModel):
+    colorID: int = 0
+
+# a step is either {"offset_ms": .., "speed": .., "angle": .., "lights": ..}
+# or [offset_ms, speed, angle, lights]; offsets are relative to the start
+class SequenceStep(BaseModel):
+    offset_ms: float
+    speed: int = 0
+    angle: int = 0
+    lights: int = 0
+
+class SequenceRequest(BaseModel):
+    steps: List[Union[SequenceStep, Tuple[float, int, int, int]]]
+    replace: bool = True # replace a running sequence instead of answering 409
 
+@app.post('/drive')
+async def drive(data: DriveRequest, request: Request):
+    try:
         # Ensure values are within the range -100 to 100
-        speed = max(-100, min(100, speed))
-        angle = max(-100, min(100, angle))
-        lights = max(0, min(1, lights))
+        speed = max(-100, min(100, data.speed))
+        angle = max(-100, min(100, data.angle))
+        lights = max(0, min(1, data.lights))
 
         if hub is None:
             raise Exception("Hub is not initialized")
+        # stop / brake setpoints are never rate limited
+        rejected = rate_limited(request, hub, "drive", priority=is_stop(speed, angle, data.brake))
+        if rejected is not None:
+            return rejected
+        # a manual setpoint takes over from a running sequence
+        await sequences.cancel(stop=False)
+        if register_mode:
+            seq = hub.submit_drive(speed, angle, lights)
+            return {"status": "success", "seq": seq}
         await hub.drive(speed, angle, lights)
-        response_time = time.time() - start_time
-        print(f"/drive endpoint processed in {response_time:.4f} seconds")
-        return jsonify({"status": "success"})
+        return {"status": "success"}
     except Exception as e:
         print(f"Error in /drive endpoint: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+@app.get('/vehicles')
+async def vehicles():
+    # connection state, connect timings and link (GATT write) latency of every vehicle
+    if fleet is None:
+        return JSONResponse({"status": "error", "message": "Hub is not initialized"}, status_code=500)
+    return {"status": "success", "primary": next((hub_id for hub_id in fleet.ids if fleet[hub_id] is hub), None),
+            "vehicles": fleet.stats()}
+
+def get_vehicle(vehicle_id):
+    if fleet is None or vehicle_id not in fleet:
+        return None
+    return fleet[vehicle_id]
+
+@app.post('/vehicles/{vehicle_id}/drive')
+async def vehicle_drive(vehicle_id: str, data: DriveRequest, request: Request):
+    # with a background writer (--vehicles, --register) this only hands the
+    # setpoint over, otherwise it waits for this vehicle's own write
+    vehicle = get_vehicle(vehicle_id)
+    if vehicle is None:
+        return JSONResponse({"status": "error", "message": f"no such vehicle: {vehicle_id}"}, status_code=404)
+    try:
+        speed = max(-100, min(100, data.speed))
+        angle = max(-100, min(100, data.angle))
+        lights = max(0, min(1, data.lights))
+
+        rejected = rate_limited(request, vehicle, "drive", priority=is_stop(speed, angle, data.brake))
+        if rejected is not None:
+            return rejected
+        if vehicle is hub:
+            await sequences.cancel(stop=False)
+        if vehicle.writer is not None and vehicle.writer.running:
+            seq = vehicle.submit_drive(speed, angle, lights)
+            return {"status": "success", "seq": seq}
+        await vehicle.drive(speed, angle, lights)
+        return {"status": "success"}
+    except Exception as e:
+        print(f"Error in /vehicles/{vehicle_id}/drive endpoint: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
 
-@app.route('/sounds', methods=['POST'])
-async def change_lights():
-    start_time = time.time()
+@app.post('/vehicles/{vehicle_id}/lights')
+async def vehicle_lights(vehicle_id: str, data: LightsRequest, request: Request):
+    vehicle = get_vehicle(vehicle_id)
+    if vehicle is None:
+        return JSONResponse({"status": "error", "message": f"no such vehicle: {vehicle_id}"}, status_code=404)
+    try:
+        rejected = rate_limited(request, vehicle, "lights")
+        if rejected is not None:
+            return rejected
+        await vehicle.change_led_color(data.colorID)
+        return {"status": "success"}
+    except Exception as e:
+        print(f"Error in /vehicles/{vehicle_id}/lights endpoint: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+@app.get('/metrics')
+async def get_metrics():
+    # per route request/error counts and latency histograms, BLE writes, connection state
+    return metrics.as_dict()
+
+@app.get('/stats')
+async def stats():
+    # with --register: queue depth, superseded (coalesced) setpoints and write latency of the hub writer
+    if hub is None:
+        return JSONResponse({"status": "error", "message": "Hub is not initialized"}, status_code=500)
+    return {"status": "success", "register": register_mode, "writer": hub.writer_stats()}
+
+@app.post('/drive/sequence')
+async def start_sequence(data: SequenceRequest, request: Request):
     try:
-        data = request.json
-        colorID = data.get('colorID', 0)
         if hub is None:
             raise Exception("Hub is not initialized")
-        await hub.change_led_color(colorID)
-        response_time = time.time() - start_time
-        print(f"/lights endpoint processed in {response_time:.4f} seconds")
-        return jsonify({"status": "success"})
+        rejected = rate_limited(request, hub, "sequence")
+        if rejected is not None:
+            return rejected
+        if sequences.running and not data.replace:
+            return JSONResponse({"status": "error", "message": "a sequence is already running"}, status_code=409)
+        steps = []
+        for step in data.steps:
+            if isinstance(step, SequenceStep):
+                step = (step.offset_ms, step.speed, step.angle, step.lights)
+            offset_ms, speed, angle, lights = step
+            steps.append((offset_ms, max(-100, min(100, speed)), max(-100, min(100, angle)), max(0, min(1, lights))))
+        sequence = await sequences.start(steps)
+        return {"status": "success", "sequence": sequence.id}
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
     except Exception as e:
-        print(f"Error in /lights endpoint: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        print(f"Error in /drive/sequence endpoint: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
 
-async def main():
-    global hub
-    device_name = "Technic Move"  # Replace with your BLE device's name
-    hub = TechnicMoveHub(device_name)
-    if not await hub.scan_and_connect():
-        print("Technic hub not found!")
-        return
+@app.get('/drive/sequence')
+async def sequence_status(id: Union[int, None] = None):
+    # latest sequence, or the one given by ?id=, with per-step timing errors
+    sequence = sequences.get(id) if sequences is not None else None
+    if sequence is None:
+        return JSONResponse({"status": "error", "message": "no such sequence"}, status_code=404)
+    return {"status": "success", "sequence": sequence.report()}
+
+@app.delete('/drive/sequence')
+async def cancel_sequence():
+    sequence = await sequences.cancel() if sequences is not None else None
+    if sequence is None:
+        return {"status": "success", "sequence": None}
+    return {"status": "success", "sequence": sequence.report()}
 
-    await hub.calibrate_steering()
-    print("Hub connected and calibrated")
-    app.run(host='0.0.0.0', port=5000)  # Ensure the server is listening on all interfaces
+@app.post('/sounds')
+async def change_lights(data: LightsRequest, request: Request):
+    try:
+        if hub is None:
+            raise Exception("Hub is not initialized")
+        rejected = rate_limited(request, hub, "lights")
+        if rejected is not None:
+            return rejected
+        await hub.change_led_color(data.colorID)
+        return {"status": "success"}
+    except Exception as e:
+        print(f"Error in /lights endpoint: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+@app.websocket('/ws/drive')
+async def drive_channel(websocket: WebSocket):
+    # binary setpoint stream, see drive_channel.py; frames are not answered
+    # setpoints can arrive faster than the hub accepts writes, so only the
+    # newest one is kept while a write is in flight
+    await websocket.accept()
+    frames = DriveFrameFilter()
+    ws_frames["connections"] += 1
+    ws_frames["open"] += 1
+    writer = LatestValueWriter(lambda setpoint: manual_drive(hub, setpoint), name="/ws/drive writer")
+    writer.start()
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is None:
+                # text frames are not setpoints
+                frames.malformed += 1
+                continue
+            frame = frames.accept(message["bytes"])
+            if frame is None or hub is None:
+                continue
+            speed = max(-100, min(100, frame.speed))
+            angle = max(-100, min(100, frame.angle))
+            lights = max(0, min(1, frame.lights))
+            writer.submit((speed, angle, lights))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await writer.stop()
+        ws_frames["open"] -= 1
+        for key in ("accepted", "out_of_order", "stale", "malformed"):
+            ws_frames[key] += getattr(frames, key)
+        if metrics.verbose:
+            print(f"/ws/drive closed: {frames.stats()} writer: {writer.stats()}")
 
-def signal_handler(sig, frame):
-    print("Interrupt received, stopping...")
-    if hub is not None:
-        asyncio.run(hub.disconnect())
-    sys.exit(0)
+def parse_args():
+    parser = argparse.ArgumentParser(description="HTTP control server for the LEGO Technic Move Hub")
+    parser.add_argument("--simulate", action="store_true",
+                        help="use the in-process BLE simulator (ble_sim.py) instead of a real hub")
+    parser.add_argument("--register", action="store_true",
+                        help="/drive only stores the newest setpoint and answers at once with its sequence number; "
+                             "a background writer sends it to the hub")
+    parser.add_argument("--vehicles", type=int, default=0, metavar="N",
+                        help="connect up to N hubs for /vehicles/{id}/...; /drive and friends use the first one")
+    parser.add_argument("--mailbox", nargs="?", const=DEFAULT_MAILBOX_PATH, default=None, metavar="PATH",
+                        help="also read setpoints from a shared memory mailbox for clients on this machine "
+                             f"(joystick_control.py --shm), default path {DEFAULT_MAILBOX_PATH}")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="answer 429 when a client or route exceeds its share of the hub's BLE write budget; "
+                             "stops (speed and angle 0) and brake pulses (\"brake\": true, speed 0) always pass")
+    parser.add_argument("--rate-budget", type=float, default=None, metavar="WRITES_PER_S",
+                        help="fixed BLE write budget per hub instead of the one measured from write latency")
+    parser.add_argument("--rate-burst", type=float, default=0.25, metavar="SECONDS",
+                        help="seconds of budget a token bucket holds")
+    parser.add_argument("--client-share", type=float, default=0.5,
+                        help="fraction of a route's budget a single client may use")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write spans of traced requests (traceparent header) and their BLE writes "
+                             "to a Chrome trace file, see tracing.py")
+    parser.add_argument("--verbose", action="store_true", help="print the processing time of every request")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGINT, signal_handler)
-    asyncio.run(main())
\ No newline at end of file
+    import uvicorn
+    args = parse_args()
+    register_mode = args.register
+    vehicle_count = args.vehicles
+    mailbox_path = args.mailbox
+    if args.trace:
+        tracer = Tracer(args.trace, "robot_control")
+        tracer.install(app)
+    if args.rate_limit:
+        rate_limit = {"budget": args.rate_budget, "burst": args.rate_burst, "client_share": args.client_share}
+    metrics.verbose = args.verbose
+    if args.simulate:
+        import ble_sim
+        ble_sim.install(ble_sim.default_world(hubs=max(1, args.vehicles)))
+    # Ctrl+C is handled by uvicorn, which runs the lifespan shutdown (disconnect)
+    uvicorn.run(app, host='0.0.0.0', port=5000, access_log=args.verbose)  # Ensure the server is listening on all interfaces
@@ -0,0 +1,302 @@
+# setpoint_mailbox.py
+# Shared memory setpoint mailbox for clients on the same machine as
+# robot_control.py (--mailbox on the server, --shm on the clients).
+#
+# The server creates a memory mapped file with one slot per vehicle. A client
+# writes speed/angle/lights into its vehicle's slot, the server polls every
+# slot and hands a changed setpoint to that vehicle's writer. Neither side
+# makes a syscall per setpoint: both only read and write the mapped memory.
+# While no setpoint arrives, the server polls less and less often.
+#
+# A restarted server replaces the file, and clients that still map the old
+# one would keep writing into a file nobody reads. The server therefore sets
+# `retired` in the old file's header first, and MailboxClient maps the new
+# file as soon as it sees the flag.
+#
+# Layout (little endian):
+#
+#   header:    char[4] magic "SPMB" | uint16 version | uint16 slots | uint32 retired
+#   ids:       slots * char[32], vehicle id (BLE address), NUL padded
+#   slots:     slots * 32 bytes:
+#              uint32 lock | uint32 seq | float64 timestamp (time.time()) | int8 speed | int8 angle | uint8 lights
+#
+# Every slot is a seqlock: the writer makes `lock` odd, writes the setpoint
+# and makes it even again. A reader that sees an odd lock, or a different
+# lock after reading, retries, so it never applies a half written setpoint.
+# There must be only one writing client per slot.
+
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from collections import namedtuple
+from latency_stats import RunningStats
+
+MAGIC = b"SPMB"
+VERSION = 2
+HEADER = struct.Struct("<4sHHI")
+RETIRED = struct.Struct("<I")
+RETIRED_OFFSET = 8
+ID_SIZE = 32
+LOCK = struct.Struct("<I")
+SLOT = struct.Struct("<IIdbbB")
+PAYLOAD = struct.Struct("<IdbbB") # SLOT without the lock
+SLOT_STRIDE = 32
+SEQ_MASK = 0xFFFFFFFF
+
+_SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+DEFAULT_MAILBOX_PATH = os.path.join(_SHM_DIR, "robot_control_setpoints")
+
+Setpoint = namedtuple("Setpoint", "seq timestamp speed angle lights")
+
+logger = logging.getLogger(__name__)
+
+
+class SetpointMailbox:
+    def __init__(self, path, file, mm):
+        """use SetpointMailbox.create() or SetpointMailbox.open()"""
+        self.path = path
+        self._file = file
+        self._mm = mm
+        magic, version, slots, _ = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} setpoint mailbox")
+        self.slots = slots
+        self._ids_offset = HEADER.size
+        self._slots_offset = HEADER.size + slots * ID_SIZE
+        self.torn_reads = 0 # reads retried because a writer was busy with the slot
+
+        # the writer side keeps its own lock counters (one writer per slot)
+        self._locks = [LOCK.unpack_from(mm, self._offset(slot))[0] & ~1 for slot in range(slots)]
+        self._seqs = [PAYLOAD.unpack_from(mm, self._offset(slot) + LOCK.size)[0] for slot in range(slots)]
+
+    @classmethod
+    def create(cls, vehicle_ids, path=DEFAULT_MAILBOX_PATH):
+        """
+        create (or replace) the mailbox with one slot per vehicle id
+        the file is built next to `path` and renamed into place, so a client never maps a half written header
+        a mailbox already at `path` is retired first, so its clients move to the new one
+        """
+        size = HEADER.size + len(vehicle_ids) * (ID_SIZE + SLOT_STRIDE)
+        data = bytearray(size)
+        HEADER.pack_into(data, 0, MAGIC, VERSION, len(vehicle_ids), 0)
+        for index, vehicle_id in enumerate(vehicle_ids):
+            encoded = str(vehicle_id).encode("ascii")[:ID_SIZE]
+            data[HEADER.size + index * ID_SIZE:HEADER.size + index * ID_SIZE + len(encoded)] = encoded
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        try:
+            old = cls.open(path)
+        except (OSError, ValueError):
+            old = None # no mailbox yet, or one of another version
+        if old is not None:
+            old.retire()
+            old.close()
+        os.replace(tmp_path, path)
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path=DEFAULT_MAILBOX_PATH):
+        """map an existing mailbox, raises FileNotFoundError when the server has not created it"""
+        file = open(path, "r+b")
+        try:
+            mm = mmap.mmap(file.fileno(), 0)
+        except Exception:
+            file.close()
+            raise
+        return cls(path, file, mm)
+
+    @property
+    def retired(self):
+        """whether the server replaced or removed this mailbox, writes to it are never read"""
+        return RETIRED.unpack_from(self._mm, RETIRED_OFFSET)[0] != 0
+
+    def retire(self):
+        RETIRED.pack_into(self._mm, RETIRED_OFFSET, 1)
+
+    @property
+    def vehicle_ids(self):
+        ids = []
+        for slot in range(self.slots):
+            offset = self._ids_offset + slot * ID_SIZE
+            ids.append(bytes(self._mm[offset:offset + ID_SIZE]).rstrip(b"\0").decode("ascii"))
+        return ids
+
+    def slot(self, vehicle):
+        """slot index of a vehicle id or of an index ("0", 1, ...), raises ValueError when unknown"""
+        if isinstance(vehicle, int) or str(vehicle).isdigit():
+            index = int(vehicle)
+            if index < self.slots:
+                return index
+        else:
+            ids = self.vehicle_ids
+            if vehicle in ids:
+                return ids.index(vehicle)
+        raise ValueError(f"no mailbox slot for vehicle {vehicle}")
+
+    def _offset(self, slot):
+        return self._slots_offset + slot * SLOT_STRIDE
+
+    def write(self, slot, speed, angle, lights=0, timestamp=None):
+        """publish a setpoint in `slot`, returns its sequence number"""
+        mm = self._mm
+        offset = self._offset(slot)
+        lock = self._locks[slot]
+        seq = self._seqs[slot] = (self._seqs[slot] + 1) & SEQ_MASK
+        LOCK.pack_into(mm, offset, (lock + 1) & SEQ_MASK)
+        PAYLOAD.pack_into(mm, offset + LOCK.size, seq, time.time() if timestamp is None else timestamp,
+                          speed, angle, lights)
+        self._locks[slot] = lock = (lock + 2) & SEQ_MASK
+        LOCK.pack_into(mm, offset, lock)
+        return seq
+
+    def read(self, slot, retries=100):
+        """newest Setpoint of `slot`, None when it was never written or every attempt was torn"""
+        mm = self._mm
+        offset = self._offset(slot)
+        for _ in range(retries):
+            lock, seq, timestamp, speed, angle, lights = SLOT.unpack_from(mm, offset)
+            if not lock & 1 and LOCK.unpack_from(mm, offset)[0] == lock:
+                return Setpoint(seq, timestamp, speed, angle, lights) if seq else None
+            self.torn_reads += 1
+        return None
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def unlink(self):
+        """remove the file, a mailbox that is still mapped is retired first"""
+        if self._mm is not None:
+            self.retire()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class MailboxReader:
+    def __init__(self, mailbox, submit, poll_interval=0.002, idle_poll_interval=0.05, idle_after=1.0):
+        """
+        mailbox: SetpointMailbox created by the server
+        submit: callable (slot, Setpoint), called once per new setpoint; must not block
+        poll_interval: seconds between two scans of every slot while setpoints arrive
+        idle_poll_interval: the interval doubles up to this after idle_after seconds without a new setpoint
+        """
+        self.mailbox = mailbox
+        self.submit = submit
+        self.poll_interval = poll_interval
+        self.idle_poll_interval = idle_poll_interval
+        self.idle_after = idle_after
+        self.interval = poll_interval
+        self.polls = 0
+        self.applied = 0
+        self.age = RunningStats() # seconds from the client's write to the server's read
+        self._last = [None] * mailbox.slots
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="setpoint mailbox reader")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def poll(self):
+        """scan every slot once, returns the number of new setpoints submitted"""
+        self.polls += 1
+        new = 0
+        for slot in range(self.mailbox.slots):
+            setpoint = self.mailbox.read(slot)
+            if setpoint is None or setpoint == self._last[slot]:
+                continue
+            self._last[slot] = setpoint
+            self.age.add(time.time() - setpoint.timestamp)
+            self.submit(slot, setpoint)
+            new += 1
+        self.applied += new
+        return new
+
+    async def _run(self):
+        last_new = time.monotonic()
+        while True:
+            try:
+                new = self.poll()
+            except Exception:
+                logger.exception("setpoint mailbox %s: poll failed", self.mailbox.path)
+                new = 0
+            if new:
+                last_new = time.monotonic()
+                self.interval = self.poll_interval
+            elif time.monotonic() - last_new >= self.idle_after:
+                # back off while idle, the first setpoint after a pause waits at most idle_poll_interval
+                self.interval = min(self.interval * 2, self.idle_poll_interval)
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        return {
+            "path": self.mailbox.path,
+            "vehicles": self.mailbox.vehicle_ids,
+            "polls": self.polls,
+            "poll_interval_ms": self.interval * 1000,
+            "applied": self.applied,
+            "torn_reads": self.mailbox.torn_reads,
+            "age_ms": self.age.as_dict(1000),
+        }
+
+
+class MailboxClient:
+    """client side of the mailbox, same interface as drive_channel.DriveChannelClient"""
+
+    def __init__(self, path=DEFAULT_MAILBOX_PATH, vehicle=0):
+        self.path = path
+        self.vehicle = vehicle
+        self.mailbox = None
+        self.slot = None
+        self.seq = 0
+
+    async def connect(self):
+        self.mailbox = SetpointMailbox.open(self.path)
+        self.slot = self.mailbox.slot(self.vehicle)
+        return self
+
+    async def send(self, speed, angle, lights=0):
+        """publish one setpoint, returns its sequence number"""
+        if self.mailbox.retired:
+            # the server restarted and replaced the file, or stopped (then connect() raises FileNotFoundError)
+            await self.close()
+            await self.connect()
+        self.seq = self.mailbox.write(self.slot, speed, angle, lights)
+        return self.seq
+
+    async def close(self):
+        if self.mailbox is not None:
+            self.mailbox.close()
+            self.mailbox = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,28 @@
+# test_droid_commands.py
+# Byte parity of the droiddepot command encoders: every command the
+# controllers send through the byte API must write exactly the bytes the old
+# hex string encoders (kept in bench_droid_commands.py) wrote.
+
+import asyncio
+from bench_droid_commands import RecordingClient, check_parity, parity_cases
+from droiddepot.connection import DroidConnection
+
+
+def recording_connection():
+    connection = DroidConnection("00:00:00:00:00:00", {})
+    connection.droid = RecordingClient()
+    return connection
+
+
+def test_every_command_writes_the_legacy_bytes():
+    count, failures = asyncio.run(check_parity(recording_connection()))
+    assert count == len(parity_cases(recording_connection()))
+    assert failures == []
+
+
+def test_build_droid_command_bytes_matches_build_droid_command():
+    connection = recording_connection()
+    for command_id in (0x05, 0x0A, 0x0F, 0x10):
+        for data in (b"", b"\x00", b"\x44\x01\x1f", bytes(range(40))):
+            assert connection.build_droid_command_bytes(command_id, data) == \
+                bytes(connection.build_droid_command(command_id, data.hex()))
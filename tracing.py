@@ -0,0 +1,253 @@
+# tracing.py
+# Hot path tracing across the clients, the control servers and the BLE write.
+#
+# A client opens a span per setpoint and sends a W3C style trace context
+# header with its request:
+#
+#   traceparent: 00-<32 hex trace id>-<16 hex parent span id>-01
+#
+# The server (--trace) continues the trace in a middleware, and the BLE write
+# (TechnicMoveHub.send_data, DroidConnection.send_droid_command) opens a
+# child span of whatever span is current on that task, and no span at all
+# when the task is not being traced. Every process writes its spans to its
+# own file in the Chrome trace event format (JSON array, one compact event
+# per line), which chrome://tracing and ui.perfetto.dev open as is.
+# Timestamps are wall clock microseconds, so the files of all processes on
+# one machine line up; merge them into one trace with
+#
+#   python tracing.py merge trace.json joystick.json robot_control.json
+#   python tracing.py summary trace.json
+
+import argparse
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+
+TRACEPARENT = "traceparent"
+
+TraceContext = namedtuple("TraceContext", "trace_id span_id")
+
+# span of the running task, the parent of new spans
+current_context = contextvars.ContextVar("trace_context", default=None)
+
+
+def new_trace_id():
+    return os.urandom(16).hex()
+
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+
+def parse_traceparent(value):
+    """TraceContext from a traceparent header, None when it is missing or malformed"""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return TraceContext(parts[1], parts[2])
+
+
+def format_traceparent(context):
+    return f"00-{context.trace_id}-{context.span_id}-01"
+
+
+class Span:
+    def __init__(self, tracer, name, parent, cat, args, start=None):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.parent = parent
+        self.context = TraceContext(parent.trace_id if parent is not None else new_trace_id(), new_span_id())
+        self.start = start
+        self.end_time = None
+        self._token = None
+
+    def begin(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        self._token = current_context.set(self.context)
+        return self
+
+    def end(self):
+        if self.end_time is not None:
+            return
+        self.end_time = time.monotonic()
+        if self._token is not None:
+            current_context.reset(self._token)
+            self._token = None
+        self.tracer.emit(self)
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def traceparent(self):
+        """header value for an outgoing request, child spans in other processes are linked to this one"""
+        self.tracer.emit_flow("s", self.context.span_id, time.monotonic())
+        return format_traceparent(self.context)
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = repr(exc_value)
+        self.end()
+
+
+class Tracer:
+    def __init__(self, path, process_name=None):
+        """
+        path: trace file, overwritten
+        process_name: shown for this process in the trace viewer
+        """
+        self.path = path
+        self.pid = os.getpid()
+        self.spans = 0
+        # monotonic for durations, anchored to the wall clock once so files of several processes line up
+        self._wall_offset = time.time() - time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(path, "w")
+        self._file.write("[\n")
+        self._write({"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0,
+                     "args": {"name": process_name or os.path.basename(sys.argv[0])}})
+
+    def _us(self, monotonic):
+        return int((monotonic + self._wall_offset) * 1e6)
+
+    def _write(self, event):
+        line = json.dumps(event, separators=(",", ":")) + ",\n"
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+
+    def span(self, name, parent=None, cat="control", start=None, **args):
+        """
+        context manager timing `name`; parent defaults to the current span of this task
+        start: monotonic start time when the span began before it was opened (e.g. an input event)
+        """
+        return Span(self, name, parent if parent is not None else current_context.get(), cat, args, start)
+
+    def child_span(self, name, cat="control", **args):
+        """
+        span of `name` under the current span of this task, a no-op context manager when there is none
+        keeps hot path writes of untraced requests out of the trace
+        """
+        parent = current_context.get()
+        return Span(self, name, parent, cat, args) if parent is not None else nullcontext()
+
+    def start_span(self, name, parent=None, cat="control", start=None, **args):
+        """open a span that is closed with span.end()"""
+        return self.span(name, parent, cat, start, **args).begin()
+
+    def emit(self, span):
+        self.spans += 1
+        args = dict(span.args, trace_id=span.context.trace_id, span_id=span.context.span_id)
+        if span.parent is not None:
+            args["parent_id"] = span.parent.span_id
+        self._write({"name": span.name, "cat": span.cat, "ph": "X", "ts": self._us(span.start),
+                     "dur": max(0, int((span.end_time - span.start) * 1e6)), "pid": self.pid,
+                     "tid": threading.get_native_id(), "args": args})
+
+    def emit_flow(self, phase, flow_id, at):
+        """flow arrow between processes: "s" where the header is sent, "f" where it arrives"""
+        event = {"name": TRACEPARENT, "cat": "flow", "ph": phase, "id": flow_id, "ts": self._us(at),
+                 "pid": self.pid, "tid": threading.get_native_id()}
+        if phase == "f":
+            event["bp"] = "e"
+        self._write(event)
+
+    def install(self, app):
+        """
+        continue the traces of HTTP requests that carry a traceparent header
+        requests without one are not traced
+        """
+
+        @app.middleware("http")
+        async def trace_request(request, call_next):
+            remote = parse_traceparent(request.headers.get(TRACEPARENT))
+            if remote is None:
+                return await call_next(request)
+            span = self.start_span(f"{request.method} {request.url.path}", parent=remote, cat="server")
+            self.emit_flow("f", remote.span_id, span.start)
+            try:
+                response = await call_next(request)
+                span.set(status=response.status_code)
+                return response
+            finally:
+                span.end()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load_events(path):
+    """events of a trace file; the trailing comma and missing "]" of an open file are accepted"""
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith("{"):
+        return json.loads(text).get("traceEvents", [])
+    text = text.rstrip(",")
+    if not text.endswith("]"):
+        text += "]"
+    return json.loads(text.replace(",\n]", "\n]"))
+
+
+def merge(output, paths):
+    events = []
+    for path in paths:
+        events.extend(load_events(path))
+    events.sort(key=lambda event: event.get("ts", 0))
+    with open(output, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, separators=(",", ":"))
+    return len(events)
+
+
+def summary(paths):
+    """duration percentiles per span name, in ms"""
+    from latency_stats import summarize
+
+    durations = {}
+    for path in paths:
+        for event in load_events(path):
+            if event.get("ph") == "X":
+                durations.setdefault((event.get("cat"), event["name"]), []).append(event["dur"] / 1e6)
+    return {f"{cat}/{name}": summarize(values, 1000) for (cat, name), values in sorted(durations.items())}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge or summarize trace files written with --trace")
+    commands = parser.add_subparsers(dest="command", required=True)
+    merge_parser = commands.add_parser("merge", help="merge the trace files of several processes into one")
+    merge_parser.add_argument("output")
+    merge_parser.add_argument("inputs", nargs="+")
+    summary_parser = commands.add_parser("summary", help="span duration percentiles per span name")
+    summary_parser.add_argument("inputs", nargs="+")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "merge":
+        print(f"{merge(args.output, args.inputs)} events written to {args.output}")
+    else:
+        for name, stats in summary(args.inputs).items():
+            print(f"{name:<40} n {stats['count']:6}  p50 {stats['p50']:8.3f} ms  p95 {stats['p95']:8.3f} ms  "
+                  f"p99 {stats['p99']:8.3f} ms")